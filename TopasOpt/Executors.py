@@ -0,0 +1,418 @@
+"""
+Executors control where and how the RunIteration.sh scripts generated by the optimisers are run. Every executor has a
+Submit method which starts a script and immediately returns a concurrent.futures.Future; the result of the future is
+the exit code of the script. Optimisers wait on these futures, so the same optimisation code can run simulations on
+the local machine, on a cluster via a batch scheduler, or not at all (for testing).
+
+Basic use::
+
+    from TopasOpt.Executors import SlurmExecutor
+    Optimiser = BayesianOptimiser(..., Executor=SlurmExecutor(SubmitArguments=['--cpus-per-task=8']),
+                                  bayes_BatchSize=8)
+"""
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+ch = logging.StreamHandler()
+formatter = logging.Formatter('[%(filename)s: line %(lineno)d %(levelname)8s] %(message)s')
+ch.setFormatter(formatter)
+logger = logging.getLogger(__name__)
+logger.addHandler(ch)
+logger.setLevel(logging.INFO)  # This toggles all the logging in your app
+logger.propagate = False
+
+
+class TopasExecutor:
+    """
+    Base class for all executors. This class is not intended to be used directly; inheriting classes must supply
+    their own Submit method.
+    Attributes beginning with an underscore are runtime state (threads, locks, queued jobs) and are not copied when
+    the optimiser writes its settings to file.
+    """
+
+    def Submit(self, ShellScriptLocation, WorkingDirectory):
+        """
+        Start running a shell script.
+
+        :param ShellScriptLocation: the script to run
+        :type ShellScriptLocation: str or Path
+        :param WorkingDirectory: directory to run the script from
+        :type WorkingDirectory: str or Path
+        :returns: concurrent.futures.Future whose result is the exit code of the script
+        """
+        raise NotImplementedError
+
+    def Cancel(self, future):
+        """
+        Stop a job which is still running, e.g. because its partial results show it can't beat the best result so
+        far. Its future then completes with a non zero exit code. Executors which can't do this return False, and
+        optimisers won't try to stop their jobs early.
+
+        :param future: the future returned by Submit
+        :type future: concurrent.futures.Future
+        :returns: True if the job is being stopped
+        """
+        return False
+
+    def Shutdown(self, wait=True):
+        """
+        Release any resources held by the executor. Jobs which have already been submitted are not cancelled.
+
+        :param wait: if True, block until all submitted jobs have finished
+        :type wait: bool, optional
+        """
+        pass
+
+    def __getstate__(self):
+        """
+        Only the user settings are copied when the executor is serialised
+        """
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __setstate__(self, state):
+        """
+        Restore the user settings; runtime state is recreated when it is next needed
+        """
+        self.__dict__.update(state)
+
+
+class LocalExecutor(TopasExecutor):
+    """
+    Run scripts on this machine. Each script runs in its own bash process; a pool of threads waits on these
+    processes, so up to MaxWorkers scripts can run at the same time. This is the default executor.
+
+    :param MaxWorkers: maximum number of scripts to run at the same time. If None, there is no limit other than
+        the number of scripts the optimiser submits at once (e.g. bayes_BatchSize)
+    :type MaxWorkers: int, optional
+    """
+
+    def __init__(self, MaxWorkers=None):
+        """
+        init method for LocalExecutor. input options are in class docstring
+        """
+        self.MaxWorkers = MaxWorkers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._jobs = {}  # future: {'process': subprocess.Popen, 'cancelled': bool}
+
+    def _run_script(self, ShellScriptLocation, WorkingDirectory, Job):
+        """
+        run a single script and wait for it to finish. The script gets its own process group, so that Cancel can
+        stop topas as well as bash
+        """
+        with self._lock:
+            if Job['cancelled']:
+                return -signal.SIGTERM
+            Job['process'] = subprocess.Popen(['bash', str(ShellScriptLocation)], cwd=str(WorkingDirectory),
+                                              start_new_session=True)
+        return Job['process'].wait()
+
+    def Submit(self, ShellScriptLocation, WorkingDirectory):
+        """
+        Start running a shell script in a new bash process. See TopasExecutor.Submit
+        """
+        if getattr(self, '_lock', None) is None:
+            self._lock = threading.Lock()
+        with self._lock:
+            if getattr(self, '_pool', None) is None:
+                # a thread only waits on its subprocess, so a large default pool costs nothing
+                MaxWorkers = self.MaxWorkers if self.MaxWorkers is not None else 256
+                self._pool = ThreadPoolExecutor(max_workers=MaxWorkers)
+                self._jobs = {}
+        Job = {'process': None, 'cancelled': False}
+        future = self._pool.submit(self._run_script, ShellScriptLocation, WorkingDirectory, Job)
+        with self._lock:
+            self._jobs[future] = Job
+        future.add_done_callback(self._forget_job)
+        return future
+
+    def _forget_job(self, future):
+        """
+        called when a job finishes
+        """
+        with self._lock:
+            self._jobs.pop(future, None)
+
+    def Cancel(self, future):
+        """
+        Terminate the process group running a script. See TopasExecutor.Cancel
+        """
+        with self._lock:
+            Job = self._jobs.get(future)
+            if Job is None:
+                return False
+            Job['cancelled'] = True
+            if Job['process'] is not None:
+                try:
+                    os.killpg(Job['process'].pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass  # it has just finished
+        return True
+
+    def Shutdown(self, wait=True):
+        """
+        Shut down the thread pool. See TopasExecutor.Shutdown
+        """
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+
+class SlurmExecutor(TopasExecutor):
+    """
+    Submit scripts to a batch scheduler and poll until they finish. The defaults are for
+    `SLURM <https://slurm.schedmd.com/>`_, but any scheduler with a submit command which prints a job ID and a status
+    command which prints the job state can be used by changing SubmitCommand, StatusCommand and the state lists.
+    Any #SBATCH (or equivalent) directives can be placed in the ShellScriptHeader of the optimiser, or passed as
+    SubmitArguments.
+
+    :param SubmitArguments: extra arguments passed to the submit command, e.g. ['--partition=long', '--cpus-per-task=8']
+    :type SubmitArguments: list, optional
+    :param PollInterval: seconds between status checks
+    :type PollInterval: float, optional
+    :param SubmitCommand: command used to submit a job. The script location is appended. It must print the job ID
+        as the first thing on its output
+    :type SubmitCommand: str, optional
+    :param StatusCommand: command used to check a job. {job_id} is replaced with the job ID. It must print the state
+        of the job
+    :type StatusCommand: str, optional
+    :param CompletedStates: states which mean the job finished successfully
+    :type CompletedStates: list, optional
+    :param FailedStates: states which mean the job finished unsuccessfully
+    :type FailedStates: list, optional
+    :param CancelCommand: command used to cancel a job. {job_id} is replaced with the job ID
+    :type CancelCommand: str, optional
+    :param UnknownStateTimeout: seconds a job can go without a state from StatusCommand (because it fails, or prints
+        nothing) before it is treated as failed. A newly submitted job may not be visible to the scheduler straight
+        away, so this shouldn't be too short
+    :type UnknownStateTimeout: float, optional
+    """
+
+    def __init__(self, SubmitArguments=None, PollInterval=30, SubmitCommand='sbatch --parsable',
+                 StatusCommand='sacct --noheader --allocations --parsable2 --format=State --jobs={job_id}',
+                 CompletedStates=None, FailedStates=None, CancelCommand='scancel {job_id}', UnknownStateTimeout=600):
+        """
+        init method for SlurmExecutor. input options are in class docstring
+        """
+        self.SubmitArguments = SubmitArguments if SubmitArguments is not None else []
+        self.PollInterval = PollInterval
+        self.SubmitCommand = SubmitCommand
+        self.StatusCommand = StatusCommand
+        self.CompletedStates = CompletedStates if CompletedStates is not None else ['COMPLETED']
+        self.FailedStates = FailedStates if FailedStates is not None else \
+            ['FAILED', 'CANCELLED', 'TIMEOUT', 'NODE_FAIL', 'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE', 'PREEMPTED']
+        self.CancelCommand = CancelCommand
+        self.UnknownStateTimeout = UnknownStateTimeout
+        self._jobs = {}  # job_id: future
+        self._unknown_since = {}  # job_id: time since which StatusCommand hasn't given a state
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def _get_job_state(self, job_id):
+        """
+        Ask the scheduler for the state of a job. Returns an empty string if the state is unknown, e.g. because the
+        scheduler doesn't know about the job yet or StatusCommand failed
+        """
+        try:
+            cmd = subprocess.run(shlex.split(self.StatusCommand.format(job_id=job_id)), capture_output=True,
+                                 text=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f'failed to check the state of job {job_id}: {e}')
+            return ''
+        if cmd.returncode != 0 or not cmd.stdout.strip():
+            return ''
+        # e.g. 'CANCELLED by 1234' -> 'CANCELLED'
+        return cmd.stdout.strip().splitlines()[0].split()[0]
+
+    def _poll_jobs(self):
+        """
+        Runs in a background thread: check every outstanding job each PollInterval, and complete the futures of
+        any which have finished. The thread exits when there are no jobs left. If anything goes wrong in the thread,
+        the futures of all outstanding jobs are given the exception, rather than leaving them waiting forever.
+        """
+        try:
+            while True:
+                with self._lock:
+                    jobs = dict(self._jobs)
+                    if not jobs:
+                        self._monitor = None
+                        return
+                for job_id, future in jobs.items():
+                    state = self._get_job_state(job_id)
+                    if state in self.CompletedStates:
+                        ReturnCode = 0
+                    elif state in self.FailedStates:
+                        logger.error(f'job {job_id} finished with state {state}')
+                        ReturnCode = 1
+                    elif state:
+                        self._unknown_since.pop(job_id, None)
+                        continue  # pending or running
+                    elif time.time() - self._unknown_since.setdefault(job_id, time.time()) > \
+                            self.UnknownStateTimeout:
+                        logger.error(f'no state for job {job_id} from "{self.StatusCommand}" in '
+                                     f'{self.UnknownStateTimeout} s; treating it as failed')
+                        ReturnCode = 1
+                    else:
+                        continue  # not yet visible to the scheduler
+                    with self._lock:
+                        self._jobs.pop(job_id)
+                        self._unknown_since.pop(job_id, None)
+                    future.set_result(ReturnCode)
+                time.sleep(self.PollInterval)
+        except Exception as e:
+            logger.error(f'stopped monitoring jobs: {e}')
+            with self._lock:
+                futures = list(self._jobs.values())
+                self._jobs = {}
+                self._unknown_since = {}
+                self._monitor = None
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def Submit(self, ShellScriptLocation, WorkingDirectory):
+        """
+        Submit a script to the scheduler. See TopasExecutor.Submit
+        """
+        if getattr(self, '_lock', None) is None:
+            self._lock = threading.Lock()
+            self._jobs = {}
+            self._unknown_since = {}
+            self._monitor = None
+        # sbatch runs the job in the directory it is submitted from
+        cmd = shlex.split(self.SubmitCommand) + list(self.SubmitArguments) + [str(ShellScriptLocation)]
+        future = Future()
+        try:
+            SubmitResult = subprocess.run(cmd, capture_output=True, text=True, cwd=str(WorkingDirectory))
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f'Failed to submit {ShellScriptLocation}: {e}')
+            future.set_result(1)
+            return future
+        if SubmitResult.returncode != 0:
+            logger.error(f'Failed to submit {ShellScriptLocation}:\n{SubmitResult.stderr}')
+            future.set_result(SubmitResult.returncode)
+            return future
+        job_id = SubmitResult.stdout.strip().split(';')[0].split()[-1]  # --parsable gives 'id' or 'id;cluster'
+        logger.info(f'submitted {Path(ShellScriptLocation).name} as job {job_id}')
+        with self._lock:
+            self._jobs[job_id] = future
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._poll_jobs, daemon=True)
+                self._monitor.start()
+        return future
+
+    def Cancel(self, future):
+        """
+        Cancel a job with CancelCommand. See TopasExecutor.Cancel
+        """
+        if getattr(self, '_lock', None) is None:
+            return False
+        with self._lock:
+            JobIDs = [job_id for job_id, job_future in self._jobs.items() if job_future is future]
+        if not JobIDs:
+            return False
+        cmd = subprocess.run(shlex.split(self.CancelCommand.format(job_id=JobIDs[0])), capture_output=True, text=True)
+        if cmd.returncode != 0:
+            logger.warning(f'failed to cancel job {JobIDs[0]}:\n{cmd.stderr}')
+            return False
+        return True
+
+    def Shutdown(self, wait=True):
+        """
+        Optionally wait for all outstanding jobs. See TopasExecutor.Shutdown
+        """
+        if wait and getattr(self, '_lock', None) is not None:
+            with self._lock:
+                futures = list(self._jobs.values())
+            for future in futures:
+                future.result()
+
+
+class FakeSchedulerExecutor(TopasExecutor):
+    """
+    An in-process stand in for a real scheduler, intended for testing. Scripts are not run (unless RunScripts=True);
+    each job simply finishes after a simulated run time. Random run times mean jobs finish out of order, which is
+    useful for testing asynchronous optimisation.
+
+    :param JobDuration: simulated run time in seconds. Either a number, or a (min, max) tuple in which case each job
+        takes a random time in that range
+    :type JobDuration: float or tuple, optional
+    :param RunScripts: if True, the scripts are actually run (in a bash process) before the job finishes
+    :type RunScripts: bool, optional
+    :param ExitCode: exit code reported for every job which isn't actually run
+    :type ExitCode: int, optional
+    :param random_state: seed for the random run times
+    :type random_state: int, optional
+    """
+
+    def __init__(self, JobDuration=0, RunScripts=False, ExitCode=0, random_state=None):
+        """
+        init method for FakeSchedulerExecutor. input options are in class docstring
+        """
+        self.JobDuration = JobDuration
+        self.RunScripts = RunScripts
+        self.ExitCode = ExitCode
+        self.random_state = random_state
+        self.SubmittedScripts = []  # every script ever submitted, in order
+        self.CancelledScripts = []  # every script stopped by Cancel, in order
+        self._rng = np.random.default_rng(random_state)
+        self._lock = threading.Lock()
+        self._timers = {}  # future: (timer, script)
+
+    def _finish_job(self, future, ShellScriptLocation, WorkingDirectory):
+        """
+        called when the simulated run time has elapsed
+        """
+        with self._lock:
+            if self._timers.pop(future, None) is None:
+                return  # cancelled
+        if self.RunScripts:
+            cmd = subprocess.run(['bash', str(ShellScriptLocation)], cwd=str(WorkingDirectory))
+            future.set_result(cmd.returncode)
+        else:
+            future.set_result(self.ExitCode)
+
+    def Submit(self, ShellScriptLocation, WorkingDirectory):
+        """
+        Record the script and schedule it to finish. See TopasExecutor.Submit
+        """
+        if getattr(self, '_lock', None) is None:
+            self._lock = threading.Lock()
+            self._rng = np.random.default_rng(self.random_state)
+            self._timers = {}
+        with self._lock:
+            self.SubmittedScripts.append(str(ShellScriptLocation))
+            if isinstance(self.JobDuration, (tuple, list)):
+                Duration = self._rng.uniform(self.JobDuration[0], self.JobDuration[1])
+            else:
+                Duration = self.JobDuration
+        future = Future()
+        timer = threading.Timer(Duration, self._finish_job, args=(future, ShellScriptLocation, WorkingDirectory))
+        timer.daemon = True
+        with self._lock:
+            self._timers[future] = (timer, str(ShellScriptLocation))
+        timer.start()
+        return future
+
+    def Cancel(self, future):
+        """
+        Finish a job straight away with exit code -15, as if it had been terminated. See TopasExecutor.Cancel
+        """
+        with self._lock:
+            Job = self._timers.pop(future, None) if getattr(self, '_timers', None) is not None else None
+            if Job is None:
+                return False
+            timer, ShellScriptLocation = Job
+            self.CancelledScripts.append(ShellScriptLocation)
+        timer.cancel()
+        future.set_result(-signal.SIGTERM)
+        return True
@@ -5,12 +5,17 @@ which other optimisers inherit from.
 """
 import logging
 import os
+import pickle
+import re
 # matplotlib.use('Agg')  # if having trouble with generating figures through ssh, this resolves...
 import shutil
 import stat
-import subprocess
 import sys
+import threading
+import time
+import warnings
 from abc import abstractmethod
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 from pathlib import Path
 
 import jsonpickle
@@ -20,13 +25,18 @@ from bayes_opt import acquisition
 from bayes_opt.event import Events
 from bayes_opt.logger import JSONLogger
 from bayes_opt.util import load_logs, NotUniqueError
-from matplotlib import pyplot as plt
-from scipy import stats
-from scipy.optimize import minimize
+from scipy.optimize import OptimizeResult
 from scipy.optimize import rosen
+from scipy.stats import norm, qmc
 from sklearn.gaussian_process.kernels import Matern
 
-from .utilities import bcolors, FigureSpecs, newJSONLogger, ReadInLogFile, PlotLogFile
+from .Executors import LocalExecutor, TopasExecutor
+from .TopasScriptGenerator import get_script_run_order, set_number_of_threads, find_script_dependencies, \
+    find_script_outputs, split_topas_script, has_mergeable_outputs
+from .utilities import bcolors, newJSONLogger, ReadInLogFile, PlotConvergence, \
+    AppendToBinaryLog, LogReader, ExportLogToText, FormatLogEntry, BackgroundRenderer, PlotRetrospectiveModelFit, \
+    PlotPredictedVersusActual, PlotSingleParameter, GaussianProcessSlicer, IncrementalGaussianProcessRegressor, \
+    SparseGaussianProcessRegressor, PooledUpperConfidenceBound, MergeBinnedResults
 
 ch = logging.StreamHandler()
 formatter = logging.Formatter('[%(filename)s: line %(lineno)d %(levelname)8s] %(message)s')
@@ -88,12 +98,62 @@ class TopasOptBaseClass:
         case the log files contain the info from all cases, it's just a matter of whether you want to store every iteration
         which can take a lot of space
     :type KeepAllResults: bool, optional
+    :param Executor: controls where the topas simulations are run, e.g. on this machine or through a batch
+        scheduler. See TopasOpt.Executors for the options. Default is TopasOpt.Executors.LocalExecutor()
+    :type Executor: TopasOpt.Executors.TopasExecutor, optional
+    :param ParallelScripts: if True, scripts which don't depend on each other (e.g. several scorers reading the same
+        phase space file) are run at the same time. Dependencies are found from the OutputFile and
+        PhaseSpaceFileName parameters; scripts which read the output of another script still wait for it to finish
+    :type ParallelScripts: bool, optional
+    :param TotalThreads: if supplied, i:Ts/NumberOfThreads in each script is overwritten so that the scripts running
+        at the same time share this many threads between them
+    :type TotalThreads: int, optional
+    :param SimulationCache: if supplied, results are looked up in this cache before topas is run, and stored in it
+        afterwards. A cache can be shared between optimisations. In multi-stage models, the outputs of upstream
+        scripts (e.g. phase space files) are also cached, so an upstream script is skipped whenever neither it nor
+        its own inputs have changed
+    :type SimulationCache: TopasOpt.utilities.SimulationCache, optional
+    :param TextLog: results are always logged at full precision to the binary log OptimisationLogs.bin, which
+        ReadInLogFile reads when given its location. If TextLog is True, OptimisationLogs.txt is also updated every iteration; if False,
+        it is only written once the optimisation has finished
+    :type TextLog: bool, optional
+    :param PlotInBackground: if True, diagnostic plots are drawn in a separate process so the optimisation doesn't
+        wait for them
+    :type PlotInBackground: bool, optional
+    :param PlotEveryNIterations: diagnostic plots are only updated every N iterations. They are always updated at
+        the end of the optimisation
+    :type PlotEveryNIterations: int, optional
+    :param PlotEverySeconds: diagnostic plots are updated at most this often
+    :type PlotEverySeconds: float, optional
+    :param EarlyTerminationSigma: if supplied, simulations which clearly can't beat the best result so far are
+        stopped before they finish. This needs a function TopasPartialObjectiveFunction(ResultsLocation, iteration)
+        in TopasObjectiveFunction.py, which estimates the objective function from the results written so far
+        (e.g. from the checkpoints topas writes with Ts/NumberOfSequentialTimes, or a scorer output every N
+        histories) and returns (estimate, uncertainty), or None if there isn't enough data yet. A simulation is
+        stopped once estimate - EarlyTerminationSigma * uncertainty is greater than the best objective function so
+        far, and its estimate is logged as its objective function. The Executor must support Cancel
+    :type EarlyTerminationSigma: float, optional
+    :param EarlyTerminationInterval: seconds between checks of the partial results of each running simulation
+    :type EarlyTerminationInterval: float, optional
+    :param SplitJobs: if greater than 1, each script which sets NumberOfHistoriesInRun and whose outputs no other
+        script reads (normally the scoring script) is split into this many jobs, each with its own random seed and
+        1/SplitJobs of the histories. The jobs are submitted to the Executor at the same time, so they can run on
+        different cores or cluster nodes, and once they have all finished their binary (.bin) results are merged
+        into the files the original script would have written before TopasObjectiveFunction is called. Scripts
+        whose outputs are read by other scripts, or which write anything other than binary results of binned
+        scorers (e.g. phase space or csv files), are not split. The threads of each job are TotalThreads (or the
+        number of cores) divided by SplitJobs. Can't be combined with EarlyTerminationSigma
+    :type SplitJobs: int, optional
     """
 
     def __init__(self, optimisation_params, BaseDirectory, SimulationName, OptimisationDirectory,
                  ReadMeText=None, G4dataLocation='~/G4Data',
                  TopasLocation='~/topas/',
-                 ShellScriptHeader=None, Overwrite=False, KeepAllResults=True):
+                 ShellScriptHeader=None, Overwrite=False, KeepAllResults=True, Executor=None,
+                 ParallelScripts=False, TotalThreads=None,
+                 SimulationCache=None, TextLog=True, PlotInBackground=True, PlotEveryNIterations=1,
+                 PlotEverySeconds=0, EarlyTerminationSigma=None, EarlyTerminationInterval=30,
+                 SplitJobs=1):
         """
         init method for all optimisers. input options are in class docstring
         """
@@ -108,6 +168,29 @@ class TopasOptBaseClass:
         self.ReadMeText = ReadMeText  # this gets written to base directory
         self.ShellScriptHeader = ShellScriptHeader
         self.KeepAllResults = KeepAllResults
+        self.Executor = Executor if Executor is not None else LocalExecutor()
+        self.ParallelScripts = ParallelScripts
+        self.TotalThreads = TotalThreads
+        self.SimulationCache = SimulationCache
+        self._CacheKeys = {}  # shell script location: (iteration, cache key)
+        self._StageCacheKeys = {}  # iteration: [(cache key, output files)] for upstream scripts not yet cached
+        self._CachedStages = {}  # script index: (cache key, cached files) for the model being generated
+        self.TextLog = TextLog
+        self._LogReader = None  # created when the log is first plotted
+        self.PlotEveryNIterations = PlotEveryNIterations
+        self.PlotEverySeconds = PlotEverySeconds
+        self._Renderer = BackgroundRenderer(InBackground=PlotInBackground)
+        self._LastPlotted = {}  # plot name: (iteration, time)
+        self.EarlyTerminationSigma = EarlyTerminationSigma
+        self.EarlyTerminationInterval = EarlyTerminationInterval
+        self._ScriptItterations = {}  # shell script location: iteration
+        self._EarlyTerminated = {}  # iteration: (estimate, uncertainty) of a simulation which was stopped
+        self._EarlyTerminatedScripts = set()
+        self._EarlyTerminationLock = threading.Lock()
+        self.SplitJobs = SplitJobs
+        self._SplitScripts = {}  # script index: names of the split scripts, for the model being generated
+        self._SplitShellScripts = {}  # shell script location: shell scripts running the split jobs
+        self._SplitOutputs = {}  # iteration: [(output file, split output files, histories of each split job)]
         # attempt the absolute imports from the optimisation directory:
         self.BaseDirectory = BaseDirectory
         self.OptimisationDirectory = OptimisationDirectory
@@ -120,6 +203,12 @@ class TopasOptBaseClass:
         _LogFileLoc  = Path(self.BaseDirectory) / self.SimulationName
         _LogFileLoc  = _LogFileLoc  / 'logs'
         self._LogFileLoc = str(_LogFileLoc  / 'OptimisationLogs.txt')
+        self.CheckpointLocation = _LogFileLoc / 'Checkpoint.pkl'  # see RestartOptimisation
+        self._Observations = []  # (iteration, x, objective function, uncertainty) of every evaluated iteration
+        self._Restarting = False
+        self._ReplayQueue = []  # observations to replay when restarting; see _ReplayIteration
+        self._InFlight = {}  # iteration: x_new of asynchronous iterations submitted but not yet evaluated
+        self._ResumeItteration = 0
         self.Itteration = 0
         self.ItterationStart = 0
         self._optimisation_params = optimisation_params
@@ -164,6 +253,7 @@ class TopasOptBaseClass:
             raise e
         self.TopasScriptGenerator = GenerateTopasScripts.GenerateTopasScripts
         self.TopasObjectiveFunction = TopasObjectiveFunction.TopasObjectiveFunction
+        self.TopasPartialObjectiveFunction = getattr(TopasObjectiveFunction, 'TopasPartialObjectiveFunction', None)
         self._CheckInputData()
 
     def _convert_optimisation_params_to_numpy(self, optimisation_params):
@@ -240,6 +330,8 @@ class TopasOptBaseClass:
 
         - Checks if the number of parameters in ParameterNames, StartingValues, UpperBounds, LowerBounds match
         - Checks that StartingValues is actually within the provided bounds
+        - If EarlyTerminationSigma is set, checks that simulations can be evaluated and stopped early
+        - Checks that SplitJobs is a positive integer
         """
 
         # do the number of parameters match?
@@ -275,6 +367,22 @@ class TopasOptBaseClass:
 
         self._CreateVariableDictionary(self.StartingValues)
 
+        if self.EarlyTerminationSigma is not None:
+            if self.TopasPartialObjectiveFunction is None:
+                logger.error(f'EarlyTerminationSigma is set, but there is no TopasPartialObjectiveFunction in '
+                             f'{Path(self.OptimisationDirectory) / "TopasObjectiveFunction.py"}. Quitting')
+                sys.exit(1)
+            if type(self.Executor).Cancel is TopasExecutor.Cancel:
+                logger.error(f'EarlyTerminationSigma is set, but {type(self.Executor).__name__} can\'t stop '
+                             f'simulations early. Quitting')
+                sys.exit(1)
+        if not (isinstance(self.SplitJobs, (int, np.integer)) and self.SplitJobs >= 1):
+            logger.error(f'SplitJobs must be an integer >= 1, not {self.SplitJobs}. Quitting')
+            sys.exit(1)
+        if self.SplitJobs > 1 and self.EarlyTerminationSigma is not None:
+            logger.error('SplitJobs and EarlyTerminationSigma can\'t be used together. Quitting')
+            sys.exit(1)
+
         # make sure topas binary exists
         if not self._testing_mode:
             if not os.path.isfile(self.TopasLocation / 'bin' / 'topas'):
@@ -283,9 +391,13 @@ class TopasOptBaseClass:
                         f'\nQuitting{bcolors.ENDC}'
                 raise FileNotFoundError(error)
 
-    def _GenerateTopasModel(self, x):
+    def _GenerateTopasModel(self, x, ShellScriptName='RunIteration.sh'):
         """
         Generates a topas model with the latest parameters as well as a shell script called RunAllFiles.sh to run it.
+
+        :param ShellScriptName: name of the shell script which runs this model. When several iterations are run
+            at the same time each one needs its own script, e.g. RunIteration_itt_5.sh
+        :type ShellScriptName: str, optional
         """
 
         self.TopasScripts, self.TopasScriptNames = self.TopasScriptGenerator(Path(self.BaseDirectory) / self.SimulationName,
@@ -296,6 +408,15 @@ class TopasOptBaseClass:
         to pass an extra argument. I just want everyone to know, i'm not proud of myself for this.
         '''
 
+        if self.ParallelScripts:
+            self.ScriptRunOrder = get_script_run_order(self.TopasScripts)
+        else:
+            self.ScriptRunOrder = [[i] for i in range(len(self.TopasScripts))]
+        if self.TotalThreads is not None:
+            for Stage in self.ScriptRunOrder:
+                for i in Stage:
+                    set_number_of_threads(self.TopasScripts[i], max(1, self.TotalThreads // len(Stage)))
+
         self.ScriptsToRun = []
         for i, script_name in enumerate(self.TopasScriptNames):
             script_name = script_name + '_itt_' + str(self.Itteration) + '.tps'
@@ -304,8 +425,119 @@ class TopasOptBaseClass:
             for line in self.TopasScripts[i]:
                 f.write(line)
                 f.write('\n')
+        self._SplitScripts = {}
+        if self.SplitJobs > 1:
+            self._SplitTopasModel()
+
+        self._CachedStages = {}
+        if self.SimulationCache is not None:
+            self._FindCachedStages()
+        self._GenerateRunIterationShellScript(ShellScriptName)
+        self._ScriptItterations[self.ShellScriptLocation] = self.Itteration
+        if self.SimulationCache is not None:
+            CacheKey = self.SimulationCache.GetKey(self.TopasScripts, self.Itteration, self.TopasLocation,
+                                                   self.G4dataLocation, self.ShellScriptHeader,
+                                                   ScriptDirectory=Path(self.BaseDirectory) / self.SimulationName /
+                                                   'TopasScripts')
+            self._CacheKeys[self.ShellScriptLocation] = (self.Itteration, CacheKey)
+
+    def _SplitTopasModel(self):
+        """
+        Split each script which sets NumberOfHistoriesInRun, whose outputs no other script reads, and whose outputs
+        can all be merged (binary results of binned scorers, see has_mergeable_outputs), into self.SplitJobs scripts
+        (see split_topas_script) and write them alongside the other scripts. The threads are shared out between the
+        jobs, so that they don't compete for the same cores.
+        _GenerateRunIterationShellScript runs them in separate shell scripts, and _EvaluateIteration merges their
+        results.
+        """
+        Dependencies = find_script_dependencies(self.TopasScripts)
+        SplitOutputs = []
+        for i, script in enumerate(self.TopasScripts):
+            if any(i in ScriptDependencies for ScriptDependencies in Dependencies):
+                continue  # other scripts read its outputs
+            if not has_mergeable_outputs(script):
+                continue  # e.g. a phase space or csv output, which MergeBinnedResults can't merge
+            SplitScripts, Histories = split_topas_script(script, self.SplitJobs)
+            if Histories is None:
+                continue
+            self._SplitScripts[i] = []
+            TotalThreads = self.TotalThreads if self.TotalThreads is not None else (os.cpu_count() or 1)
+            for k, SplitScript in enumerate(SplitScripts):
+                set_number_of_threads(SplitScript, max(1, TotalThreads // self.SplitJobs))
+                script_name = f'{self.TopasScriptNames[i]}_split_{k}_itt_{self.Itteration}.tps'
+                self._SplitScripts[i].append(script_name)
+                f = open(str(Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts' / script_name), 'w')
+                for line in SplitScript:
+                    f.write(line)
+                    f.write('\n')
+                f.close()
+            SplitOutputFiles = [find_script_outputs(SplitScript) for SplitScript in SplitScripts]
+            for j, OutputFile in enumerate(find_script_outputs(script)):
+                SplitOutputs.append((OutputFile, [Outputs[j] for Outputs in SplitOutputFiles], Histories))
+        self._SplitOutputs[self.Itteration] = SplitOutputs
+
+    def _MergeSplitResults(self):
+        """
+        Merge the results of the split jobs of iteration self.Itteration (see SplitJobs) into the files the original
+        scripts would have written, and delete the results of the individual jobs.
+        _SplitTopasModel only splits scripts whose results can all be merged, so anything else is unexpected and is
+        left as it is.
+        """
+        ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+        for OutputFile, SplitOutputFiles, Histories in self._SplitOutputs.pop(self.Itteration, []):
+            SplitFiles = [ResultsLocation / (SplitOutputFile + '.bin') for SplitOutputFile in SplitOutputFiles]
+            if all(os.path.isfile(SplitFile) for SplitFile in SplitFiles):
+                MergeBinnedResults(SplitFiles, ResultsLocation / (OutputFile + '.bin'), Histories)
+                for SplitFile in SplitFiles:
+                    os.remove(SplitFile)
+                    os.remove(str(SplitFile) + 'header')
+            elif any(file.startswith(SplitOutputFile + '.') for file in os.listdir(ResultsLocation)
+                     for SplitOutputFile in SplitOutputFiles):
+                logger.warning(f'could not merge the split results for {OutputFile}; only binary results can be '
+                               f'merged. The results of each job are left in {ResultsLocation}')
+            # otherwise, nothing was written by the split jobs, e.g. because the results came from SimulationCache
+
+    def _FindCachedStages(self):
+        """
+        Give each script which other scripts depend on (e.g. one which writes a phase space file) a cache key based on
+        its own content and the keys of its inputs, and check whether its outputs are already in
+        self.SimulationCache. Cached scripts are skipped in RunIteration.sh, which hard links their outputs into Results
+        instead. Scripts which aren't cached yet are stored once the iteration has been evaluated.
+        """
+        Dependencies = find_script_dependencies(self.TopasScripts)
+        ScriptDirectory = Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts'
+        StageKeys = {}
+        StagesToStore = []
+        for Stage in get_script_run_order(self.TopasScripts):
+            for i in Stage:
+                UpstreamKeys = [StageKeys[j] for j in sorted(Dependencies[i])]
+                StageKeys[i] = self.SimulationCache.GetKey([self.TopasScripts[i]], self.Itteration,
+                                                           self.TopasLocation, self.G4dataLocation,
+                                                           self.ShellScriptHeader, UpstreamKeys=UpstreamKeys,
+                                                           ScriptDirectory=ScriptDirectory)
+                if not any(i in ScriptDependencies for ScriptDependencies in Dependencies):
+                    continue  # nothing reads this script's output, so the whole model cache is enough
+                CachedFiles = self.SimulationCache.GetCachedFiles(StageKeys[i], self.Itteration)
+                if CachedFiles is None:
+                    StagesToStore.append((StageKeys[i], find_script_outputs(self.TopasScripts[i])))
+                else:
+                    self._CachedStages[i] = (StageKeys[i], CachedFiles)
+        self._StageCacheKeys[self.Itteration] = StagesToStore
 
-        self._GenerateRunIterationShellScript()
+    def _StoreCachedStages(self):
+        """
+        Add the outputs of the upstream scripts of iteration self.Itteration to self.SimulationCache, for any which
+        weren't already cached when the model was generated
+        """
+        ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+        ResultsFiles = self._get_iteration_results_files(self.Itteration)
+        for StageKey, OutputFiles in self._StageCacheKeys.pop(self.Itteration, []):
+            StageFiles = [file for file in ResultsFiles
+                          if any(file == OutputFile or file.startswith(OutputFile + '.') for OutputFile in OutputFiles)]
+            if (not StageFiles) and (not self._testing_mode):
+                continue  # the script didn't write anything, so don't let other iterations rely on it
+            self.SimulationCache.StoreResults(StageKey, [ResultsLocation / file for file in StageFiles],
+                                              self.Itteration)
 
     def _setup_topas_emulator(self):
         """
@@ -331,16 +563,75 @@ class TopasOptBaseClass:
         os.chmod(EmulatorLocation, st.st_mode | stat.S_IEXEC)
         f.close()
 
-    def _GenerateRunIterationShellScript(self):
+    def _GenerateRunIterationShellScript(self, ShellScriptName='RunIteration.sh'):
         """
         This will generate a bash script called 'RunAllFiles', which, funnily enough, can be used to run all files generated!
         """
-        ShellScriptLocation = str(Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts' / 'RunIteration.sh')
+        ShellScriptLocation = str(Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts' / ShellScriptName)
+        self.ShellScriptLocation = ShellScriptLocation
+        f = self._OpenShellScript(ShellScriptLocation)
+
+        # add in all topas scripts which need to be run. scripts in the same stage are independent so run together:
+        for Stage in self.ScriptRunOrder:
+            Stage = [i for i in Stage if i not in self._SplitScripts]  # run by the split shell scripts below
+            if len(Stage) > 1:
+                f.write('pids=""\n')
+            for i in Stage:
+                script_name = self.ScriptsToRun[i]
+                Indent = ''
+                if i in self._CachedStages:
+                    # hard link (or copy) the cached outputs, so that they stay valid even if the cache entry is
+                    # evicted while they are in use, and fall back to running the script if it already has been
+                    StageKey, CachedFiles = self._CachedStages[i]
+                    f.write(f'if [ -f "{Path(self.SimulationCache.CacheDirectory) / StageKey / "metadata.json"}" ]')
+                    for CachedFile, FileName in CachedFiles:
+                        f.write(f' \\\n    && {{ ln -f "{CachedFile}" "../Results/{FileName}" 2> /dev/null || '
+                                f'cp "{CachedFile}" "../Results/{FileName}"; }}')
+                    f.write('; then\n')
+                    f.write(f'    echo "Using cached results for: {script_name}"\n')
+                    f.write('else\n')
+                    Indent = '    '
+                f.write(Indent + 'echo "Beginning analysis of: ' + script_name + '"')
+                f.write('\n')
+                f.write(Indent + '(time TOPAS_HEADLESS_MODE=1 ' + str(self.TopasLocation) + '/bin/topas ' + script_name + ') &> ../logs/TopasLogs/' + script_name)
+                if len(Stage) == 1:
+                    f.write(' || status=1')
+                if i in self._CachedStages:
+                    f.write('\nfi')
+                if len(Stage) > 1:
+                    f.write(' &\npids="$pids $!"')
+                f.write('\n')
+            if len(Stage) > 1:
+                # a bare wait always succeeds, so wait for each script to get its exit code:
+                f.write('for pid in $pids; do\n    wait "$pid" || status=1\ndone\n')
+        self._CloseShellScript(f, ShellScriptLocation)
+
+        # each split job gets its own shell script, which runs its part of every split script:
+        self._SplitShellScripts[ShellScriptLocation] = []
+        if self._SplitScripts:
+            for k in range(self.SplitJobs):
+                SplitShellScriptLocation = str(Path(ShellScriptLocation).with_name(
+                    f'{Path(ShellScriptLocation).stem}_split_{k}.sh'))
+                f = self._OpenShellScript(SplitShellScriptLocation)
+                for i in sorted(self._SplitScripts):
+                    script_name = self._SplitScripts[i][k]
+                    f.write('echo "Beginning analysis of: ' + script_name + '"\n')
+                    f.write('(time TOPAS_HEADLESS_MODE=1 ' + str(self.TopasLocation) + '/bin/topas ' + script_name
+                            + ') &> ../logs/TopasLogs/' + script_name + ' || status=1\n')
+                self._CloseShellScript(f, SplitShellScriptLocation)
+                self._SplitShellScripts[ShellScriptLocation].append(SplitShellScriptLocation)
+
+    def _OpenShellScript(self, ShellScriptLocation):
+        """
+        Create a shell script which sets up the topas environment, ready for the commands which run topas. Commands
+        which fail should set status=1, which is the exit code of the script (see _CloseShellScript)
+
+        :returns: the open file
+        """
         if os.path.isfile(ShellScriptLocation):
             # I don't think I should need to do this; the file should be overwritten if it exists, but this doesn't
             # seem to be working so deleting it.
             os.remove(ShellScriptLocation)
-        self.ShellScriptLocation = ShellScriptLocation
         f = open(ShellScriptLocation, 'w+')
         # set up the environment etc.
         if self.ShellScriptHeader is None:
@@ -349,35 +640,176 @@ class TopasOptBaseClass:
             f.write(f'\nexport TOPAS_G4_DATA_DIR={self.G4dataLocation}\n')
         else:
             f.write(self.ShellScriptHeader)
+        f.write('\nstatus=0\n')
+        return f
 
-        # add in all topas scripts which need to be run:
-        for script_name in self.ScriptsToRun:
-            file_loc = str(Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts' / script_name)
-            f.write('echo "Beginning analysis of: ' + script_name + '"')
-            f.write('\n')
-            f.write('(time TOPAS_HEADLESS_MODE=1 ' + str(self.TopasLocation) + '/bin/topas ' + script_name + ') &> ../logs/TopasLogs/' + script_name)
-            f.write('\n')
+    def _CloseShellScript(self, f, ShellScriptLocation):
+        """
+        Make a shell script written with _OpenShellScript executable and close it. The script exits with a non zero
+        code if any of its commands failed
+        """
+        f.write('exit $status\n')
         # change file permissions:
         st = os.stat(ShellScriptLocation)
         os.chmod(ShellScriptLocation, st.st_mode | stat.S_IEXEC)
         f.close()
 
-    def _RunTopasModel(self):
+    def _SubmitTopasModel(self, ShellScriptLocation=None):
         """
-        This invokes a bash subprocess to run the current model
+        Hand a model to self.Executor to run, without waiting for it to finish
+
+        :param ShellScriptLocation: the shell script to run. If None, the most recently generated script is used
+        :type ShellScriptLocation: str, optional
+        :returns: concurrent.futures.Future whose result is the exit code of the script
         """
-        print(f'{bcolors.OKBLUE}Topas: Running file: \n{self.ShellScriptLocation}')
+        if ShellScriptLocation is None:
+            ShellScriptLocation = self.ShellScriptLocation
+        if self.SimulationCache is not None and ShellScriptLocation in self._CacheKeys:
+            Itteration, CacheKey = self._CacheKeys[ShellScriptLocation]
+            ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+            if self.SimulationCache.RestoreResults(CacheKey, ResultsLocation, Itteration):
+                print(f'{bcolors.OKBLUE}Topas: using cached results for: \n{ShellScriptLocation}{bcolors.ENDC}')
+                future = Future()
+                future.set_result(0)
+                return future
+        print(f'{bcolors.OKBLUE}Topas: Running file: \n{ShellScriptLocation}')
         ShellScriptPath = str(Path(self.BaseDirectory) / self.SimulationName / 'TopasScripts')
-        cmd = subprocess.run(['bash', self.ShellScriptLocation], cwd=ShellScriptPath)
-        if cmd.returncode == 0:
+        future = self.Executor.Submit(ShellScriptLocation, ShellScriptPath)
+        if self._SplitShellScripts.get(ShellScriptLocation):
+            future = self._SubmitSplitJobs(self._SplitShellScripts[ShellScriptLocation], ShellScriptPath, future)
+        if self.EarlyTerminationSigma is not None and ShellScriptLocation in self._ScriptItterations:
+            Monitor = threading.Thread(target=self._MonitorTopasModel, daemon=True,
+                                       args=(ShellScriptLocation, self._ScriptItterations[ShellScriptLocation],
+                                             future))
+            Monitor.start()
+        return future
+
+    def _SubmitSplitJobs(self, SplitShellScripts, ShellScriptPath, future):
+        """
+        Once the rest of a model (e.g. the scripts writing the phase space files the split scripts read) has finished,
+        submit all of its split jobs to self.Executor at the same time
+
+        :param SplitShellScripts: the shell scripts which run the split jobs
+        :type SplitShellScripts: list
+        :param ShellScriptPath: directory to run the shell scripts in
+        :type ShellScriptPath: str
+        :param future: the future of the shell script which runs the rest of the model
+        :type future: concurrent.futures.Future
+        :returns: concurrent.futures.Future whose result is 0 once every job has succeeded, or else the first
+            non zero exit code
+        """
+        Combined = Future()
+        Lock = threading.Lock()
+
+        def SplitJobFinished(SplitJob, SplitJobs):
+            """
+            called as each split job finishes; finishes Combined once they all have
+            """
+            with Lock:
+                if Combined.done() or not all(Job.done() for Job in SplitJobs):
+                    return
+                try:
+                    ReturnCodes = [Job.result() for Job in SplitJobs]
+                except Exception as e:
+                    Combined.set_exception(e)
+                    return
+                Combined.set_result(next((ReturnCode for ReturnCode in ReturnCodes if ReturnCode != 0), 0))
+
+        def SubmitSplitJobs(future):
+            """
+            called when the rest of the model has finished
+            """
+            try:
+                if future.result() != 0:
+                    Combined.set_result(future.result())
+                    return
+                SplitJobs = [self.Executor.Submit(SplitShellScript, ShellScriptPath)
+                             for SplitShellScript in SplitShellScripts]
+            except Exception as e:
+                Combined.set_exception(e)
+                return
+            for SplitJob in SplitJobs:
+                SplitJob.add_done_callback(lambda SplitJob: SplitJobFinished(SplitJob, SplitJobs))
+
+        future.add_done_callback(SubmitSplitJobs)
+        return Combined
+
+    def _MonitorTopasModel(self, ShellScriptLocation, Itteration, future):
+        """
+        Runs in a background thread while a model is running: every EarlyTerminationInterval, estimate the objective
+        function from the partial results with TopasPartialObjectiveFunction, and stop the model if it clearly
+        can't beat the best objective function so far
+
+        :param ShellScriptLocation: the shell script being run
+        :type ShellScriptLocation: str
+        :param Itteration: the iteration the model belongs to
+        :type Itteration: int
+        :param future: the future returned by self.Executor.Submit
+        :type future: concurrent.futures.Future
+        """
+        ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+        while not future.done():
+            time.sleep(self.EarlyTerminationInterval)
+            if future.done() or not self.AllObjectiveFunctionValues:
+                continue
+            BestOF = np.min(self.AllObjectiveFunctionValues)
+            try:
+                PartialResult = self.TopasPartialObjectiveFunction(ResultsLocation, Itteration)
+            except Exception as e:
+                # the results files may be half written; try again next time
+                logger.debug(f'TopasPartialObjectiveFunction failed for iteration {Itteration}: {e}')
+                continue
+            if PartialResult is None:
+                continue
+            Estimate, Uncertainty = PartialResult
+            if Estimate - self.EarlyTerminationSigma * Uncertainty <= BestOF:
+                continue
+            with self._EarlyTerminationLock:
+                # the lock is held until the result is recorded, so _CheckTopasModelExitCode can't see the exit
+                # code of the stopped model first
+                if future.done() or not self.Executor.Cancel(future):
+                    return
+                self._EarlyTerminated[Itteration] = (float(Estimate), float(Uncertainty))
+                self._EarlyTerminatedScripts.add(ShellScriptLocation)
+            logger.info(f'stopped iteration {Itteration} early: objective function estimate {Estimate:1.3g} '
+                        f'+/- {Uncertainty:1.3g} is worse than the best so far ({BestOF:1.3g})')
+            return
+
+    def _CheckTopasModelExitCode(self, ShellScriptLocation, ReturnCode):
+        """
+        Report on a finished model, and quit if it failed. Models which were stopped early are not failures
+
+        :param ShellScriptLocation: the shell script which was run
+        :type ShellScriptLocation: str
+        :param ReturnCode: exit code of the shell script
+        :type ReturnCode: int
+        """
+        with self._EarlyTerminationLock:
+            if ShellScriptLocation in self._EarlyTerminatedScripts:
+                self._EarlyTerminatedScripts.discard(ShellScriptLocation)
+                print(f'{bcolors.OKBLUE}Stopped early{bcolors.ENDC}')
+                return
+        if ReturnCode == 0:
             print(f'{bcolors.OKBLUE}Analysis complete{bcolors.ENDC}')
         else:
-            logger.error(f'RunIteration.sh failed with exit code {cmd.returncode}.'
+            logger.error(f'{os.path.split(ShellScriptLocation)[1]} failed with exit code {ReturnCode}.'
                          f'\nSuggestion: look at {Path(self.OptimisationDirectory) / self.SimulationName / "Logs" / "TopasLogs"} '
                          f'\nto figure out what went wrong...'
                          f' Quitting')
             sys.exit(1)
 
+    def _RunTopasModel(self, ShellScriptLocation=None):
+        """
+        This runs the current model using self.Executor, and waits for it to finish
+
+        :param ShellScriptLocation: the shell script to run. If None, the most recently generated script is used
+        :type ShellScriptLocation: str, optional
+        """
+        if ShellScriptLocation is None:
+            ShellScriptLocation = self.ShellScriptLocation
+        future = self._SubmitTopasModel(ShellScriptLocation)
+        self._CheckTopasModelExitCode(ShellScriptLocation, future.result())
+
     def _UpdateOptimisationLogs(self, x, OF):
         """
         Just a simple function to keep track of the objective function in the logs folder
@@ -387,37 +819,72 @@ class TopasOptBaseClass:
         :param OF: the current objective function value
         """
 
-        with open(self._LogFileLoc , 'a') as f:
-            Entry = f'Itteration: {self.Itteration}'
-            for i, Parameter in enumerate(self.ParameterNames):
-                try:
-                    Entry = Entry + f', {Parameter}: {x[0][i]: 1.2f}'
-                except IndexError:
-                    Entry = Entry + f', {Parameter}: {x[i]: 1.2f}'
-
+        Entry = {'Itteration': self.Itteration}
+        for i, Parameter in enumerate(self.ParameterNames):
             try:
-                Entry = Entry + f', target_prediction_mean: {self._target_prediction_mean[-1]: 1.2f}'
-                Entry = Entry + f', target_prediction_std: {self._target_prediction_std[-1]: 1.2f}'
-            except AttributeError:
-                # these parameters are only available for bayes optimisation
-                pass
+                Entry[Parameter] = float(x[0][i])
             except IndexError:
-                # for the first entry
-                Entry = Entry + f', _target_prediction_mean: NaN'
-                Entry = Entry + f', _target_prediction_std: NaN'
+                Entry[Parameter] = float(x[i])
 
-            Entry = Entry + f', ObjectiveFunction: {OF: 1.2f}\n'
-            f.write(Entry)
+        try:
+            Entry['target_prediction_mean'] = float(self._target_prediction_mean[-1])
+            Entry['target_prediction_std'] = float(self._target_prediction_std[-1])
+        except AttributeError:
+            # these parameters are only available for bayes optimisation
+            pass
+        except IndexError:
+            # for the first entry
+            Entry['_target_prediction_mean'] = np.nan
+            Entry['_target_prediction_std'] = np.nan
+        Entry.update(self._ExtraLogEntries())
+
+        Entry['ObjectiveFunction'] = float(OF)
+        AppendToBinaryLog(self._LogFileLoc, Entry)
+        Entry = FormatLogEntry(Entry)
+        if self.TextLog:
+            with open(self._LogFileLoc, 'a') as f:
+                f.write(Entry)
         print(f'{bcolors.OKGREEN}{Entry}{bcolors.ENDC}')
 
+    def _ExtraLogEntries(self):
+        """
+        Anything an optimiser logs for each iteration as well as the parameters and objective function. Optimisers
+        which log more (e.g. the fidelity of each iteration) override this
+
+        :returns: dictionary of the extra values for iteration self.Itteration
+        """
+        return {}
+
+    def _GetBestCandidates(self, ResultsDict):
+        """
+        The objective functions to choose the best iteration from at the end of the optimisation. Optimisers whose
+        results aren't all comparable (e.g. results at different fidelities) override this
+
+        :param ResultsDict: the log, as returned by ReadInLogFile
+        :type ResultsDict: dict
+        :returns: array of objective functions, with np.inf for iterations which can't be the best
+        """
+        return np.array(ResultsDict['ObjectiveFunction'])
+
+    def _ObjectiveFunctionToTarget(self, OF):
+        """
+        Convert an objective function value to what BlackBoxFunction returns. Optimisers which seek a maximum
+        override this
+
+        :param OF: the objective function value
+        :returns: the value the optimiser works with
+        """
+        return OF
+
     def _write_final_log_entry(self):
         """
         This method can optionally be called when an optimiser has finished running.
         It reads in the logs, then prints a message at the end summarising the best found solution.
         """
-        ResultsDict = ReadInLogFile(self._LogFileLoc)
+        ResultsDict = ReadInLogFile(Path(self._LogFileLoc).with_suffix('.bin'))
 
-        best_iteration = np.argmin(ResultsDict['ObjectiveFunction'])
+        ObjectiveFunction = self._GetBestCandidates(ResultsDict)
+        best_iteration = np.argmin(ObjectiveFunction)
         best_OF = ResultsDict['ObjectiveFunction'][best_iteration]
         ResultsDict.pop('ObjectiveFunction')
         ResultsDict.pop('Itteration')
@@ -426,6 +893,8 @@ class TopasOptBaseClass:
             ResultsDict.pop('_target_prediction_std')
         except KeyError:
             pass
+        if not self.TextLog:
+            ExportLogToText(self._LogFileLoc)
         # what's left is the results (hopefully no one starts updating the log format!)
         ParameterValues = list(ResultsDict.values())
         best_params = np.array([param_list[best_iteration] for param_list in ParameterValues])
@@ -443,14 +912,54 @@ class TopasOptBaseClass:
             f.write(Entry)
         print(f'{bcolors.OKGREEN}{Entry}{bcolors.ENDC}')
 
-    def _Plot_Convergence(self):
+    def _ReadLog(self):
         """
-        just generates the current convergence plot from the log file using the function in utilities
+        Read the log for this optimisation. Only the iterations added since the last call are read from disk
+
+        :returns: ResultsDict: dictionary of numpy arrays, one for each logged quantity
+        """
+        if self._LogReader is None:
+            self._LogReader = LogReader(self._LogFileLoc)
+        return self._LogReader.Read()
+
+    def _PlotIsDue(self, PlotName, force=False):
         """
+        Decide whether a diagnostic plot should be updated, based on PlotEveryNIterations and PlotEverySeconds
 
+        :param PlotName: identifies the plot
+        :type PlotName: str
+        :param force: if True, the plot is always updated
+        :type force: bool, optional
+        :returns: True if the plot should be updated now
+        """
+        if PlotName in self._LastPlotted and not force:
+            LastItteration, LastTime = self._LastPlotted[PlotName]
+            if (self.Itteration - LastItteration) < self.PlotEveryNIterations:
+                return False
+            if (time.time() - LastTime) < self.PlotEverySeconds:
+                return False
+        self._LastPlotted[PlotName] = (self.Itteration, time.time())
+        return True
+
+    def _FinishPlotting(self):
+        """
+        Update all diagnostic plots at the end of an optimisation, then let the renderer finish in the background
+        """
+        self._Plot_Convergence(force=True)
+        self._Renderer.Close()
+
+    def _Plot_Convergence(self, force=False):
+        """
+        just generates the current convergence plot from the log file using the function in utilities
+
+        :param force: if True, the plot is updated even if PlotEveryNIterations / PlotEverySeconds say it isn't due
+        :type force: bool, optional
+        """
+        if not self._PlotIsDue('ConvergencePlot', force):
+            return
         SaveLoc = Path(self.BaseDirectory) / self.SimulationName
         SaveLoc = SaveLoc / 'logs' / 'ConvergencePlot.png'
-        PlotLogFile(self._LogFileLoc, SaveLoc)
+        self._Renderer.Submit('ConvergencePlot', PlotConvergence, self._ReadLog(), SaveLoc)
 
     def _CopySelf(self):
         """
@@ -481,14 +990,22 @@ class TopasOptBaseClass:
             x.append(x_new[self.ParameterNames[i]])
         self.x = np.array(x, ndmin=2)
 
-    def _empty_results_folder(self):
+    def _empty_results_folder(self, Itteration=None):
         """
         if KeepAllResults is false, this function is called which removes all existing files
         in the results folder. It is called just before new scripts are run such that the latest results
         will be kept
+
+        :param Itteration: if supplied, only the results belonging to this iteration are removed. This is used when
+            other iterations may still be running.
+        :type Itteration: int, optional
         """
         ResultsLocation = str(Path(self.BaseDirectory) / self.SimulationName / 'Results')
-        for filename in os.listdir(ResultsLocation):
+        if Itteration is None:
+            FilesToDelete = os.listdir(ResultsLocation)
+        else:
+            FilesToDelete = self._get_iteration_results_files(Itteration)
+        for filename in FilesToDelete:
             file_path = os.path.join(ResultsLocation, filename)
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -498,32 +1015,74 @@ class TopasOptBaseClass:
             except Exception as e:
                 logger.warning(f'Failed to delete {file_path} from results folder. Reason: {e}. continuing...')
 
-    # public methods
+    def _get_iteration_results_files(self, Itteration):
+        """
+        Find the files in the results folder which were written by a given iteration. These are identified by the
+        _itt_N suffix that TopasScriptGenerator adds to every output file name.
 
-    @abstractmethod
-    def RunOptimisation(self):
+        :param Itteration: the iteration number
+        :type Itteration: int
+        :returns: list of file names (not full paths)
         """
-        each inheriting optimizer must supply its own RunOptimisation method
+        ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+        IterationTag = re.compile(f'_itt_{Itteration}(\\.|$)')
+        return sorted(filename for filename in os.listdir(ResultsLocation) if IterationTag.search(filename))
+
+    def _PrepareIteration(self, x_new, ShellScriptName='RunIteration.sh'):
         """
-        pass
-    
-    def BlackBoxFunction(self, x_new):
+        Take a new set of parameters from the optimiser and write the topas model for iteration self.Itteration.
+        Nothing is run; see _RunTopasModel.
+
+        :param x_new: the parameters to simulate, in whatever format the optimiser supplies them
+        :param ShellScriptName: name of the shell script which will run this iteration
+        :type ShellScriptName: str, optional
         """
-        Called Black Box function in the spirit of bayesian optimisation, this function simply takes the most recent
-        parameter guesses, and solves the model.
+        self._ConvertDictToVariables(x_new)
+        self._CreateVariableDictionary(self.x)
+        self._GenerateTopasModel(self.x, ShellScriptName)
+
+    def _EvaluateIteration(self):
         """
+        Calculate the objective function for the results of iteration self.Itteration (at parameters self.x)
+        and update the logs and convergence plot. self.Itteration is not incremented here.
 
+        :returns: the objective function value, with the sign flipped for optimisers which seek a maximum
+        """
+        ResultsLocation = Path(self.BaseDirectory) / self.SimulationName / 'Results'
+        CacheKey = None
+        for ShellScriptLocation, (Itteration, Key) in list(self._CacheKeys.items()):
+            if Itteration == self.Itteration:
+                CacheKey = Key
+                del self._CacheKeys[ShellScriptLocation]  # this iteration won't be submitted again
+        with self._EarlyTerminationLock:
+            EarlyTerminatedOF = self._EarlyTerminated.pop(self.Itteration, None)
+        if EarlyTerminatedOF is not None:
+            # the results are incomplete, so use the estimate and don't cache anything
+            self._StageCacheKeys.pop(self.Itteration, None)
+            EarlyTerminatedOF, self.OFUncertainty = EarlyTerminatedOF
+            return self._RecordObjectiveFunction(EarlyTerminatedOF)
+        self._MergeSplitResults()
+        if CacheKey is not None:
+            ObjectiveFunctionHash = self.SimulationCache.HashFile(
+                Path(self.OptimisationDirectory) / 'TopasObjectiveFunction.py')
+        if self.SimulationCache is not None:
+            self._StoreCachedStages()
+        self.OF = None
+        if CacheKey is not None:
+            self.OF = self.SimulationCache.GetObjectiveFunction(CacheKey, ObjectiveFunctionHash)
+        if self.OF is None:
+            self.OF = self.TopasObjectiveFunction(ResultsLocation, self.Itteration)
+            if CacheKey is not None:
+                ResultsFiles = [ResultsLocation / file for file in self._get_iteration_results_files(self.Itteration)]
+                self.SimulationCache.StoreResults(CacheKey, ResultsFiles, self.Itteration, self.OF,
+                                                  ObjectiveFunctionHash)
+        self.OFUncertainty = None
+        if np.ndim(self.OF) > 0:
+            # the objective function also returned its uncertainty, e.g. from the topas statistics
+            self.OF, self.OFUncertainty = self.OF
         if self._testing_mode:
             # this is a special section only intended for development, unit testing, etc.
             # if you are here, it means 'testing_mode' is within your TopasLocation
-            self._ConvertDictToVariables(x_new)
-            self._CreateVariableDictionary(self.x)
-            self._GenerateTopasModel(self.x)
-            if not self.KeepAllResults:
-                self._empty_results_folder()
-            self._RunTopasModel()
-            self.OF = self.TopasObjectiveFunction(Path(self.BaseDirectory) / self.SimulationName / 'Results',
-                                                  self.Itteration)
             # this is the part where we would normally read in the results and assess the objective function, but
             # since we use TopasEmulator, there are no results. therefore we need to 'insert' them.
             if self.x.shape[0] == 2:
@@ -531,46 +1090,282 @@ class TopasOptBaseClass:
             elif self.x.shape[0] == 1:
                 x = self.x[0]
             self.OF = np.min([rosen(x), 10])  # rosenbrock function can get huge, so just cap it at 100.
-            self.AllObjectiveFunctionValues.append(self.OF)
-            self._UpdateOptimisationLogs(self.x, self.OF)
-            self._Plot_Convergence()
-            self.Itteration = self.Itteration + 1
-        else:
-            # this is the normal optimisation
-            self._ConvertDictToVariables(x_new)
-            self._CreateVariableDictionary(self.x)
-            self._GenerateTopasModel(self.x)
-            if not self.KeepAllResults:
-                self._empty_results_folder()
-            self._RunTopasModel()
-            self.OF = self.TopasObjectiveFunction(Path(self.BaseDirectory) / self.SimulationName / 'Results', self.Itteration)
-            self.AllObjectiveFunctionValues.append(self.OF)
-            self._UpdateOptimisationLogs(self.x, self.OF)
-            self._Plot_Convergence()
+        return self._RecordObjectiveFunction(self.OF)
+
+    def _RecordObjectiveFunction(self, OF):
+        """
+        Log the objective function of iteration self.Itteration and update the convergence plot
+
+        :returns: the objective function value, with the sign flipped for optimisers which seek a maximum
+        """
+        self.OF = OF
+        self.AllObjectiveFunctionValues.append(self.OF)
+        self._Observations.append((self.Itteration, np.ravel(self.x).astype(float), self.OF, self.OFUncertainty))
+        self._UpdateOptimisationLogs(self.x, self.OF)
+        self._Plot_Convergence()
+        self._CheckpointAfterEvaluation()
+        return self._ObjectiveFunctionToTarget(self.OF)
+
+    def _CheckpointAfterEvaluation(self):
+        """
+        Called every time an iteration has been evaluated and logged. Writes the checkpoint; optimisers which update
+        their state after this (e.g. BayesianOptimiser registering the result) override this and write the
+        checkpoint themselves
+        """
+        self._WriteCheckpoint()
+
+    def _GetCheckpointState(self):
+        """
+        The state needed to continue this optimisation. Optimisers with more state than the results so far extend
+        this (and _SetCheckpointState)
+
+        :returns: dict of the state
+        """
+        # asynchronous results arrive out of order, so iterations below the next one may still be in flight
+        Submitted = [Observation[0] for Observation in self._Observations] + list(self._InFlight)
+        return {'Class': type(self).__name__,
+                'Itteration': max(Submitted, default=-1) + 1,
+                'InFlight': dict(self._InFlight),
+                'SuggestionsProbed': self.SuggestionsProbed,
+                'AllObjectiveFunctionValues': list(self.AllObjectiveFunctionValues),
+                'Observations': list(self._Observations)}
+
+    def _SetCheckpointState(self, State):
+        """
+        Restore the state returned by _GetCheckpointState
+
+        :param State: the state read from the checkpoint
+        :type State: dict
+        """
+        self.Itteration = State['Itteration']
+        self.ItterationStart = self.Itteration
+        self.SuggestionsProbed = State['SuggestionsProbed']
+        self.AllObjectiveFunctionValues = list(State['AllObjectiveFunctionValues'])
+        self._Observations = list(State['Observations'])
+        self._InFlight = dict(State.get('InFlight', {}))
+
+    def _WriteCheckpoint(self):
+        """
+        Write the state of the optimisation to self.CheckpointLocation. The checkpoint is written to a temporary file
+        which then replaces the old one, so a crash can never leave a half written checkpoint
+        """
+        TemporaryLocation = str(self.CheckpointLocation) + '.tmp'
+        with open(TemporaryLocation, 'wb') as f:
+            pickle.dump(self._GetCheckpointState(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(TemporaryLocation, self.CheckpointLocation)
+
+    def _ReadCheckpoint(self):
+        """
+        :returns: the state stored in self.CheckpointLocation, or None if there is no checkpoint
+        """
+        if not os.path.isfile(self.CheckpointLocation):
+            return None
+        with open(self.CheckpointLocation, 'rb') as f:
+            return pickle.load(f)
+
+    def _StartReplay(self):
+        """
+        For optimisers whose state can't be restored directly (e.g. those driven by scipy), restart the optimisation
+        from the beginning and replay the logged results rather than simulating them again. The replay finishes once
+        every result has been replayed, or as soon as the optimiser asks for a point other than the one logged
+        """
+        self._ResumeItteration = self.Itteration
+        self._ReplayQueue = list(self._Observations)
+        if self._ReplayQueue:
+            self.Itteration = self._ReplayQueue[0][0]
+
+    def _ReplayIteration(self, x_new):
+        """
+        While replaying (see _StartReplay), return the logged result for x_new instead of simulating it
+
+        :param x_new: the parameters the optimiser wants to simulate
+        :returns: the objective function value as _EvaluateIteration would return it, or None if x_new has to be
+            simulated
+        """
+        if not self._ReplayQueue:
+            return None
+        Itteration, x, OF, OFUncertainty = self._ReplayQueue[0]
+        self._ConvertDictToVariables(x_new)
+        if not (Itteration == self.Itteration and np.allclose(np.ravel(self.x), x, rtol=1e-12, atol=1e-12)):
+            logger.warning(f'the optimiser did not request the same point for iteration {Itteration} as it did '
+                           f'before the restart, so the optimisation continues from here without replaying the '
+                           f'rest of the log')
+            self._ReplayQueue = []
+            self.Itteration = self._ResumeItteration
+            return None
+        self._ReplayQueue.pop(0)
+        self.OF, self.OFUncertainty = OF, OFUncertainty
+        self.Itteration = self.Itteration + 1
+        return self._ObjectiveFunctionToTarget(OF)
+
+    def _RemoveFinalLogEntry(self):
+        """
+        delete the end of run info from the text log file, so that it can be continued
+        """
+        if os.path.isfile(self._LogFileLoc):
+            with open(self._LogFileLoc, "r") as f:
+                lines = f.readlines()
+            with open(self._LogFileLoc, "w") as f:
+                for line in lines:
+                    if line[0:10] == 'Itteration':
+                        f.write(line)
+
+    def _RunIterationsConcurrently(self, x_new_list):
+        """
+        Generate the models for several parameter sets and run them all at the same time. Iterations
+        self.Itteration, self.Itteration+1... are assigned in the order of x_new_list, and each gets its own
+        RunIteration_itt_N.sh. Objective functions are not calculated here; once this returns, set self.x and
+        self.Itteration to each entry in turn and call _EvaluateIteration.
+
+        :param x_new_list: the parameter sets to simulate
+        :type x_new_list: list
+        :returns: ParameterSets: list of the converted parameter arrays, in the same order as x_new_list
+        """
+        StartItteration = self.Itteration
+        if not self.KeepAllResults:
+            self._empty_results_folder()
+
+        ShellScripts = []
+        ParameterSets = []
+        for x_new in x_new_list:
+            self._PrepareIteration(x_new, ShellScriptName=f'RunIteration_itt_{self.Itteration}.sh')
+            ShellScripts.append(self.ShellScriptLocation)
+            ParameterSets.append(self.x)
             self.Itteration = self.Itteration + 1
+        self.Itteration = StartItteration
 
-        if 'BayesianOptimiser' in str(self.__class__):
-            # bit of a hack since bayesian optimise will seek maximum
-            return -self.OF
-        else:
-            return self.OF
+        futures = [self._SubmitTopasModel(ShellScriptLocation) for ShellScriptLocation in ShellScripts]
+        for ShellScriptLocation, future in zip(ShellScripts, futures):
+            self._CheckTopasModelExitCode(ShellScriptLocation, future.result())
+
+        return ParameterSets
+
+    def _RunIterationsAsynchronously(self, SuggestPoint, OnResult, NumberOfWorkers):
+        """
+        Keep NumberOfWorkers simulations running at all times until MaxItterations have been submitted.
+        Whenever any simulation finishes, its result is handed to OnResult and a new point is requested from
+        SuggestPoint, so a slow simulation never holds up the others.
+
+        Iteration numbers are assigned when a point is submitted, so they match the _itt_N names of the results
+        files. Because results are logged as they arrive, the iterations in the log file may be out of order.
+        Iterations which were still running when the checkpoint was written (self._InFlight) are submitted again
+        first, with the same points.
+
+        :param SuggestPoint: function taking no arguments which returns the next x_new to probe. When it is called,
+            self.Itteration is the iteration the point will be run as. Points which are still running should be
+            treated as pending by the optimiser.
+        :type SuggestPoint: callable
+        :param OnResult: function called with x_new once that simulation has finished, with self.x and
+            self.Itteration already set for that iteration. It must call self._EvaluateIteration. If it returns
+            False, no further points are submitted (the ones already running are still completed).
+        :type OnResult: callable
+        :param NumberOfWorkers: number of simulations to keep in flight
+        :type NumberOfWorkers: int
+        """
+        NextItteration = self.Itteration
+        LastEvaluatedItteration = None
+        KeepGoing = True
+        Pending = {}  # future: (iteration, x_new, x, shell script)
+        for Itteration in sorted(self._InFlight):
+            self.Itteration = Itteration
+            x_new = self._InFlight[Itteration]
+            self._PrepareIteration(x_new, ShellScriptName=f'RunIteration_itt_{Itteration}.sh')
+            future = self._SubmitTopasModel(self.ShellScriptLocation)
+            Pending[future] = (Itteration, x_new, self.x, self.ShellScriptLocation)
+        while Pending or (KeepGoing and NextItteration < self.MaxItterations):
+            while KeepGoing and len(Pending) < NumberOfWorkers and NextItteration < self.MaxItterations:
+                self.Itteration = NextItteration
+                x_new = SuggestPoint()
+                self._InFlight[NextItteration] = x_new
+                self._PrepareIteration(x_new, ShellScriptName=f'RunIteration_itt_{NextItteration}.sh')
+                future = self._SubmitTopasModel(self.ShellScriptLocation)
+                Pending[future] = (NextItteration, x_new, self.x, self.ShellScriptLocation)
+                NextItteration = NextItteration + 1
+
+            done, not_done = wait(Pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.Itteration, x_new, self.x, ShellScriptLocation = Pending.pop(future)
+                self._CheckTopasModelExitCode(ShellScriptLocation, future.result())
+                del self._InFlight[self.Itteration]
+                if (not self.KeepAllResults) and (LastEvaluatedItteration is not None):
+                    # other simulations may still be writing, so only remove the previous result
+                    self._empty_results_folder(LastEvaluatedItteration)
+                KeepGoing = (OnResult(x_new) is not False) and KeepGoing
+                LastEvaluatedItteration = self.Itteration
+
+        self.Itteration = NextItteration
+
+    # public methods
+
+    @abstractmethod
+    def RunOptimisation(self):
+        """
+        each inheriting optimizer must supply its own RunOptimisation method
+        """
+        pass
+    
+    def BlackBoxFunction(self, x_new):
+        """
+        Called Black Box function in the spirit of bayesian optimisation, this function simply takes the most recent
+        parameter guesses, and solves the model.
+        """
+        target = self._ReplayIteration(x_new)
+        if target is not None:
+            return target
+
+        self._PrepareIteration(x_new)
+        if not self.KeepAllResults:
+            self._empty_results_folder()
+        self._RunTopasModel()
+        target = self._EvaluateIteration()
+        self.Itteration = self.Itteration + 1
+        return target
+
+    def RestartOptimisation(self):
+        """
+        Sometimes for whatever reason an optimisation is stopped prematurely.
+        This function allows you to continue the optimisation from the checkpoint (logs/Checkpoint.pkl) which is
+        written after every iteration. You just have to change Optimiser.RunOptimisation() to
+        Optimiser.RestartOptimisation() in your optimisation script; the code will do the rest automatically.
+        Nothing which has already been simulated is simulated again, and the existing logs and results are kept.
+        Nitterations can be increased to continue an optimisation which finished.
+        """
+        State = self._ReadCheckpoint()
+        if State is None:
+            logger.error(f'cannot restart; there is no checkpoint at {self.CheckpointLocation}. Quitting')
+            sys.exit(1)
+        if not State['Class'] == type(self).__name__:
+            logger.error(f'cannot restart; the checkpoint at {self.CheckpointLocation} was written by '
+                         f'{State["Class"]}, not {type(self).__name__}. Quitting')
+            sys.exit(1)
+        self._SetCheckpointState(State)
+        if State['Itteration'] >= self.MaxItterations and not self._InFlight:
+            logger.error(f'nothing to restart; max iterations is {self.MaxItterations} and have already been completed')
+            sys.exit(1)
+        self._Restarting = True
+        self._RemoveFinalLogEntry()
+        self.RunOptimisation()
 
     def SetUpDirectoryStructure(self):
         """
         Method to set up directory structure. This will attempt to empty the directory if it already exists.
         If Overwrite=False, it will ask first, otherwise just do it.
         Also writes the readme text if that exists, and copies all attributes of self to a json file.
+        When restarting (see RestartOptimisation) the existing directory is kept as it is.
         """
+        if self._Restarting:
+            if self._testing_mode:
+                self._setup_topas_emulator()
+            return
 
         FullSimName = Path(self.BaseDirectory) / self.SimulationName
         if not os.path.isdir(FullSimName):
             os.mkdir(FullSimName)
         self._EmptySimulationFolder()
+        self._LogReader = None  # any existing reader was following the log which has just been deleted
         self._CopySelf()
         os.mkdir(Path(FullSimName) / 'logs')
         os.mkdir(Path(FullSimName) / 'logs' / 'TopasLogs')
-        if 'BayesianOptimiser' in str(self.__class__):
-            os.mkdir(Path(FullSimName) / 'logs' / 'SingleParameterPlots')
         os.mkdir(Path(FullSimName) / 'TopasScripts')
         os.mkdir(Path(FullSimName) / 'Results')
 
@@ -582,22 +1377,46 @@ class TopasOptBaseClass:
             self._setup_topas_emulator()
 
 
+class _MaxItterationsReached(Exception):
+    """
+    Raised by NelderMeadOptimiser when a new simulation is needed but MaxItterations have already been run
+    """
+    pass
+
+
 class NelderMeadOptimiser(TopasOptBaseClass):
     """
-    Implementation of Nelder-Mead based on scipy. Other options are defined in TopasOptBaseClass
+    Implementation of Nelder-Mead, following the algorithm (and default settings) of scipy.optimize.minimize but
+    running one step at a time. The simplex and the objective function at each vertex are checkpointed after every
+    step, so RestartOptimisation continues from the last step. Every simulated point is remembered, so a point
+    which has already been simulated (e.g. a vertex of a shrunk simplex which was clipped back onto the bounds, or
+    the points of the step which was interrupted) is never simulated again, and does not count towards Nitterations.
+    Other options are defined in TopasOptBaseClass
 
     :param NM_StartingSimplex: This is a Nelder-Mead specific parameter which controls the size of the
         starting simplex. A value of .1 will create a starting simplex that is spans 10% of the starting values,
         which is the default behavior. Alternatively one can specify the starting simplex, e.g. for a 2D function
         starting_sim = [[0.9, 0.9], [0.72, 0.9], [0.9, 0.72]]
     :type NM_StartingSimplex: None or float or array-like, optional
+    :param NM_Speculative: if True, the reflection, expansion and both contractions of each step are simulated at
+        the same time (see Executor), and the step then takes whichever it needs. This follows exactly the same path
+        as the normal algorithm and each step takes the time of one simulation instead of up to three, but up to
+        three of the four simulations are wasted, so Nitterations is used up faster. The vertices of the starting
+        simplex and of each shrink step are also simulated at the same time.
+    :type NM_Speculative: bool, optional
     """
 
-    def __init__(self, NM_StartingSimplex=None, **kwds):
+    def __init__(self, NM_StartingSimplex=None, NM_Speculative=False, **kwds):
         """
         init function for NelderMeadOptimiser
         """
         self.NM_StartingSimplex = NM_StartingSimplex
+        self.NM_Speculative = NM_Speculative
+        self.StartingSimplexSupplied = False
+        self._Simplex = None  # vertices of the current simplex, best first
+        self._SimplexValues = None  # objective function at each vertex
+        self._NelderMeadSteps = 0
+        self._VertexCache = {}  # objective function of every simulated point; see _EvaluateVertex
         super().__init__(**kwds)
         if self.NM_StartingSimplex:  # nb None evaluates as False
             self.StartingSimplexSupplied = True
@@ -642,24 +1461,186 @@ class NelderMeadOptimiser(TopasOptBaseClass):
 
         self.StartingSimplex = sim
 
-    def RunOptimisation(self):
+    def _GetCheckpointState(self):
         """
-        Use the scipy.optimize.minimize module to perform the optimisation.
-        Note that most of the 'action' is happening in BlackBoxFunction, which is repeated called by the optimiser
+        As for the other optimisers, plus the current simplex
         """
+        State = super()._GetCheckpointState()
+        State.update({'Simplex': self._Simplex, 'SimplexValues': self._SimplexValues,
+                      'NelderMeadSteps': self._NelderMeadSteps})
+        return State
 
-        self.SetUpDirectoryStructure()
+    def _SetCheckpointState(self, State):
+        """
+        Restore the simplex, and remember every point which has already been simulated
+        """
+        super()._SetCheckpointState(State)
+        self._Simplex = State['Simplex']
+        self._SimplexValues = State['SimplexValues']
+        self._NelderMeadSteps = State['NelderMeadSteps']
+        self._VertexCache = {np.asarray(x, dtype=float).tobytes(): OF for Itteration, x, OF, OFUncertainty
+                             in self._Observations}
+
+    def _EvaluateVertex(self, x):
+        """
+        The objective function at x. Points which have already been simulated are looked up rather than simulated
+        again
+
+        :param x: the parameters
+        :type x: np.ndarray
+        :returns: the objective function
+        """
+        return self._EvaluateVertices([x])[0]
+
+    def _EvaluateVertices(self, Points, Speculative=False):
+        """
+        The objective function at each of Points. Points which have already been simulated are looked up; with
+        NM_Speculative the rest are simulated at the same time if MaxItterations leaves room for all of them,
+        otherwise they are simulated one at a time until MaxItterations is reached
+
+        :param Points: the parameters of each point
+        :type Points: list
+        :param Speculative: True if only some of Points may be needed, so they are only worth simulating if all of
+            them can be. If there isn't room for them all, nothing is simulated
+        :type Speculative: bool, optional
+        :returns: list of the objective functions
+        """
+        Keys = [np.asarray(x, dtype=float).tobytes() for x in Points]
+        NewPoints = {}  # key: point, for points which have not been simulated yet
+        for Key, x in zip(Keys, Points):
+            if Key not in self._VertexCache:
+                NewPoints.setdefault(Key, np.array(x, dtype=float))
+        WithinBudget = self.Itteration + len(NewPoints) <= self.MaxItterations
+        if Speculative and not WithinBudget:
+            raise _MaxItterationsReached
+        if not self.NM_Speculative or len(NewPoints) == 1 or not WithinBudget:
+            for Key, x in NewPoints.items():
+                if self.Itteration >= self.MaxItterations:
+                    raise _MaxItterationsReached
+                self._VertexCache[Key] = self.BlackBoxFunction(x)
+        elif NewPoints:
+            ParameterSets = self._RunIterationsConcurrently(list(NewPoints.values()))
+            for Key, x in zip(NewPoints, ParameterSets):
+                self.x = x
+                self._VertexCache[Key] = self._EvaluateIteration()
+                self.Itteration = self.Itteration + 1
+        return [self._VertexCache[Key] for Key in Keys]
+
+    def _InitialiseSimplex(self):
+        """
+        Build the starting simplex in the same way as scipy, and evaluate it
+        """
         if self.StartingSimplexSupplied:
-            StartingSimplex = self.StartingSimplex
+            Simplex = np.array(self.StartingSimplex, dtype=float)
         else:
-            StartingSimplex = None
+            # the scipy default simplex:
+            x0 = np.clip(self.StartingValues, self.LowerBounds, self.UpperBounds)
+            Simplex = np.tile(x0, (len(x0) + 1, 1))
+            for k in range(len(x0)):
+                Simplex[k + 1, k] = 1.05 * x0[k] if x0[k] != 0 else 0.00025
+        # reflect any vertices outside the upper bounds back into the interior, then clip to the bounds:
+        Simplex = np.where(Simplex > self.UpperBounds, 2 * self.UpperBounds - Simplex, Simplex)
+        Simplex = np.clip(Simplex, self.LowerBounds, self.UpperBounds)
+        SimplexValues = np.array(self._EvaluateVertices(Simplex))
+        Order = np.argsort(SimplexValues)
+        self._Simplex = Simplex[Order]
+        self._SimplexValues = SimplexValues[Order]
+
+    def _NelderMeadStep(self):
+        """
+        Perform one Nelder-Mead step (reflection, expansion, contraction or shrink) and checkpoint the new simplex.
+        The step is only applied once all of its points have been evaluated, so the checkpointed simplex is always
+        the result of a whole step
 
-        bnds = tuple(zip(self.LowerBounds, self.UpperBounds))
+        :returns: False if the simplex has converged, True otherwise
+        """
+        rho, chi, psi, sigma = 1, 2, 0.5, 0.5  # reflection, expansion, contraction, shrink
+        Simplex = self._Simplex.copy()
+        SimplexValues = self._SimplexValues.copy()
+        # converged, using the default xatol and fatol of scipy:
+        if (np.max(np.abs(Simplex[1:] - Simplex[0])) <= 1e-4 and
+                np.max(np.abs(SimplexValues[0] - SimplexValues[1:])) <= 1e-4):
+            return False
+
+        xbar = np.mean(Simplex[:-1], axis=0)
+        xr = np.clip((1 + rho) * xbar - rho * Simplex[-1], self.LowerBounds, self.UpperBounds)
+        xe = np.clip((1 + rho * chi) * xbar - rho * chi * Simplex[-1], self.LowerBounds, self.UpperBounds)
+        xc = np.clip((1 + psi * rho) * xbar - psi * rho * Simplex[-1], self.LowerBounds, self.UpperBounds)
+        xcc = np.clip((1 - psi) * xbar + psi * Simplex[-1], self.LowerBounds, self.UpperBounds)
+        if self.NM_Speculative:
+            try:
+                # the step below then finds all of these in the cache
+                self._EvaluateVertices([xr, xe, xc, xcc], Speculative=True)
+            except _MaxItterationsReached:
+                pass  # use the remaining iterations one at a time
+        fxr = self._EvaluateVertex(xr)
+        if fxr < SimplexValues[0]:
+            fxe = self._EvaluateVertex(xe)
+            if fxe < fxr:
+                Simplex[-1], SimplexValues[-1] = xe, fxe
+            else:
+                Simplex[-1], SimplexValues[-1] = xr, fxr
+        elif fxr < SimplexValues[-2]:
+            Simplex[-1], SimplexValues[-1] = xr, fxr
+        else:
+            Shrink = False
+            if fxr < SimplexValues[-1]:
+                # outside contraction
+                fxc = self._EvaluateVertex(xc)
+                if fxc <= fxr:
+                    Simplex[-1], SimplexValues[-1] = xc, fxc
+                else:
+                    Shrink = True
+            else:
+                # inside contraction
+                fxcc = self._EvaluateVertex(xcc)
+                if fxcc < SimplexValues[-1]:
+                    Simplex[-1], SimplexValues[-1] = xcc, fxcc
+                else:
+                    Shrink = True
+            if Shrink:
+                Simplex[1:] = np.clip(Simplex[0] + sigma * (Simplex[1:] - Simplex[0]), self.LowerBounds,
+                                      self.UpperBounds)
+                SimplexValues[1:] = self._EvaluateVertices(Simplex[1:])
+
+        Order = np.argsort(SimplexValues)
+        self._Simplex = Simplex[Order]
+        self._SimplexValues = SimplexValues[Order]
+        self._NelderMeadSteps = self._NelderMeadSteps + 1
+        self._WriteCheckpoint()
+        return True
+
+    def RunOptimisation(self):
+        """
+        Run Nelder-Mead steps until the simplex converges or MaxItterations simulations have been run.
+        Note that most of the 'action' is happening in BlackBoxFunction, which is called for every new point.
+        The final simplex is stored in self.NelderMeadRes, in the same format as scipy.optimize.minimize
+        """
 
-        self.NelderMeadRes = minimize(self.BlackBoxFunction, self.StartingValues, method='Nelder-Mead', bounds=bnds,
-                       options={'disp': True, 'initial_simplex': StartingSimplex,
-                                'maxiter': self.MaxItterations, 'maxfev': self.MaxItterations})
+        self.SetUpDirectoryStructure()
+        self._Renderer.Start()  # before any other threads are started
+
+        Converged = False
+        try:
+            if self._Simplex is None:
+                self._InitialiseSimplex()
+                self._WriteCheckpoint()
+            while self._NelderMeadSteps < self.MaxItterations and not Converged:
+                Converged = not self._NelderMeadStep()
+        except _MaxItterationsReached:
+            pass
+        if Converged:
+            logger.info(f'Nelder-Mead converged after {self._NelderMeadSteps} steps and {self.Itteration} '
+                        f'simulations')
+        else:
+            logger.warning(f'Nelder-Mead stopped after {self._NelderMeadSteps} steps and {self.Itteration} '
+                           f'simulations without converging')
+        if self._Simplex is not None:
+            self.NelderMeadRes = OptimizeResult(x=self._Simplex[0], fun=self._SimplexValues[0],
+                                                nit=self._NelderMeadSteps, nfev=self.Itteration, success=Converged,
+                                                final_simplex=(self._Simplex, self._SimplexValues))
         self._write_final_log_entry()
+        self._FinishPlotting()
 
 
 class BayesianOptimiser(TopasOptBaseClass):
@@ -688,11 +1669,80 @@ class BayesianOptimiser(TopasOptBaseClass):
     :param custom_kernel: You can optionally [construct your own kernel](https://scikit-learn.org/stable/modules/gaussian_process.html)
         to use in the gaussian process model
     :type custom_kernel: instance of scikit-learn.gaussian_process.kernels.Kernel or derived classes
+    :param bayes_BatchSize: Bayes-specific parameter. Number of points to suggest and simulate at the same time in each
+        round. The default of 1 is the standard sequential algorithm. For values > 1, points are chosen using the
+        `constant liar <https://hal.science/hal-00260579>`_ strategy: once a point is suggested it is temporarily
+        registered with a fake ('lie') objective value so that the next suggestion goes somewhere else. All simulations
+        in the batch are run at once and all results are registered before the model is refit.
+    :type bayes_BatchSize: int, optional
+    :param bayes_ConstantLiarStrategy: Bayes-specific parameter, only used when bayes_BatchSize > 1. The lie used for
+        pending points; 'min', 'mean' or 'max' of the results so far, or a number. Note that the optimiser internally
+        maximises -1*ObjectiveFunction, so the default 'min' assumes pending points are as bad as the worst result so
+        far, which spreads each batch out.
+    :type bayes_ConstantLiarStrategy: str or float, optional
+    :param bayes_Asynchronous: Bayes-specific parameter, only used when bayes_BatchSize > 1. If True, instead of
+        waiting for a whole batch to finish, bayes_BatchSize simulations are kept running at all times: as soon as
+        any one finishes its result is registered and a new point is suggested, treating the simulations which are
+        still running as pending points (via the constant liar). This is more efficient when simulation times vary
+        a lot between points.
+    :type bayes_Asynchronous: bool, optional
+    :param bayes_GPRefitInterval: Bayes-specific parameter. The gaussian process hyperparameters (e.g. length scales)
+        are re-optimised, with n_restarts_optimizer random restarts, once this many new points have been added since
+        they were last optimised. In between, new points are added to the existing model with a cheap Cholesky
+        update. The default of 1 re-optimises every iteration; larger values are much faster for long optimisations.
+        See utilities.IncrementalGaussianProcessRegressor
+    :type bayes_GPRefitInterval: int, optional
+    :param bayes_GPRefitTolerance: Bayes-specific parameter. If not None, the hyperparameters are also re-optimised
+        whenever the log marginal likelihood per point changes by more than this from its value at the last
+        re-optimisation
+    :type bayes_GPRefitTolerance: float, optional
+    :param bayes_SparseInducingPoints: Bayes-specific parameter. If not None, a sparse gaussian process with this
+        many inducing points is used instead of the exact one once there are more results than inducing points, so
+        that in very long optimisations the cost of fitting grows linearly (O(n * bayes_SparseInducingPoints^2))
+        rather than cubically with the number of results n. The same kernel (including custom_kernel) is used, but
+        its hyperparameters are fitted to the inducing points only. bayes_GPRefitInterval and bayes_GPRefitTolerance
+        have no effect in this case. See utilities.SparseGaussianProcessRegressor
+    :type bayes_SparseInducingPoints: int, optional
+    :param bayes_AcquisitionPoolSize: Bayes-specific parameter. If not None, the acquisition function is maximised by
+        scoring a Sobol pool of this many candidates in one batch and refining only the best with L-BFGS-B, starting
+        from the previous suggestion's refined points as well. This is faster than the bayes_opt default when there
+        are many parameters. See utilities.PooledUpperConfidenceBound
+    :type bayes_AcquisitionPoolSize: int, optional
+    :param bayes_AcquisitionRefine: Bayes-specific parameter, only used with bayes_AcquisitionPoolSize. Number of the
+        best candidates to refine
+    :type bayes_AcquisitionRefine: int, optional
+    :param bayes_AcquisitionWorkers: Bayes-specific parameter, only used with bayes_AcquisitionPoolSize. Number of
+        processes to refine the candidates in
+    :type bayes_AcquisitionWorkers: int, optional
+    :param bayes_MeasuredNoise: Bayes-specific parameter. If True, TopasObjectiveFunction must return
+        (ObjectiveFunction, uncertainty), where uncertainty is the standard deviation of the objective function due
+        to Monte Carlo statistics (e.g. from the topas per voxel statistics, or by splitting the histories into
+        batches). The gaussian process then treats each point as having its own noise, uncertainty**2, on top of
+        bayes_GP_alpha, so noisy points are trusted less than precise ones. The uncertainty is logged
+    :type bayes_MeasuredNoise: bool, optional
+    :param bayes_AdaptivePrimaries: Bayes-specific parameter. (minimum, maximum) number of primaries. If supplied,
+        the number of primaries for each simulation is chosen so that its uncertainty is about bayes_NoiseFraction
+        times the gaussian process's predicted standard deviation at that point, assuming the uncertainty falls as
+        1/sqrt(primaries). Early exploratory points, where the model is uncertain anyway, get few primaries and the
+        final candidates get many. The number of primaries is passed to GenerateTopasScripts as an extra keyword
+        argument (see bayes_PrimariesName) and logged. Implies bayes_MeasuredNoise; until the first uncertainty has
+        been measured the minimum is used
+    :type bayes_AdaptivePrimaries: tuple, optional
+    :param bayes_PrimariesName: Bayes-specific parameter, only used with bayes_AdaptivePrimaries. Name of the
+        keyword argument GenerateTopasScripts receives the number of primaries as
+    :type bayes_PrimariesName: str, optional
+    :param bayes_NoiseFraction: Bayes-specific parameter, only used with bayes_AdaptivePrimaries. Target
+        uncertainty of each simulation as a fraction of the model's predicted standard deviation
+    :type bayes_NoiseFraction: float, optional
     """
 
     def __init__(self, bayes_length_scales=None, bayes_UCBkappa=5,
                  bayes_KappaDecayIterations=10, bayes_GP_alpha=0.01,
-                 custom_kernel=None,**kwds):
+                 custom_kernel=None, bayes_BatchSize=1, bayes_ConstantLiarStrategy='min',
+                 bayes_Asynchronous=False, bayes_GPRefitInterval=1, bayes_GPRefitTolerance=None,
+                 bayes_SparseInducingPoints=None, bayes_AcquisitionPoolSize=None, bayes_AcquisitionRefine=10,
+                 bayes_AcquisitionWorkers=1, bayes_MeasuredNoise=False, bayes_AdaptivePrimaries=None,
+                 bayes_PrimariesName='n_primaries', bayes_NoiseFraction=0.5, **kwds):
         """
         init function for Bayesian optimiser
         """
@@ -700,7 +1750,52 @@ class BayesianOptimiser(TopasOptBaseClass):
         self.bayes_UCBkappa = bayes_UCBkappa
         self.bayes_KappaDecayIterations = bayes_KappaDecayIterations
         self.bayes_GP_alpha = bayes_GP_alpha
+        self.bayes_BatchSize = bayes_BatchSize
+        self.bayes_ConstantLiarStrategy = bayes_ConstantLiarStrategy
+        self.bayes_Asynchronous = bayes_Asynchronous
+        self.bayes_GPRefitInterval = bayes_GPRefitInterval
+        self.bayes_GPRefitTolerance = bayes_GPRefitTolerance
+        self.bayes_SparseInducingPoints = bayes_SparseInducingPoints
+        self.bayes_AcquisitionPoolSize = bayes_AcquisitionPoolSize
+        self.bayes_AcquisitionRefine = bayes_AcquisitionRefine
+        self.bayes_AcquisitionWorkers = bayes_AcquisitionWorkers
+        self.bayes_MeasuredNoise = bayes_MeasuredNoise or (bayes_AdaptivePrimaries is not None)
+        self.bayes_AdaptivePrimaries = bayes_AdaptivePrimaries
+        self.bayes_PrimariesName = bayes_PrimariesName
+        self.bayes_NoiseFraction = bayes_NoiseFraction
+        self._PlannedPrimaries = {}  # iteration: number of primaries
+        self._NoiseVariances = []  # measured noise variance of each point registered with the optimizer
         super().__init__(**kwds)
+        if not (isinstance(self.bayes_BatchSize, (int, np.integer)) and self.bayes_BatchSize >= 1):
+            logger.error(f'bayes_BatchSize must be an integer >= 1, not {self.bayes_BatchSize}. Quitting')
+            sys.exit(1)
+        if not (isinstance(self.bayes_GPRefitInterval, (int, np.integer)) and self.bayes_GPRefitInterval >= 1):
+            logger.error(f'bayes_GPRefitInterval must be an integer >= 1, not {self.bayes_GPRefitInterval}. Quitting')
+            sys.exit(1)
+        if self.bayes_SparseInducingPoints is not None and not \
+                (isinstance(self.bayes_SparseInducingPoints, (int, np.integer)) and self.bayes_SparseInducingPoints >= 1):
+            logger.error(f'bayes_SparseInducingPoints must be None or an integer >= 1, not '
+                         f'{self.bayes_SparseInducingPoints}. Quitting')
+            sys.exit(1)
+        if isinstance(self.bayes_ConstantLiarStrategy, (int, float, np.integer)) and \
+                not isinstance(self.bayes_ConstantLiarStrategy, bool):
+            self.bayes_ConstantLiarStrategy = float(self.bayes_ConstantLiarStrategy)  # bayes_opt only accepts floats
+        elif self.bayes_ConstantLiarStrategy not in ['min', 'mean', 'max']:
+            logger.error(f"bayes_ConstantLiarStrategy must be 'min', 'mean', 'max' or a number, not "
+                         f"{self.bayes_ConstantLiarStrategy}. Quitting")
+            sys.exit(1)
+        if self.bayes_AdaptivePrimaries is not None:
+            if not (np.size(self.bayes_AdaptivePrimaries) == 2 and 0 < self.bayes_AdaptivePrimaries[0]
+                    <= self.bayes_AdaptivePrimaries[1]):
+                logger.error(f'bayes_AdaptivePrimaries must be (minimum, maximum) number of primaries, not '
+                             f'{self.bayes_AdaptivePrimaries}. Quitting')
+                sys.exit(1)
+            if self.bayes_PrimariesName in self.ParameterNames:
+                logger.error(f'bayes_PrimariesName ({self.bayes_PrimariesName}) is also one of the ParameterNames.'
+                             f' Quitting')
+                sys.exit(1)
+        if self.bayes_Asynchronous and self.bayes_BatchSize == 1:
+            logger.warning('bayes_Asynchronous has no effect unless bayes_BatchSize > 1; running sequentially')
 
         self.BayesOptLogLoc = Path(self.BaseDirectory) / self.SimulationName / 'logs/bayes_opt_logs.json'
         self._BayesianOptimiser__RestartMode = False  # don't change!
@@ -712,6 +1807,7 @@ class BayesianOptimiser(TopasOptBaseClass):
         # Bayesian optimisation settings:
         self._target_prediction_mean = []  # keep track of what the optimiser expects to get
         self._target_prediction_std = []  # keep track of what the optimiser expects to get
+        self._Slicer = None  # GaussianProcessSlicer, created when first needed
         # see here: https://github.com/fmfn/BayesianOptimization/issues/202
         self.Matern_Nu = 1.5  # see here https://scikit-learn.org/stable/modules/generated/sklearn.gaussian_process.kernels.Matern.html#sklearn.gaussian_process.kernels.Matern
         self.UCBkappa = bayes_UCBkappa  # higher kappa = more exploration. lower kappa = more exploitation
@@ -734,13 +1830,70 @@ class BayesianOptimiser(TopasOptBaseClass):
             # ^^ this is the parameter to ensure we end up with UCBKappa_final on the last iteration
 
         # instantiate optimizer:
-        acq = acquisition.UpperConfidenceBound(kappa=self.UCBkappa, exploration_decay=self.kappa_decay,
-                                                        exploration_decay_delay=self.kappa_decay_delay)
+        if self.bayes_AcquisitionPoolSize is None:
+            acq = acquisition.UpperConfidenceBound(kappa=self.UCBkappa, exploration_decay=self.kappa_decay,
+                                                   exploration_decay_delay=self.kappa_decay_delay, random_state=1)
+        else:
+            acq = PooledUpperConfidenceBound(kappa=self.UCBkappa, exploration_decay=self.kappa_decay,
+                                             exploration_decay_delay=self.kappa_decay_delay,
+                                             pool_size=self.bayes_AcquisitionPoolSize,
+                                             n_refine=self.bayes_AcquisitionRefine,
+                                             n_workers=self.bayes_AcquisitionWorkers, random_state=1)
         self.optimizer = BayesianOptimization(f=None, pbounds=self.pbounds, random_state=1,
                                               allow_duplicate_points=False, acquisition_function=acq)
-        self.optimizer.set_gp_params(normalize_y=True, kernel=self._kernel,
-                                n_restarts_optimizer=self.n_restarts_optimizer, alpha=self.bayes_GP_alpha)  # tuning of the gaussian parameters...
+        # tuning of the gaussian parameters...
+        if self.bayes_SparseInducingPoints is None:
+            self.optimizer._gp = IncrementalGaussianProcessRegressor(kernel=self._kernel, alpha=self.bayes_GP_alpha,
+                                                                     normalize_y=True,
+                                                                     n_restarts_optimizer=self.n_restarts_optimizer,
+                                                                     random_state=self.optimizer._random_state,
+                                                                     refit_every=self.bayes_GPRefitInterval,
+                                                                     lml_tolerance=self.bayes_GPRefitTolerance)
+        else:
+            self.optimizer._gp = SparseGaussianProcessRegressor(kernel=self._kernel, alpha=self.bayes_GP_alpha,
+                                                                normalize_y=True,
+                                                                n_restarts_optimizer=self.n_restarts_optimizer,
+                                                                random_state=self.optimizer._random_state,
+                                                                n_inducing=self.bayes_SparseInducingPoints)
+        if self.bayes_BatchSize > 1:
+            # wraps the UCB acquisition above, so kappa still decays once per suggested point
+            self._batch_acquisition = acquisition.ConstantLiar(base_acquisition=acq,
+                                                               strategy=self.bayes_ConstantLiarStrategy)
+
 
+    def _CreateVariableDictionary(self, x):
+        """
+        As for the other optimisers, with the number of primaries added if bayes_AdaptivePrimaries is used
+        """
+        super()._CreateVariableDictionary(x)
+        if self.bayes_AdaptivePrimaries is not None:
+            self.VariableDict[self.bayes_PrimariesName] = self._PlannedPrimaries.get(
+                self.Itteration, int(self.bayes_AdaptivePrimaries[0]))
+
+    def _plan_primaries(self, Itteration, predicted_std):
+        """
+        Choose the number of primaries for an iteration, so that its uncertainty is bayes_NoiseFraction * the
+        predicted standard deviation. The uncertainty of N primaries is estimated as c / sqrt(N), where c is the
+        median of uncertainty * sqrt(primaries) over the simulations so far
+
+        :param Itteration: the iteration the primaries are for
+        :type Itteration: int
+        :param predicted_std: standard deviation predicted by the gaussian process at the point to be simulated
+        :type predicted_std: float
+        """
+        if self.bayes_AdaptivePrimaries is None:
+            return
+        MinPrimaries, MaxPrimaries = self.bayes_AdaptivePrimaries
+        Primaries = MinPrimaries
+        ResultsDict = self._ReadLog()
+        if 'ObjectiveFunctionUncertainty' in ResultsDict and self.bayes_PrimariesName in ResultsDict:
+            NoiseConstants = np.asarray(ResultsDict['ObjectiveFunctionUncertainty']) * \
+                np.sqrt(np.asarray(ResultsDict[self.bayes_PrimariesName]))
+            NoiseConstants = NoiseConstants[np.isfinite(NoiseConstants) & (NoiseConstants > 0)]
+            TargetUncertainty = self.bayes_NoiseFraction * predicted_std
+            if NoiseConstants.size and TargetUncertainty > 0:
+                Primaries = (np.median(NoiseConstants) / TargetUncertainty) ** 2
+        self._PlannedPrimaries[Itteration] = int(np.clip(Primaries, MinPrimaries, MaxPrimaries))
 
     def _derive_bayes_length_scales(self, bayes_length_scales):
         """
@@ -824,7 +1977,7 @@ class BayesianOptimiser(TopasOptBaseClass):
         :param optimizer: The bayesian optimiser object from RunOptimisation
         """
 
-        ResultsDict = ReadInLogFile(self._LogFileLoc)
+        ResultsDict = self._ReadLog()
 
         # we need to format this into a an array based on ParameterNames
         ResultsArray = np.zeros([len(ResultsDict['Itteration']), len(self.ParameterNames)])
@@ -834,59 +1987,55 @@ class BayesianOptimiser(TopasOptBaseClass):
             Values = ResultsDict[parameter]
             ResultsArray[:, i] = Values
 
-        OF = ResultsDict['ObjectiveFunction']
-        OF = [-1 * item for item in
-              OF]  # it is stored in the log files with the opposite sign of what is used internally
+        OF = -1 * ResultsDict['ObjectiveFunction']  # it is stored in the log files with the opposite sign of what is used internally
         ItterationVector = ResultsDict['Itteration']
         mean, std = optimizer._gp.predict(ResultsArray, return_std=True)
 
-        fig, axs = plt.subplots(nrows=1, ncols=1, figsize=(5, 5))
-        axs.plot(ItterationVector, OF, 'C1-x')
-        axs.set_xlabel('Itteration number', fontsize=FigureSpecs.LabelFontSize)
-        axs.set_ylabel('Objective function', fontsize=FigureSpecs.LabelFontSize)
-        axs.grid(True)
-        axs.plot(ItterationVector, mean, 'C0')
-        axs.fill_between(ItterationVector, mean + std, mean - std, alpha=0.3, color='C0')
-        axs.legend(['Actual', 'Predicted', 'Std.'])
-        axs.set_title('Retrospective Model Fit', fontsize=FigureSpecs.TitleFontSize)
-
         SaveLoc = Path(self.BaseDirectory) / self.SimulationName
         SaveLoc = SaveLoc / 'logs'
-        plt.savefig(SaveLoc / 'RetrospectiveModelFit.png')
-        plt.close(fig)
+        self._Renderer.Submit('RetrospectiveModelFit', PlotRetrospectiveModelFit, ItterationVector, OF, mean, std,
+                              SaveLoc / 'RetrospectiveModelFit.png')
 
     def _plot_predicted_versus_actual_correlation(self):
         """
         Produce a scatter plot of the predicted versus actual objective function values, and print spearman and pearson
         correlation coefficient to it
         """
-        fig, axs = plt.subplots(nrows=1, ncols=1, figsize=(5, 5))
         TargetPredictionMean = [-1 * item for item in
                                 self._target_prediction_mean]  # need to account for min/max discrepancy
-        axs.scatter(self.AllObjectiveFunctionValues, TargetPredictionMean)
-        axs.set_xlabel('Actual', fontsize=FigureSpecs.LabelFontSize)
-        axs.set_ylabel('Predicted', fontsize=FigureSpecs.LabelFontSize)
-        NewMinLim = np.min([axs.get_ylim(), axs.get_xlim()])
-        NewMaxLim = np.max([axs.get_ylim(), axs.get_xlim()])
-        axs.set_ylim([NewMinLim, NewMaxLim])
-        axs.set_xlim([NewMinLim, NewMaxLim])
-        axs.plot([NewMinLim, NewMaxLim], [NewMinLim, NewMaxLim], 'r--')
-
-        # Assess and print correlation metrics:
-        if len(TargetPredictionMean) > 2:
-            Pearson = stats.pearsonr(self.AllObjectiveFunctionValues, TargetPredictionMean)
-            Spearman = stats.spearmanr(self.AllObjectiveFunctionValues, TargetPredictionMean)
-            plt.text(NewMinLim + abs(NewMinLim * 0.2), NewMaxLim - (abs(NewMaxLim * 0.2)),
-                     f'Spearman: {Spearman[0]: 1.1f}\nPearson: {Pearson[0]: 1.1f}',
-                     fontsize=FigureSpecs.LabelFontSize)
-
-        axs.grid(True)
-        axs.set_title('Actual versus predicted correlation', fontsize=FigureSpecs.TitleFontSize)
-        plt.tight_layout()
         SaveLoc = Path(self.BaseDirectory) / self.SimulationName
         SaveLoc = SaveLoc / 'logs'
-        plt.savefig(SaveLoc / 'CorrelationPlot.png')
-        plt.close(fig)
+        self._Renderer.Submit('CorrelationPlot', PlotPredictedVersusActual, list(self.AllObjectiveFunctionValues),
+                              TargetPredictionMean, SaveLoc / 'CorrelationPlot.png')
+
+    def PredictParameterSlices(self, Nsamples=100, Pairwise=False, PairwiseSamples=25):
+        """
+        Predict the objective function while only one parameter (or, if Pairwise, one pair of parameters) varies
+        and the others are held at the current best values. All slices are predicted in one batch and nothing is
+        plotted, so this can be used for headless analysis of the current model.
+
+        :param Nsamples: number of points along each single parameter slice
+        :type Nsamples: int, optional
+        :param Pairwise: if True, also predict a grid for each pair of parameters
+        :type Pairwise: bool, optional
+        :param PairwiseSamples: number of points along each side of the pairwise grids
+        :type PairwiseSamples: int, optional
+        :returns: Slices: {param: (values, mean, std)} for each parameter, and
+            PairwiseSlices: {(param1, param2): (values1, values2, mean, std)} where mean and std have shape
+            (PairwiseSamples, PairwiseSamples) and are indexed [values1, values2]. Empty unless Pairwise
+        """
+        if self._Slicer is None or self._Slicer.gp is not self.optimizer._gp:
+            self._Slicer = GaussianProcessSlicer(self.optimizer._gp)
+        Params = list(self.optimizer.max['params'].keys())
+        ConstantValues = np.array(list(self.optimizer.max['params'].values()))  # current best guess for each param
+        Bounds = np.array([self.pbounds[param] for param in Params])
+        Slices, PairwiseSlices = self._Slicer.Predict(ConstantValues, Bounds, Nsamples=Nsamples, Pairwise=Pairwise,
+                                                      PairwiseSamples=PairwiseSamples)
+        # the optimiser maximises -1 * objective function:
+        Slices = {Params[i]: (values, -1 * mean, std) for i, (values, mean, std) in Slices.items()}
+        PairwiseSlices = {(Params[i], Params[j]): (values_i, values_j, -1 * mean, std)
+                          for (i, j), (values_i, values_j, mean, std) in PairwiseSlices.items()}
+        return Slices, PairwiseSlices
 
     def _plot_single_variable_objective(self, optimizer):
         """
@@ -900,33 +2049,31 @@ class BayesianOptimiser(TopasOptBaseClass):
         if not os.path.isdir(PlotSavePath):
             os.mkdir(PlotSavePath)
 
-        Nsamples = 100
-        Params = list(optimizer.max['params'].keys())
-        PointsToTest = np.ones([len(Params), Nsamples])  # this will be an array of the best points for each param
-        # below we overwrite one row at a time with the parameter being varied
-        ConstantValues = np.array(list(optimizer.max['params'].values()))  # current best guess for each param
-        for i, const_val in enumerate(ConstantValues):
-            PointsToTest[i, :] = PointsToTest[i,:] * const_val
-
-
-        for i, param in enumerate(Params):
-
-            PointsToTest_temp = PointsToTest.copy()
-            PointsToVary = np.linspace(self.pbounds[param][0], self.pbounds[param][1], Nsamples)
-            PointsToTest_temp[i, :] = PointsToVary
-            mean, std = optimizer._gp.predict(PointsToTest_temp.T, return_std=True)
-            mean = -1 * mean
-            std = -1 * std
-            fig = plt.figure()
-            plt.plot(PointsToVary, mean)
-            plt.fill_between(PointsToVary, mean + std, mean - std, alpha=0.5, color='C0')
-            plt.xlabel(param)
-            plt.ylabel('Predicted Objective function value')
-            plt.title(f'Single parameter plot for {param}')
-            plt.grid()
+        Slices, PairwiseSlices = self.PredictParameterSlices()
+        for param, (PointsToVary, mean, std) in Slices.items():
             SaveName = PlotSavePath + f'/{param}.png'
-            plt.savefig(SaveName)
-            plt.close(fig)
+            self._Renderer.Submit(f'SingleParameterPlot_{param}', PlotSingleParameter, param, PointsToVary, mean, std,
+                                  SaveName)
+
+    def _plot_diagnostics(self, force=False):
+        """
+        Update the Bayesian diagnostic plots, if they are due (see PlotEveryNIterations and PlotEverySeconds)
+
+        :param force: if True, the plots are updated regardless
+        :type force: bool, optional
+        """
+        if not self._PlotIsDue('BayesianDiagnostics', force):
+            return
+        self._plot_predicted_versus_actual_correlation()
+        self._plot_convergence_plot_retrospective(self.optimizer)
+        self._plot_single_variable_objective(self.optimizer)
+
+    def _FinishPlotting(self):
+        """
+        Update all diagnostic plots at the end of an optimisation, then let the renderer finish in the background
+        """
+        self._plot_diagnostics(force=True)
+        super()._FinishPlotting()
 
     def _update_logs_with_length_scales(self):
         """
@@ -946,6 +2093,273 @@ class BayesianOptimiser(TopasOptBaseClass):
         except AttributeError:
             pass
 
+    def _record_noise(self, uncertainty):
+        """
+        Add the measured uncertainty of the point just registered to the noise the gaussian process is fit with
+        """
+        if uncertainty is None:
+            logger.error('bayes_MeasuredNoise is set, so TopasObjectiveFunction must return '
+                         '(ObjectiveFunction, uncertainty). Quitting')
+            sys.exit(1)
+        self._NoiseVariances.append(float(uncertainty) ** 2)
+        self.optimizer._gp.noise_variance = np.array(self._NoiseVariances)
+
+    def _read_registered_noise_variances(self):
+        """
+        Read the measured noise of each point registered with the optimizer from the log file, for restarts without
+        a checkpoint. Repeated points are logged but not registered, so the log entries are matched to the registered
+        points in order, by their parameters and objective function.
+
+        :returns: NoiseVariances: list with one variance per registered point
+        """
+        BinaryLogFileLoc = Path(self._LogFileLoc).with_suffix('.bin')
+        if os.path.isfile(str(BinaryLogFileLoc) + '.json'):
+            ResultsDict = ReadInLogFile(BinaryLogFileLoc)
+        else:
+            ResultsDict = ReadInLogFile(self._LogFileLoc)
+        LoggedParams = np.array([ResultsDict[key] for key in self.optimizer.space.keys]).T
+        LoggedTargets = -np.array(ResultsDict['ObjectiveFunction'])
+        Uncertainty = np.array(ResultsDict['ObjectiveFunctionUncertainty'])
+        Tolerance = 5e-3 + 1e-9  # values in the text log are rounded to two decimal places
+        NoiseVariances = []
+        row = 0
+        for params, target in zip(self.optimizer.space.params, self.optimizer.space.target):
+            while row < len(LoggedTargets) and not (
+                    np.allclose(LoggedParams[row], params, rtol=0, atol=Tolerance) and
+                    np.isclose(LoggedTargets[row], target, rtol=0, atol=Tolerance)):
+                row = row + 1
+            if row == len(LoggedTargets):
+                logger.error(f'could not find the point {params} from {self.BayesOptLogLoc} in {self._LogFileLoc}, '
+                             f'so its measured noise is unknown. Quitting')
+                sys.exit(1)
+            NoiseVariances.append(float(Uncertainty[row]) ** 2)
+            row = row + 1
+        return NoiseVariances
+
+    def _register_point(self, params, target):
+        """
+        Register a new result with the optimizer. Points which have already been probed are not registered again.
+        With bayes_MeasuredNoise, the uncertainty of the most recently evaluated iteration is recorded too
+
+        :param params: the parameters which were simulated
+        :type params: dict
+        :param target: the value returned by BlackBoxFunction for these parameters
+        :returns: False if the same point has now been requested so many times that optimisation should stop
+        """
+        KeepGoing = True
+        try:
+            self.optimizer.register(params=params, target=target)
+            if self.bayes_MeasuredNoise:
+                self._record_noise(self.OFUncertainty)
+        except NotUniqueError:
+            try:
+                self.RepeatedPointsProbed = self.RepeatedPointsProbed + 1
+                logger.warning(
+                    f'Bayesian algorithm is attempting to probe an existing point: {np.array(list(params.values()))}.'
+                    f' Continuing for now....')
+                if self.RepeatedPointsProbed > 10:
+                    logger.error('The same point has been requested more than 10 times; quitting')
+                    KeepGoing = False
+            except AttributeError:
+                self.RepeatedPointsProbed = 1
+        self._WriteCheckpoint()
+        return KeepGoing
+
+    def _CheckpointAfterEvaluation(self):
+        """
+        The checkpoint is written once the result has been registered with the optimizer (see _register_point)
+        """
+        pass
+
+    def _ExtraLogEntries(self):
+        """
+        The number of primaries with bayes_AdaptivePrimaries, and the uncertainty of the objective function with
+        bayes_MeasuredNoise
+        """
+        Entry = super()._ExtraLogEntries()
+        if self.bayes_AdaptivePrimaries is not None:
+            Entry[self.bayes_PrimariesName] = float(self._PlannedPrimaries.get(self.Itteration,
+                                                                               self.bayes_AdaptivePrimaries[0]))
+        if self.bayes_MeasuredNoise:
+            Entry['ObjectiveFunctionUncertainty'] = np.nan if self.OFUncertainty is None else \
+                float(self.OFUncertainty)
+        return Entry
+
+    def _ObjectiveFunctionToTarget(self, OF):
+        """
+        bayes_opt seeks the maximum, so the objective function is negated
+        """
+        return -OF
+
+    def SetUpDirectoryStructure(self):
+        """
+        As for the other optimisers, plus a directory for the single parameter plots
+        """
+        super().SetUpDirectoryStructure()
+        os.makedirs(Path(self.BaseDirectory) / self.SimulationName / 'logs' / 'SingleParameterPlots', exist_ok=True)
+
+    def _GetCheckpointState(self):
+        """
+        As for the other optimisers, plus the fitted gaussian process, the probed points, the random state and the
+        exploration decay counter of the acquisition function, so that a restart does not have to refit anything
+        """
+        State = super()._GetCheckpointState()
+        acq = self.optimizer.acquisition_function
+        State.update({'Optimizer': {'gp': self.optimizer._gp, 'space': self.optimizer._space,
+                                    'random_state': self.optimizer._random_state},
+                      'Acquisition': {'i': acq.i, 'kappa': acq.kappa, 'random_state': acq.random_state.get_state()},
+                      'NoiseVariances': list(self._NoiseVariances),
+                      'TargetPredictionMean': list(self._target_prediction_mean),
+                      'TargetPredictionStd': list(self._target_prediction_std),
+                      'PlannedPrimaries': dict(self._PlannedPrimaries)})
+        return State
+
+    def _SetCheckpointState(self, State):
+        """
+        Restore the state returned by _GetCheckpointState. The gaussian process and probed points are restored as
+        they were, while only the counters of the acquisition function are restored, so that e.g. a larger
+        Nitterations still takes effect
+        """
+        super()._SetCheckpointState(State)
+        # these are pickled together so the gaussian process still shares the random state of the optimizer
+        self.optimizer._gp = State['Optimizer']['gp']
+        self.optimizer._space = State['Optimizer']['space']
+        self.optimizer._random_state = State['Optimizer']['random_state']
+        acq = self.optimizer.acquisition_function
+        acq.i = State['Acquisition']['i']
+        acq.kappa = State['Acquisition']['kappa']
+        acq.random_state.set_state(State['Acquisition']['random_state'])
+        self._NoiseVariances = State['NoiseVariances']
+        self._target_prediction_mean = State['TargetPredictionMean']
+        self._target_prediction_std = State['TargetPredictionStd']
+        self._PlannedPrimaries = State['PlannedPrimaries']
+
+    def _suggest_batch(self, BatchSize, refit_gp=True):
+        """
+        Suggest BatchSize points to probe at the same time. Any user suggestions which have not been probed yet are
+        used first; the remainder come from the constant liar acquisition function. The GP is refit to the real
+        observations before returning, since the constant liar leaves it fit to the fantasised ones.
+
+        :param BatchSize: number of points to suggest
+        :type BatchSize: int
+        :param refit_gp: if False, the GP is left fit to the real plus fantasised observations
+        :type refit_gp: bool, optional
+        :returns: PointsToProbe: list of parameter dictionaries
+        """
+        PointsToProbe = []
+        for n in range(BatchSize):
+            if (self.Nsuggestions is not None) and (self.SuggestionsProbed < self.Nsuggestions):
+                next_point_to_probe = self.Suggestions[self.SuggestionsProbed]
+                self.SuggestionsProbed += 1
+                # user suggestions are pending too, so the liar should steer away from them
+                self._batch_acquisition.dummies.append(self.optimizer.space.params_to_array(next_point_to_probe))
+            else:
+                suggestion = self._batch_acquisition.suggest(gp=self.optimizer._gp, target_space=self.optimizer.space)
+                next_point_to_probe = self.optimizer.space.array_to_params(suggestion)
+            PointsToProbe.append(next_point_to_probe)
+
+        if refit_gp:
+            self.optimizer._gp.fit(self.optimizer.space.params, self.optimizer.space.target)
+        return PointsToProbe
+
+    def _run_batch_optimisation_loop(self):
+        """
+        The main optimisation loop when bayes_BatchSize > 1: suggest a batch of points, simulate them all at once,
+        then register all the results before the next batch is suggested.
+        """
+        while self.Itteration < self.MaxItterations:
+            BatchSize = min(self.bayes_BatchSize, self.MaxItterations - self.Itteration)
+            PointsToProbe = self._suggest_batch(BatchSize)
+            PointsArray = np.array([self.optimizer.space.params_to_array(point) for point in PointsToProbe])
+            mean, std = self.optimizer._gp.predict(PointsArray, return_std=True)
+            for n in range(BatchSize):
+                self._plan_primaries(self.Itteration + n, std[n])
+
+            ParameterSets = self._RunIterationsConcurrently(PointsToProbe)
+            KeepGoing = True
+            for n, next_point_to_probe in enumerate(PointsToProbe):
+                self.x = ParameterSets[n]
+                self._target_prediction_mean.append(float(mean[n]))
+                self._target_prediction_std.append(float(std[n]))
+                target = self._EvaluateIteration()
+                self.Itteration = self.Itteration + 1
+                KeepGoing = self._register_point(next_point_to_probe, target) and KeepGoing
+
+            self._plot_diagnostics()
+            if not KeepGoing:
+                break
+
+    def _run_asynchronous_optimisation_loop(self):
+        """
+        The main optimisation loop when bayes_Asynchronous is True: bayes_BatchSize simulations are kept in flight,
+        and a new point is suggested every time one of them finishes.
+        """
+        PendingPredictions = {}
+
+        def suggest_point():
+            """
+            suggest the next point, treating every running simulation as a pending (constant liar) point
+            """
+            next_point_to_probe = self._suggest_batch(1, refit_gp=False)[0]
+            PointArray = self.optimizer.space.params_to_array(next_point_to_probe)
+            # this is the prediction of the model which chose the point (pending points included)
+            mean, std = self.optimizer._gp.predict(PointArray.reshape(1, -1), return_std=True)
+            PendingPredictions[self.Itteration] = (float(mean[0]), float(std[0]))
+            self._plan_primaries(self.Itteration, float(std[0]))
+            return next_point_to_probe
+
+        def on_result(next_point_to_probe):
+            """
+            log and register a finished simulation
+            """
+            mean, std = PendingPredictions.pop(self.Itteration)
+            self._target_prediction_mean.append(mean)
+            self._target_prediction_std.append(std)
+            target = self._EvaluateIteration()
+            KeepGoing = self._register_point(next_point_to_probe, target)
+
+            self.optimizer._gp.fit(self.optimizer.space.params, self.optimizer.space.target)
+            self._plot_diagnostics()
+            return KeepGoing
+
+        for Itteration, next_point_to_probe in self._InFlight.items():
+            # restored from the checkpoint; these are resubmitted, so they are pending points again
+            PointArray = self.optimizer.space.params_to_array(next_point_to_probe)
+            self._batch_acquisition.dummies.append(PointArray)
+            mean, std = self.optimizer._gp.predict(PointArray.reshape(1, -1), return_std=True)
+            PendingPredictions[Itteration] = (float(mean[0]), float(std[0]))
+
+        self._RunIterationsAsynchronously(suggest_point, on_result, self.bayes_BatchSize)
+
+    def _run_optimisation_loop(self):
+        """
+        Suggest and probe points until MaxItterations have been run, using whichever loop the settings call for
+        """
+        if self.bayes_BatchSize > 1 and self.bayes_Asynchronous:
+            self._run_asynchronous_optimisation_loop()
+        elif self.bayes_BatchSize > 1:
+            self._run_batch_optimisation_loop()
+        else:
+            for point in range(self.Itteration, self.MaxItterations):
+
+                if (self.Nsuggestions is not None) and (self.SuggestionsProbed < self.Nsuggestions):
+                    # evaluate any suggested solutions first
+                    next_point_to_probe = self.Suggestions[self.SuggestionsProbed]
+                    self.SuggestionsProbed += 1
+                else:
+                    next_point_to_probe = self.optimizer.suggest()
+
+                NextPointValues = np.array(list(next_point_to_probe.values()))
+                mean, std = self.optimizer._gp.predict(NextPointValues.reshape(1, -1), return_std=True)
+                self._target_prediction_mean.append(float(np.squeeze(mean)))
+                self._target_prediction_std.append(float(np.squeeze(std)))
+                self._plan_primaries(self.Itteration, float(np.squeeze(std)))
+                target = self.BlackBoxFunction(next_point_to_probe)
+                if not self._register_point(next_point_to_probe, target):
+                    break
+
+                self._plot_diagnostics()
+
     def RunOptimisation(self):
         """
         This is the main optimisation loop.
@@ -955,12 +2369,18 @@ class BayesianOptimiser(TopasOptBaseClass):
         # set up directory structure
         if not self.__RestartMode:
             self.SetUpDirectoryStructure()
-        else:
+        elif self._testing_mode:
             self._setup_topas_emulator()
+        self._Renderer.Start()  # before any other threads are started
+        if isinstance(self.optimizer.acquisition_function, PooledUpperConfidenceBound):
+            self.optimizer.acquisition_function.Start()  # likewise
 
         if self.__RestartMode:
             # then load the previous log files:
             load_logs(self.optimizer, logs=[self.BayesOptLogLoc])
+            if self.bayes_MeasuredNoise:
+                self._NoiseVariances = self._read_registered_noise_variances()
+                self.optimizer._gp.noise_variance = np.array(self._NoiseVariances)
             bayes_opt_logger = newJSONLogger(path=self.BayesOptLogLoc)
             self.optimizer.subscribe(Events.OPTIMIZATION_STEP, bayes_opt_logger)
             self.optimizer._gp.fit(self.optimizer._space.params, self.optimizer._space.target)
@@ -970,68 +2390,377 @@ class BayesianOptimiser(TopasOptBaseClass):
             if self.Itteration >= self.MaxItterations-1:
                 logger.error(f'nothing to restart; max iterations is {self.MaxItterations} and have already been completed')
                 sys.exit(1)
+        elif self._Restarting:
+            # everything else was restored from the checkpoint
+            bayes_opt_logger = newJSONLogger(path=self.BayesOptLogLoc)
+            self.optimizer.subscribe(Events.OPTIMIZATION_STEP, bayes_opt_logger)
         else:
             bayes_opt_logger = JSONLogger(path=str(self.BayesOptLogLoc))
             self.optimizer.subscribe(Events.OPTIMIZATION_STEP, bayes_opt_logger)
             # first guess is nonsense but we need the vectors to be the same length
             self._target_prediction_mean.append(0)
             self._target_prediction_std.append(0)
-            target = self.BlackBoxFunction(self.VariableDict)
-            self.optimizer.register(self.VariableDict, target=target)
-
-        for point in range(self.Itteration, self.MaxItterations):
+            StartPoint = {Parameter: self.VariableDict[Parameter] for Parameter in self.ParameterNames}
+            target = self.BlackBoxFunction(StartPoint)
+            self.optimizer.register(StartPoint, target=target)
+            if self.bayes_MeasuredNoise:
+                self._record_noise(self.OFUncertainty)
+            self._WriteCheckpoint()
 
-            if (self.Nsuggestions is not None) and (self.SuggestionsProbed < self.Nsuggestions):
-                # evaluate any suggested solutions first
-                next_point_to_probe = self.Suggestions[self.SuggestionsProbed]
-                self.SuggestionsProbed += 1
-            else:
-                next_point_to_probe = self.optimizer.suggest()
-
-            NextPointValues = np.array(list(next_point_to_probe.values()))
-            mean, std = self.optimizer._gp.predict(NextPointValues.reshape(1, -1), return_std=True)
-            self._target_prediction_mean.append(float(mean))
-            self._target_prediction_std.append(float(mean))
-            target = self.BlackBoxFunction(next_point_to_probe)
-            try:
-                self.optimizer.register(params=next_point_to_probe, target=target)
-            except NotUniqueError:
-                try:
-                    self.RepeatedPointsProbed = self.RepeatedPointsProbed + 1
-                    logger.warning(
-                        f'Bayesian algorithm is attempting to probe an existing point: {NextPointValues}. Continuing for now....')
-                    if self.RepeatedPointsProbed > 10:
-                        logger.error('The same point has been requested more than 10 times; quitting')
-                        break
-                except AttributeError:
-                    self.RepeatedPointsProbed = 1
-
-            self._plot_predicted_versus_actual_correlation()
-            self._plot_convergence_plot_retrospective(self.optimizer)
-            self._plot_single_variable_objective(self.optimizer)
+        self._run_optimisation_loop()
+        if isinstance(self.optimizer.acquisition_function, PooledUpperConfidenceBound):
+            self.optimizer.acquisition_function.Close()
 
         # update the logs with the best value:
         self._write_final_log_entry()
         # update logs with length scales:
         self._update_logs_with_length_scales()
+        self._FinishPlotting()
 
     def RestartOptimisation(self):
         """
         Sometimes for whatever reason an optimisation is stopped prematurely.
-        This function allows you to restart the optimisation by loading the previous log files.
+        This function allows you to restart the optimisation from the checkpoint (see
+        TopasOptBaseClass.RestartOptimisation). Optimisations from older versions of TopasOpt, which have no
+        checkpoint, are restarted by loading the previous log files and refitting the gaussian process.
         You just have to change Optimiser.RunOptimisation() to Optimiser.RestartOptimisation()
         in your optimisation script; the code will do the rest automatically.
         """
+        if os.path.isfile(self.CheckpointLocation):
+            super().RestartOptimisation()
+            return
         self.__RestartMode = True
+        self._RemoveFinalLogEntry()
+        self.RunOptimisation()
 
 
-        # delete the end of run info from the log file
-        with open(self._LogFileLoc, "r") as f:
-            lines = f.readlines()
-        with open(self._LogFileLoc, "w") as f:
-            for line in lines:
-                if line[0:10] == 'Itteration':
-                    f.write(line)
+class HybridOptimiser(BayesianOptimiser):
+    """
+    Bayesian optimisation followed by a surrogate assisted local refinement. The first
+    Nitterations - hybrid_LocalItterations iterations are exactly as for BayesianOptimiser. After that, the
+    precision of the answer is mostly limited by how finely the gaussian process resolves the objective function
+    around the best point, so the remaining iterations are spent on a trust region search around the incumbent (the
+    probed point which the gaussian process predicts is best). At each step, hybrid_Candidates points within the
+    trust region are screened on the gaussian process, and the one with the highest expected improvement over the
+    incumbent is only simulated if that expected improvement is worth a simulation (see
+    hybrid_MinExpectedImprovement). The trust region grows when the improvement is as expected and shrinks when it
+    isn't, or when no candidate is worth simulating; in that case nothing is simulated. Every simulated point is added
+    to the gaussian process, so the model gets more accurate around the optimum as the refinement goes on.
+    The refinement stops when Nitterations have been run or the trust region is smaller than hybrid_MinTrustRadius.
+    Points in the refinement are simulated one at a time, whatever bayes_BatchSize is.
+    Other options are described in BayesianOptimiser and TopasOptBaseClass.
+
+    :param hybrid_LocalItterations: number of the Nitterations to spend on the local refinement. Default is a
+        quarter of Nitterations
+    :type hybrid_LocalItterations: int, optional
+    :param hybrid_TrustRadius: starting half width of the trust region, as a fraction of the range of each parameter.
+        It never grows larger than this
+    :type hybrid_TrustRadius: float, optional
+    :param hybrid_MinTrustRadius: the refinement stops when the trust region is smaller than this
+    :type hybrid_MinTrustRadius: float, optional
+    :param hybrid_Candidates: number of candidate points to screen on the gaussian process at each step
+    :type hybrid_Candidates: int, optional
+    :param hybrid_MinExpectedImprovement: candidates are only simulated if their expected improvement is more than
+        this fraction of the spread of the objective function values so far
+    :type hybrid_MinExpectedImprovement: float, optional
+    """
 
-        self.RunOptimisation()
+    def __init__(self, hybrid_LocalItterations=None, hybrid_TrustRadius=0.1, hybrid_MinTrustRadius=1e-3,
+                 hybrid_Candidates=1000, hybrid_MinExpectedImprovement=1e-3, **kwds):
+        """
+        init function for HybridOptimiser
+        """
+        self.hybrid_LocalItterations = hybrid_LocalItterations
+        self.hybrid_TrustRadius = hybrid_TrustRadius
+        self.hybrid_MinTrustRadius = hybrid_MinTrustRadius
+        self.hybrid_Candidates = hybrid_Candidates
+        self.hybrid_MinExpectedImprovement = hybrid_MinExpectedImprovement
+        self._TrustRadius = hybrid_TrustRadius
+        super().__init__(**kwds)
+        if self.hybrid_LocalItterations is None:
+            self.hybrid_LocalItterations = self.MaxItterations // 4
+        if not (isinstance(self.hybrid_LocalItterations, (int, np.integer)) and
+                0 <= self.hybrid_LocalItterations < self.MaxItterations):
+            logger.error(f'hybrid_LocalItterations must be an integer >= 0 and less than Nitterations, not '
+                         f'{self.hybrid_LocalItterations}. Quitting')
+            sys.exit(1)
+        if not 0 < self.hybrid_MinTrustRadius <= self.hybrid_TrustRadius:
+            logger.error(f'hybrid_TrustRadius ({self.hybrid_TrustRadius}) and hybrid_MinTrustRadius '
+                         f'({self.hybrid_MinTrustRadius}) must satisfy 0 < hybrid_MinTrustRadius <= '
+                         f'hybrid_TrustRadius. Quitting')
+            sys.exit(1)
+        # kappa should finish decaying at the end of the bayesian search, not the end of the refinement:
+        self.kappa_decay_delay = self.kappa_decay_delay - self.hybrid_LocalItterations
+        self.optimizer.acquisition_function.exploration_decay_delay = self.kappa_decay_delay
+
+    def _GetCheckpointState(self):
+        """
+        As for BayesianOptimiser, plus the size of the trust region
+        """
+        State = super()._GetCheckpointState()
+        State['TrustRadius'] = self._TrustRadius
+        return State
+
+    def _SetCheckpointState(self, State):
+        """
+        As for BayesianOptimiser, plus the size of the trust region
+        """
+        super()._SetCheckpointState(State)
+        self._TrustRadius = State['TrustRadius']
+
+    def _get_incumbent(self):
+        """
+        :returns: the probed point with the best predicted objective function, and that prediction. The prediction
+            is used rather than the simulated value, so that a point which was lucky with the noise is not chosen
+        """
+        mean = self.optimizer._gp.predict(self.optimizer.space.params)
+        best = np.argmax(mean)
+        return self.optimizer.space.params[best], mean[best]
+
+    def _expected_improvement(self, mean, std, IncumbentMean):
+        """
+        Expected improvement over IncumbentMean of points with the predicted mean and std. Note the gaussian process
+        models the negative objective function, so improvement is an increase
+
+        :returns: the expected improvement at each point
+        """
+        std = np.maximum(std, 1e-12)
+        z = (mean - IncumbentMean) / std
+        return (mean - IncumbentMean) * norm.cdf(z) + std * norm.pdf(z)
+
+    def _run_local_refinement(self):
+        """
+        The trust region search described in the class docstring
+        """
+        Bounds = self.optimizer.space.bounds
+        Range = Bounds[:, 1] - Bounds[:, 0]
+        # the bayesian search fits the gaussian process before suggesting each point, so it hasn't seen the last one:
+        self.optimizer._gp.fit(self.optimizer.space.params, self.optimizer.space.target)
+        while self.Itteration < self.MaxItterations and self._TrustRadius >= self.hybrid_MinTrustRadius:
+            Incumbent, IncumbentMean = self._get_incumbent()
+            Steps = self.optimizer._random_state.uniform(-1, 1, size=(self.hybrid_Candidates, len(Incumbent)))
+            Candidates = np.clip(Incumbent + Steps * self._TrustRadius * Range, Bounds[:, 0], Bounds[:, 1])
+            mean, std = self.optimizer._gp.predict(Candidates, return_std=True)
+            ExpectedImprovement = self._expected_improvement(mean, std, IncumbentMean)
+            best = np.argmax(ExpectedImprovement)
+            if ExpectedImprovement[best] <= self.hybrid_MinExpectedImprovement * np.ptp(self.optimizer.space.target):
+                # nothing worth simulating at this scale
+                self._TrustRadius = self._TrustRadius / 2
+                continue
 
+            next_point_to_probe = self.optimizer.space.array_to_params(Candidates[best])
+            self._target_prediction_mean.append(float(mean[best]))
+            self._target_prediction_std.append(float(std[best]))
+            self._plan_primaries(self.Itteration, float(std[best]))
+            target = self.BlackBoxFunction(next_point_to_probe)
+            ImprovementRatio = (target - IncumbentMean) / ExpectedImprovement[best]
+            if ImprovementRatio > 0.75:
+                self._TrustRadius = min(2 * self._TrustRadius, self.hybrid_TrustRadius)
+            elif ImprovementRatio < 0.25:
+                self._TrustRadius = self._TrustRadius / 2
+            if not self._register_point(next_point_to_probe, target):
+                break
+            self.optimizer._gp.fit(self.optimizer.space.params, self.optimizer.space.target)
+            self._plot_diagnostics()
+
+        if self._TrustRadius < self.hybrid_MinTrustRadius:
+            logger.info(f'local refinement converged after {self.Itteration} iterations')
+
+    def _run_optimisation_loop(self):
+        """
+        Run the bayesian search, then the local refinement
+        """
+        TotalItterations = self.MaxItterations
+        self.MaxItterations = TotalItterations - self.hybrid_LocalItterations
+        try:
+            super()._run_optimisation_loop()
+        finally:
+            self.MaxItterations = TotalItterations
+        self._run_local_refinement()
+
+
+class MultiFidelityOptimiser(TopasOptBaseClass):
+    """
+    Optimisation by `successive halving <https://arxiv.org/abs/1502.07943>`_ over a fidelity parameter, such as the
+    number of primary particles. Each round (or bracket) starts with many parameter sets, spread over the parameter
+    space with a Sobol sequence, which are all simulated at the lowest fidelity. Only the best 1/mf_Eta of them are
+    simulated again at the next fidelity, and so on, so most simulations are cheap and only the most promising
+    parameter sets are simulated with high statistics. Rounds are repeated until Nitterations simulations have been
+    run; the first round also includes start_point. All simulations in each step are run at the same time (see
+    Executor).
+
+    The fidelity is passed to GenerateTopasScripts as an extra keyword argument, alongside the parameters being
+    optimised, e.g. GenerateTopasScripts(BaseDirectory, iteration, x=1, y=2, Fidelity=1e5). It is also logged.
+    The best parameter set is chosen from the simulations at the highest fidelity.
+    Other options are described in TopasOptBaseClass.
+
+    :param mf_Fidelities: the fidelities to use, lowest (cheapest) first, e.g. [1e4, 1e5, 1e6] primaries
+    :type mf_Fidelities: list
+    :param mf_FidelityName: name of the keyword argument GenerateTopasScripts receives the fidelity as
+    :type mf_FidelityName: str, optional
+    :param mf_Eta: only the best 1/mf_Eta of the parameter sets at each fidelity go on to the next one
+    :type mf_Eta: int, optional
+    :param mf_InitialPoints: number of parameter sets at the start of each round. The default,
+        mf_Eta ** (len(mf_Fidelities) - 1), leaves one parameter set at the highest fidelity
+    :type mf_InitialPoints: int, optional
+    :param mf_RandomSeed: seed for the Sobol sequence
+    :type mf_RandomSeed: int, optional
+    """
+
+    def __init__(self, mf_Fidelities, mf_FidelityName='Fidelity', mf_Eta=3, mf_InitialPoints=None,
+                 mf_RandomSeed=None, **kwds):
+        """
+        init function for MultiFidelityOptimiser
+        """
+        self.mf_Fidelities = list(mf_Fidelities)
+        self.mf_FidelityName = mf_FidelityName
+        self.mf_Eta = mf_Eta
+        if mf_InitialPoints is None:
+            mf_InitialPoints = mf_Eta ** (len(self.mf_Fidelities) - 1)
+        self.mf_InitialPoints = mf_InitialPoints
+        self.mf_RandomSeed = mf_RandomSeed
+        # the seed actually used, which is checkpointed so that a restart generates the same candidates
+        self._SobolSeed = mf_RandomSeed if mf_RandomSeed is not None else np.random.SeedSequence().entropy
+        self.Fidelity = self.mf_Fidelities[0] if self.mf_Fidelities else None  # fidelity of the current iteration
+        super().__init__(**kwds)
+        if len(self.mf_Fidelities) == 0:
+            logger.error('mf_Fidelities must contain at least one fidelity. Quitting')
+            sys.exit(1)
+        if not (isinstance(self.mf_Eta, (int, np.integer)) and self.mf_Eta >= 2):
+            logger.error(f'mf_Eta must be an integer >= 2, not {self.mf_Eta}. Quitting')
+            sys.exit(1)
+        if self.mf_FidelityName in self.ParameterNames:
+            logger.error(f'mf_FidelityName ({self.mf_FidelityName}) is also one of the ParameterNames. Quitting')
+            sys.exit(1)
+
+    def _CreateVariableDictionary(self, x):
+        """
+        As for the other optimisers, with the current fidelity added
+        """
+        super()._CreateVariableDictionary(x)
+        self.VariableDict[self.mf_FidelityName] = self.Fidelity
+
+    def _GenerateCandidates(self, Sampler, N):
+        """
+        N parameter sets spread over the bounds by the Sobol sequence Sampler
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Sobol warns if N is not a power of 2
+            Samples = Sampler.random(N)
+        return qmc.scale(Samples, self.LowerBounds, self.UpperBounds)
+
+    def _ExtraLogEntries(self):
+        """
+        The fidelity of each iteration
+        """
+        Entry = super()._ExtraLogEntries()
+        Entry[self.mf_FidelityName] = float(self.Fidelity)
+        return Entry
+
+    def _GetBestCandidates(self, ResultsDict):
+        """
+        Low fidelity results are too noisy to pick the best from, so only the highest fidelity is considered
+        """
+        ObjectiveFunction = super()._GetBestCandidates(ResultsDict)
+        Fidelity = np.array(ResultsDict[self.mf_FidelityName])
+        ObjectiveFunction[Fidelity < np.max(Fidelity)] = np.inf
+        return ObjectiveFunction
+
+    def _GetCheckpointState(self):
+        """
+        As for the other optimisers, plus the seed of the Sobol sequence
+        """
+        State = super()._GetCheckpointState()
+        State['SobolSeed'] = self._SobolSeed
+        return State
+
+    def _SetCheckpointState(self, State):
+        """
+        The candidates depend only on the Sobol seed and the results so far, so the optimisation is restarted from
+        the beginning with the logged results replayed instead of simulated (see _StartReplay)
+        """
+        super()._SetCheckpointState(State)
+        self._SobolSeed = State['SobolSeed']
+        self._StartReplay()
+
+    def RunOptimisation(self):
+        """
+        Run rounds of successive halving until Nitterations simulations have been run
+        """
+        self.SetUpDirectoryStructure()
+        self._Renderer.Start()  # before any other threads are started
+        Sampler = qmc.Sobol(d=len(self.ParameterNames), scramble=True, seed=self._SobolSeed)
+
+        Round = 0
+        while self.Itteration < self.MaxItterations:
+            Candidates = self._GenerateCandidates(Sampler, self.mf_InitialPoints)
+            if Round == 0:
+                Candidates[0] = self.StartingValues
+            for Rung, Fidelity in enumerate(self.mf_Fidelities):
+                Candidates = Candidates[:self.MaxItterations - self.Itteration]
+                if len(Candidates) == 0:
+                    break
+                self.Fidelity = Fidelity
+                Results = []
+                while len(Results) < len(Candidates):
+                    OF = self._ReplayIteration(Candidates[len(Results)])
+                    if OF is None:
+                        break
+                    Results.append(OF)
+                ParameterSets = []
+                if len(Results) < len(Candidates):
+                    ParameterSets = self._RunIterationsConcurrently([x for x in Candidates[len(Results):]])
+                for x in ParameterSets:
+                    self.x = x
+                    Results.append(self._EvaluateIteration())
+                    self.Itteration = self.Itteration + 1
+                # the best parameter sets go on to the next fidelity:
+                NumberToKeep = max(1, len(Candidates) // self.mf_Eta)
+                Candidates = Candidates[np.argsort(Results, kind='stable')[:NumberToKeep]]
+            Round = Round + 1
+
+        self._write_final_log_entry()
+        self._FinishPlotting()
+
+
+def EvaluateObjectiveFunctionBatch(OptimisationDirectory, ResultsLocation, Itterations, ReturnUncertainty=False):
+    """
+    Calculate the objective function for many existing results at once, e.g. to study the noise in the objective
+    function or to refit a model to the results of an earlier optimisation. If TopasObjectiveFunction.py in
+    OptimisationDirectory defines TopasObjectiveFunctionBatch(ResultsLocation, iterations), which returns the
+    objective function of each iteration as an array, it is called once for all of them; see
+    TopasOpt.utilities.ExtractDataFromResults for a quick way to write one. Otherwise, TopasObjectiveFunction is called
+    for each iteration in turn.
+
+    :param OptimisationDirectory: location of TopasObjectiveFunction.py
+    :type OptimisationDirectory: str or Path
+    :param ResultsLocation: location of the results
+    :type ResultsLocation: str or Path
+    :param Itterations: the iterations to calculate the objective function for
+    :type Itterations: list of int
+    :param ReturnUncertainty: if True, also return the uncertainty of each objective function, for a
+        TopasObjectiveFunction which returns (ObjectiveFunction, uncertainty) as with bayes_MeasuredNoise. It is NaN
+        where no uncertainty is returned, including for TopasObjectiveFunctionBatch
+    :type ReturnUncertainty: bool, optional
+    :returns: np.ndarray of the objective function values, in the same order as Itterations, followed by an
+        np.ndarray of their uncertainties if ReturnUncertainty is True
+    """
+    _import_from_absolute_path(Path(OptimisationDirectory) / 'TopasObjectiveFunction.py')
+    Itterations = list(Itterations)
+    ResultsLocation = Path(ResultsLocation)
+    BatchObjectiveFunction = getattr(TopasObjectiveFunction, 'TopasObjectiveFunctionBatch', None)
+    if BatchObjectiveFunction is not None:
+        ObjectiveFunctions = np.asarray(BatchObjectiveFunction(ResultsLocation, Itterations))
+        Uncertainties = np.full(ObjectiveFunctions.shape, np.nan)
+    else:
+        ObjectiveFunctions = np.zeros(len(Itterations))
+        Uncertainties = np.full(len(Itterations), np.nan)
+        for i, Itteration in enumerate(Itterations):
+            OF = TopasObjectiveFunction.TopasObjectiveFunction(ResultsLocation, Itteration)
+            if np.ndim(OF) > 0:
+                # the objective function also returned its uncertainty
+                OF, Uncertainties[i] = OF
+            ObjectiveFunctions[i] = OF
+    if ReturnUncertainty:
+        return ObjectiveFunctions, Uncertainties
+    return ObjectiveFunctions
@@ -276,3 +276,182 @@ class generate_topas_script_generator:
         f2 = open(outputFile, "w+")
         for line in TopasScriptGenerator:
             f2.writelines(line)
+
+
+def _get_string_parameter_value(line, ParameterName):
+    """
+    If line sets the string parameter ParameterName (e.g. s:Sc/Scorer/OutputFile = "../Results/Dose_itt_1"), return
+    the file name it is set to (e.g. Dose_itt_1). Otherwise, return None.
+    """
+    match = re.match(r'\s*s:\S+/' + ParameterName + r'\s*=\s*(.+)', line.split('#', 1)[0], re.IGNORECASE)
+    if match is None:
+        return None
+    value = match.group(1).strip().strip('"').strip("'").strip()
+    return os.path.split(value)[1]
+
+
+def find_script_outputs(TopasScript):
+    """
+    Find the files written by a script, from its OutputFile parameters.
+
+    :param TopasScript: a script returned by GenerateTopasScripts, as a list of lines
+    :type TopasScript: list
+    :returns: OutputFiles: list of output file names without extensions, e.g. ['coll_PhaseSpace_itt_1']
+    """
+    OutputFiles = []
+    for line in TopasScript:
+        OutputFile = _get_string_parameter_value(line, 'OutputFile')
+        if OutputFile is not None:
+            OutputFiles.append(OutputFile)
+    return OutputFiles
+
+
+def find_script_dependencies(TopasScripts):
+    """
+    Work out which scripts must finish before each script can run. Script j depends on script i if one of the
+    PhaseSpaceFileName parameters in j reads a file written by an OutputFile parameter in i.
+
+    :param TopasScripts: the scripts returned by GenerateTopasScripts; each script is a list of lines
+    :type TopasScripts: list
+    :returns: Dependencies: a list with one set per script, containing the indices of the scripts it depends on
+    """
+    Outputs = {}  # file name: index of the script which writes it
+    for i, script in enumerate(TopasScripts):
+        for OutputFile in find_script_outputs(script):
+            Outputs[OutputFile] = i
+
+    Dependencies = []
+    for j, script in enumerate(TopasScripts):
+        ScriptDependencies = set()
+        for line in script:
+            InputFile = _get_string_parameter_value(line, 'PhaseSpaceFileName')
+            if InputFile is not None and InputFile in Outputs and not Outputs[InputFile] == j:
+                ScriptDependencies.add(Outputs[InputFile])
+        Dependencies.append(ScriptDependencies)
+    return Dependencies
+
+
+def get_script_run_order(TopasScripts):
+    """
+    Group scripts into stages which can be run one after the other. Scripts in the same stage do not depend on each
+    other, so they can run at the same time; every script runs in a later stage than the scripts it depends on.
+
+    :param TopasScripts: the scripts returned by GenerateTopasScripts; each script is a list of lines
+    :type TopasScripts: list
+    :returns: RunOrder: a list of stages, each of which is a list of script indices
+    """
+    Dependencies = find_script_dependencies(TopasScripts)
+    RunOrder = []
+    Scheduled = set()
+    while len(Scheduled) < len(TopasScripts):
+        Stage = [i for i in range(len(TopasScripts))
+                 if i not in Scheduled and Dependencies[i].issubset(Scheduled)]
+        if not Stage:
+            # circular dependency; this shouldn't be possible, but fall back to running in the order given
+            logger.warning('could not resolve the dependencies between topas scripts; running them sequentially')
+            Stage = [min(set(range(len(TopasScripts))) - Scheduled)]
+        RunOrder.append(Stage)
+        Scheduled.update(Stage)
+    return RunOrder
+
+
+def set_number_of_threads(TopasScript, NumberOfThreads):
+    """
+    Set i:Ts/NumberOfThreads in a script, adding the parameter if it isn't already there.
+
+    :param TopasScript: a script returned by GenerateTopasScripts, as a list of lines. It is modified in place
+    :type TopasScript: list
+    :param NumberOfThreads: number of threads this script should use
+    :type NumberOfThreads: int
+    """
+    ThreadLine = 'i:Ts/NumberOfThreads = ' + str(NumberOfThreads)
+    FoundThreadLine = False
+    for i, line in enumerate(TopasScript):
+        if re.match(r'\s*i:Ts/NumberOfThreads\s*=', line, re.IGNORECASE):
+            TopasScript[i] = ThreadLine
+            FoundThreadLine = True
+    if not FoundThreadLine:
+        TopasScript.append(ThreadLine)
+
+
+def has_mergeable_outputs(TopasScript):
+    """
+    Check whether the results of a script can be merged after splitting it with split_topas_script, i.e. every
+    OutputFile in it belongs to a binned scorer (not a phase space) with OutputType "binary". Scorers default to csv
+    output in topas, so a scorer which doesn't set OutputType can't be merged.
+
+    :param TopasScript: a script returned by GenerateTopasScripts, as a list of lines
+    :type TopasScript: list
+    :returns: True if every output of the script can be merged with MergeBinnedResults
+    """
+    ScorerPattern = re.compile(r'\s*s\w*:Sc/([^/\s]+)/(OutputFile|OutputType|Quantity)\s*=\s*(.+)', re.IGNORECASE)
+    Scorers = {}
+    for line in TopasScript:
+        code = line.split('#', 1)[0]
+        match = ScorerPattern.match(code)
+        if match is not None:
+            Value = match.group(3).strip().strip('"').strip("'").strip()
+            Scorers.setdefault(match.group(1), {})[match.group(2).lower()] = Value
+        elif _get_string_parameter_value(line, 'OutputFile') is not None:
+            return False  # an output file which isn't written by a scorer
+    for Scorer in Scorers.values():
+        if 'outputfile' not in Scorer:
+            continue
+        if Scorer.get('outputtype', '').lower() != 'binary' or Scorer.get('quantity', '').lower() == 'phasespace':
+            return False
+    return True
+
+
+def split_topas_script(TopasScript, NumberOfJobs):
+    """
+    Split a script into NumberOfJobs scripts which can run at the same time and together simulate the same histories.
+    Each job simulates 1/NumberOfJobs of the histories of every source (NumberOfHistoriesInRun), with its own
+    random seed (Ts/Seed) and its own output files, named by adding _split_k before the _itt_N suffix
+    (e.g. WaterTank_itt_3 -> WaterTank_split_0_itt_3).
+
+    :param TopasScript: a script returned by GenerateTopasScripts, as a list of lines
+    :type TopasScript: list
+    :param NumberOfJobs: number of jobs to split the script into
+    :type NumberOfJobs: int
+    :returns: Scripts: a list of NumberOfJobs scripts, and Histories: the number of histories each one simulates,
+        summed over all sources. Histories is None if the script doesn't set NumberOfHistoriesInRun, in which case
+        it can't be split
+    """
+    HistoriesPattern = re.compile(r'(\s*i\w*:So/\S+/NumberOfHistoriesInRun\s*=\s*)(\d+)(.*)', re.IGNORECASE)
+    SeedPattern = re.compile(r'\s*i:Ts/Seed\s*=\s*(\d+)', re.IGNORECASE)
+    Seed = 1  # the topas default
+    for line in TopasScript:
+        match = SeedPattern.match(line.split('#', 1)[0])
+        if match is not None:
+            Seed = int(match.group(1))
+    if not any(HistoriesPattern.match(line.split('#', 1)[0]) for line in TopasScript):
+        return [list(TopasScript)], None
+
+    Scripts = []
+    Histories = []
+    for k in range(NumberOfJobs):
+        Script = []
+        JobHistories = 0
+        for line in TopasScript:
+            code = line.split('#', 1)[0]
+            match = HistoriesPattern.match(code)
+            OutputFile = _get_string_parameter_value(line, 'OutputFile')
+            if match is not None:
+                # share out the histories, with the remainder going to the first jobs
+                Total = int(match.group(2))
+                n = Total // NumberOfJobs + (1 if k < Total % NumberOfJobs else 0)
+                JobHistories = JobHistories + n
+                line = match.group(1) + str(n) + match.group(3)
+            elif SeedPattern.match(code) is not None:
+                continue  # replaced below
+            elif OutputFile is not None:
+                IterationTag = re.search(r'_itt_\d+$', OutputFile)
+                Insert = IterationTag.start() if IterationTag is not None else len(OutputFile)
+                SplitOutputFile = OutputFile[:Insert] + f'_split_{k}' + OutputFile[Insert:]
+                Position = line.rfind(OutputFile)
+                line = line[:Position] + SplitOutputFile + line[Position + len(OutputFile):]
+            Script.append(line)
+        Script.append(f'i:Ts/Seed = {Seed + k}')
+        Scripts.append(Script)
+        Histories.append(JobHistories)
+    return Scripts, Histories
@@ -2,6 +2,7 @@
 Supporting classes and functions that don't belong anywhere else in particular
 """
 from bayes_opt.logger import JSONLogger
+from bayes_opt import acquisition
 import sys
 sys.path.append('.')
 import os, sys
@@ -9,10 +10,25 @@ import logging
 import numpy as np
 import topas2numpy as tp
 import matplotlib.pyplot as plt
-from scipy.interpolate import RegularGridInterpolator
+from scipy import stats
+from scipy.stats import qmc
+from scipy.optimize import minimize
+from scipy.linalg import solve_triangular, cholesky, cho_solve
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern, RBF
 from pathlib import Path
 import stat
 import glob
+import hashlib
+import json
+import re
+import shutil
+import multiprocessing
+import atexit
+import pickle
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 plt.interactive(False)
 
@@ -64,6 +80,237 @@ class newJSONLogger(JSONLogger):
         super(JSONLogger, self).__init__()
 
 
+class MemoryMappedBinnedResult(tp.BinnedResult):
+    """
+    A drop in replacement for topas2numpy.BinnedResult for large binary results files. The header is read as usual,
+    but the .bin file is memory mapped rather than read into memory, so a statistic is only read from disk when (and
+    where) it is used. A unit conversion is set with Scale and only applied when a statistic is read with
+    GetStatistic, rather than by making a scaled copy of every statistic in the file.
+    ASCII (.csv) results can't be memory mapped, so they are read into memory as usual.
+
+    Basic use::
+
+        Result = MemoryMappedBinnedResult('Results/WaterTank.bin', Scale=1e6)  # Gy to uGy
+        Sum = Result.GetStatistic('Sum')  # reads and scales the Sum only
+        Peak = Result.data['Sum'].max()  # read only, unscaled view of the file; nothing is copied
+
+    :param filepath: location of the .bin (or .csv) file. The header of a .bin file is read from filepath + 'header'
+    :type filepath: str or Path
+    :param Scale: factor GetStatistic multiplies the data by, e.g. to convert units
+    :type Scale: float, optional
+    """
+
+    def __init__(self, filepath, Scale=1):
+        """
+        init method for MemoryMappedBinnedResult. input options are in class docstring
+        """
+        self.path = str(filepath)
+        self.Scale = Scale
+        if os.path.splitext(self.path)[1] == '.csv':
+            self._read_ascii()
+        else:
+            self._read_binary()
+
+    def _read_binary(self):
+        """
+        Read the header and memory map the data. topas writes the statistics interleaved, and each one in Fortran
+        order, so every statistic is a strided view of the file
+        """
+        with open(self.path + 'header') as f_header:
+            self._read_header(f_header.read())
+        DataShape = [dim.n_bins for dim in self.dimensions]
+        Data = np.memmap(self.path, dtype=np.float64, mode='r').reshape((-1, len(self.statistics)))
+        self.data = {stat: Data[:, i].reshape(DataShape, order='F') for i, stat in enumerate(self.statistics)}
+
+    def GetStatistic(self, Statistic='Sum', out=None):
+        """
+        Read one statistic into memory, multiplied by Scale
+
+        :param Statistic: the statistic to read, e.g. 'Sum', 'Mean' or 'Standard_Deviation'. Must be one of
+            self.statistics
+        :type Statistic: str, optional
+        :param out: if supplied, the result is written into this array, which must have the shape of the data,
+            instead of a new one
+        :type out: np.ndarray, optional
+        :returns: the scaled statistic
+        """
+        if Statistic not in self.data:
+            raise KeyError(f'{Statistic} was not scored in {self.path}; available statistics are {self.statistics}')
+        return np.asarray(np.multiply(self.data[Statistic], self.Scale, out=out))
+
+
+def _GetBinnedResultChunks(Shape, ChunkBytes):
+    """
+    Split data of the given shape into chunks of about ChunkBytes. The chunks are along the last non singleton
+    dimension; in topas's (Fortran) ordering, each chunk is then one contiguous part of the file
+
+    :returns: list of index tuples, one per chunk
+    """
+    Axis = ([axis for axis, n in enumerate(Shape) if n > 1] or [len(Shape) - 1])[-1]
+    Step = max(1, int(ChunkBytes // (8 * np.prod(Shape) // Shape[Axis])))
+    return [(slice(None),) * Axis + (slice(Start, Start + Step),) for Start in range(0, Shape[Axis], Step)]
+
+
+def SumBinnedResults(Results, Statistic='Sum', out=None, Threads=1, ChunkBytes=64 * 2 ** 20):
+    """
+    Sum one statistic of several results files, e.g. the outputs of a job split into many parts, into a single
+    float64 array. Each file is read a chunk at a time; the chunk is scaled (see MemoryMappedBinnedResult) into a
+    small buffer and added to out in place, so however many files there are, only out plus one chunk per thread is
+    held in memory. With Threads > 1 several files are read at once, which helps when reading is limited by disk
+    latency (e.g. network file systems) rather than bandwidth; the order the files are added in, and so the last
+    few bits of the sum, then varies.
+    Singleton dimensions of the data are broadcast, so out may be larger along them (as in WaterTankData).
+
+    :param Results: the results to sum, which must all have the same binning
+    :type Results: list of MemoryMappedBinnedResult
+    :param Statistic: the statistic to sum
+    :type Statistic: str, optional
+    :param out: float64 array to add the results to. If None, a new one is created
+    :type out: np.ndarray, optional
+    :param Threads: number of files to read at the same time
+    :type Threads: int, optional
+    :param ChunkBytes: approximate size of each chunk
+    :type ChunkBytes: int, optional
+    :returns: out
+    """
+    Shape = Results[0].data[Statistic].shape
+    if out is None:
+        out = np.zeros(Shape)
+    Chunks = _GetBinnedResultChunks(Shape, ChunkBytes)
+    Locks = [threading.Lock() for Chunk in Chunks]
+
+    def AddResult(Result):
+        """
+        add one result to out, a chunk at a time
+        """
+        if Result.data[Statistic].shape != Shape:
+            raise ValueError(f'{Result.path} has shape {Result.data[Statistic].shape}, but {Results[0].path} '
+                             f'has shape {Shape}')
+        Buffer = None
+        for Chunk, Lock in zip(Chunks, Locks):
+            Data = Result.data[Statistic][Chunk]
+            if Buffer is None or Buffer.shape != Data.shape:
+                Buffer = np.empty(Data.shape)
+            np.multiply(Data, getattr(Result, 'Scale', 1), out=Buffer)
+            with Lock:
+                out[Chunk] += Buffer
+
+    if Threads > 1:
+        with ThreadPoolExecutor(max_workers=Threads) as Pool:
+            list(Pool.map(AddResult, Results))
+    else:
+        for Result in Results:
+            AddResult(Result)
+    return out
+
+
+def MergeBinnedResults(InputFiles, OutputFile, Histories, ChunkBytes=64 * 2 ** 20):
+    """
+    Combine the binary results files written by the parts of a job split into many parts (see
+    TopasScriptGenerator.split_topas_script) into the file the whole job would have written. Each statistic topas
+    can score is combined as follows:
+
+    - Sum, Count_in_Bin and Histories_with_Scorer_Active are added
+    - Min and Max are the elementwise min and max
+    - Mean is the mean of the parts, weighted by their number of histories
+    - Second_Moment, Variance and Standard_Deviation are combined with the
+      `parallel algorithm <https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm>`_
+      of Chan et al. This assumes that, as in topas, Second_Moment is the sum of squared differences from the mean
+      per history and Variance = Second_Moment / (histories - 1)
+
+    As in SumBinnedResults, the input files are memory mapped and combined a chunk at a time, straight into the
+    memory mapped output, so only a few chunks are held in memory however many parts there are.
+    The header of the first input file is copied to OutputFile + 'header'.
+
+    :param InputFiles: the .bin files to combine, which must all have the same binning and statistics
+    :type InputFiles: list of str or Path
+    :param OutputFile: the .bin file to write
+    :type OutputFile: str or Path
+    :param Histories: the number of histories simulated by each part, in the same order as InputFiles
+    :type Histories: list of int
+    :param ChunkBytes: approximate size of each chunk
+    :type ChunkBytes: int, optional
+    """
+    Results = [MemoryMappedBinnedResult(InputFile) for InputFile in InputFiles]
+    Statistics = Results[0].statistics
+    Shape = Results[0].data[Statistics[0]].shape
+    for Result in Results[1:]:
+        if Result.statistics != Statistics or Result.data[Statistics[0]].shape != Shape:
+            raise ValueError(f'{Result.path} has different binning or statistics to {Results[0].path}')
+    Added = [Statistic for Statistic in ['Sum', 'Count_in_Bin', 'Histories_with_Scorer_Active']
+             if Statistic in Statistics]
+    Moments = [Statistic for Statistic in ['Mean', 'Second_Moment', 'Variance', 'Standard_Deviation']
+               if Statistic in Statistics]
+    Unknown = [Statistic for Statistic in Statistics if Statistic not in Added + Moments + ['Min', 'Max']]
+    if Unknown:
+        raise ValueError(f'Don\'t know how to combine {Unknown} in {Results[0].path}')
+    if Moments and not ('Mean' in Statistics or 'Sum' in Statistics):
+        raise ValueError(f'{Results[0].path} has neither Mean nor Sum, so the variance can\'t be combined')
+    SpreadStatistic = next((Statistic for Statistic in ['Second_Moment', 'Variance', 'Standard_Deviation']
+                            if Statistic in Statistics), None)
+
+    # topas writes the statistics interleaved, each one in Fortran order:
+    Output = np.memmap(OutputFile, dtype=np.float64, mode='w+', shape=(int(np.prod(Shape)), len(Statistics)))
+    Merged = {Statistic: Output[:, i].reshape(Shape, order='F') for i, Statistic in enumerate(Statistics)}
+
+    def GetMeanAndM2(Result, n, Chunk):
+        """
+        the mean and sum of squared differences from the mean (None if there is no spread statistic) of one
+        part, in one chunk
+        """
+        if 'Mean' in Statistics:
+            Mean = np.array(Result.data['Mean'][Chunk])
+        else:
+            Mean = Result.data['Sum'][Chunk] / n
+        if SpreadStatistic == 'Second_Moment':
+            M2 = np.array(Result.data['Second_Moment'][Chunk])
+        elif SpreadStatistic == 'Variance':
+            M2 = Result.data['Variance'][Chunk] * (n - 1)
+        elif SpreadStatistic == 'Standard_Deviation':
+            M2 = Result.data['Standard_Deviation'][Chunk] ** 2 * (n - 1)
+        else:
+            M2 = None
+        return Mean, M2
+
+    for Chunk in _GetBinnedResultChunks(Shape, ChunkBytes):
+        for Statistic in Added:
+            Total = np.array(Results[0].data[Statistic][Chunk])
+            for Result in Results[1:]:
+                Total += Result.data[Statistic][Chunk]
+            Merged[Statistic][Chunk] = Total
+        for Statistic, Combine in [('Min', np.minimum), ('Max', np.maximum)]:
+            if Statistic in Statistics:
+                Extreme = np.array(Results[0].data[Statistic][Chunk])
+                for Result in Results[1:]:
+                    Combine(Extreme, Result.data[Statistic][Chunk], out=Extreme)
+                Merged[Statistic][Chunk] = Extreme
+        if Moments:
+            # running count, mean and M2, updated one part at a time (Chan et al.)
+            N = float(Histories[0])
+            Mean, M2 = GetMeanAndM2(Results[0], N, Chunk)
+            for Result, n in zip(Results[1:], Histories[1:]):
+                PartMean, PartM2 = GetMeanAndM2(Result, float(n), Chunk)
+                Delta = PartMean - Mean
+                Mean += Delta * (n / (N + n))
+                if M2 is not None:
+                    M2 += PartM2 + Delta ** 2 * (N * n / (N + n))
+                N = N + n
+            if 'Mean' in Statistics:
+                Merged['Mean'][Chunk] = Mean
+            if M2 is not None:
+                Variance = M2 / max(N - 1, 1)
+                for Statistic, Value in [('Second_Moment', M2), ('Variance', Variance),
+                                         ('Standard_Deviation', np.sqrt(Variance))]:
+                    if Statistic in Statistics:
+                        Merged[Statistic][Chunk] = Value
+    Output.flush()
+    del Output, Merged
+    with open(str(InputFiles[0]) + 'header') as f_header:
+        Header = f_header.read()
+    with open(str(OutputFile) + 'header', 'w') as f_header:
+        f_header.write(Header.replace(Path(InputFiles[0]).stem, Path(OutputFile).stem))
+
+
 class WaterTankData:
     """
     Read in and analyse a series of topas scoring files in a rectangular phantom (the water tank).
@@ -92,9 +339,19 @@ class WaterTankData:
     :type AbsDepthDose: bool
     :param verbose: if True, various messages are printed
     :type verbose: bool
+    :param ReadThreads: number of files to read at the same time when there are several. See SumBinnedResults
+    :type ReadThreads: int, optional
+    :param DoseCube: if supplied, this is used as the DoseCube instead of summing the files, whose headers are still
+        read to set up the coordinate system. This is how ReferenceDataCache restores saved references
+    :type DoseCube: np.ndarray, optional
     """
 
-    def __init__(self, AnalysisPath, FileToAnalyse, AbsDepthDose=False, verbose=False):
+    _InterpolationCache = {}  # see _GetInterpolationWeights
+    _InterpolationCacheSize = 32
+    _InterpolationCacheLock = threading.Lock()
+
+    def __init__(self, AnalysisPath, FileToAnalyse, AbsDepthDose=False, verbose=False, ReadThreads=1,
+                 DoseCube=None):
         """
         :param AnalysisPath: Path where files are located
         :type AnalysisPath: string
@@ -107,6 +364,8 @@ class WaterTankData:
         self.AnalysisPath = AnalysisPath
         self.FileToAnalyse = FileToAnalyse
         self.verbose = verbose
+        self.ReadThreads = ReadThreads
+        self.DoseCube = DoseCube
         # the below lists all get appended to as data is read in
         self.Xangles = []
         self.Yangles = []
@@ -141,7 +400,8 @@ class WaterTankData:
 
     def _ReadDoseFilesIntoDoseCube(self):
         """
-        read all dose files into an integral 'dose cube' that can be queried later
+        read all dose files into an integral 'dose cube' that can be queried later. The files are only opened here;
+        their data are summed in one pass by __GenerateDoseCubeData
         """
         self.MultiFileMode = True  # overwrite below if not
         if isinstance(self.FileToAnalyse, str):
@@ -149,6 +409,7 @@ class WaterTankData:
             self.FileToAnalyse = list([self.FileToAnalyse])
             self.MultiFileMode = False
 
+        Results = []
         for file in self.FileToAnalyse:
 
             self.CurrentFile = file
@@ -158,13 +419,14 @@ class WaterTankData:
 
             self.__ReadInDoseFiles()
             self.__ConstructCoordinateSystem()
+            Results.append(self.dose)
 
-            # generate the data for plots:
-            self.__GenerateDoseCubeData()
+        # generate the data for plots:
+        self.__GenerateDoseCubeData(Results)
 
     def __ReadInDoseFiles(self):
         """
-        read in the dose file using topas2numpy
+        read in the dose file using MemoryMappedBinnedResult, so only the Sum is read into memory
         """
         try:
             FileLocation = str(Path(self.AnalysisPath) / self.CurrentFile)
@@ -172,7 +434,7 @@ class WaterTankData:
                 FileLocation = FileLocation + '.bin'
                 if not os.path.isfile(FileLocation):
                     logging.error(f'Could not locate file: \n{FileLocation}')
-            self.dose = tp.BinnedResult(FileLocation)
+            self.dose = MemoryMappedBinnedResult(FileLocation)
             # convert dose units:
             if self.dose.unit == 'Gy':
                 DoseConverter = 1e6
@@ -188,15 +450,12 @@ class WaterTankData:
             else:
                 DoseConverter = 1
                 logging.warning('unable to detect dose unit; reading in without conversion')
-            self.dose.data['Sum'] = self.dose.data['Sum'] * DoseConverter
+            self.dose.Scale = DoseConverter  # applied when the data are read
 
         except FileNotFoundError as e:
             logging.warning(f'{bcolors.FAIL}Could not find one of the input files or file header: {self.CurrentFile}{bcolors.ENDC}\n')
             raise e
 
-        if np.max(self.dose.data['Sum'])<1e-16:
-            logging.error(f'there is no data in the dose file {FileLocation}')
-
     def __ConstructCoordinateSystem(self):
         """
         Build a coordinate system based off the dose cube information.
@@ -256,28 +515,28 @@ class WaterTankData:
             elif dim_check_ind[2]:
                 self.z = np.array([-self.z, self.z])
 
-    def __GenerateDoseCubeData(self):
+    def __GenerateDoseCubeData(self, Results):
         """
-        Read in all the data into a dose cube so we can query it later
+        Sum all the data into a dose cube so we can query it later. The files are streamed into the cube by
+        SumBinnedResults, so only the cube itself is held in memory; singleton dimensions are broadcast over the
+        expanded (mirrored) dimension.
 
         at the moment, this is done without interpolation, so there is an explicit assumption
         that each read in file has the same coordinate system (which is true for every use case I can currently envisage)
+
+        :param Results: the opened results files
+        :type Results: list of MemoryMappedBinnedResult
         """
-        try:
-            test = self.DoseCube
-        except AttributeError:
-            # the first time this function is called the data won't exist yet so it must be created
-            self.DoseCube = np.zeros([self.x.size, self.y.size, self.z.size])
-        Dose3D = self.dose.data['Sum']
-        if (self.DataSize < 2).any():
-            # we also need to expand the dimensinos
-            if self.DataSize[0] < 2:
-                Dose3D = np.stack([Dose3D.squeeze(),Dose3D.squeeze()], 0)
-            elif self.DataSize[1] < 2:
-                Dose3D = np.stack([Dose3D.squeeze(),Dose3D.squeeze()], 1)
-            elif self.DataSize[2] < 2:
-                Dose3D = np.stack([Dose3D.squeeze(),Dose3D.squeeze()], 2)
-        self.DoseCube = np.add(self.DoseCube, Dose3D)
+        if self.DoseCube is not None:
+            self.DoseCube = np.asarray(self.DoseCube, dtype=float)
+            if not self.DoseCube.shape == (self.x.size, self.y.size, self.z.size):
+                raise ValueError(f'the supplied DoseCube has shape {self.DoseCube.shape}, but the files have shape '
+                                 f'{(self.x.size, self.y.size, self.z.size)}')
+            return
+        self.DoseCube = np.zeros([self.x.size, self.y.size, self.z.size])
+        SumBinnedResults(Results, 'Sum', out=self.DoseCube, Threads=self.ReadThreads)
+        if np.max(self.DoseCube) < 1e-16:
+            logging.error(f'there is no data in the dose files {self.FileToAnalyse}')
 
     def __GenerateDepthDoseData(self):
         """
@@ -328,6 +587,11 @@ class WaterTankData:
         Extract data from the dose cube at positions Xpts, Ypts, Zpts
         Each of these is an array or list, and they must be the same shape (they can be of any dimensionality as
         they are flattened inside the function). The data is returned in the same shape as the input points.
+        Points between voxel centres are linearly interpolated, and points outside the dose cube are 0 (as for
+        scipy's RegularGridInterpolator). Along any axis where every point lies on a voxel centre, e.g. profiles and
+        depth doses through the voxel centres, the voxels are read directly rather than interpolated. The indices and
+        weights for each set of points are cached, since objective functions usually extract the same points from
+        every result.
 
         :param Xpts: x points
         :param Ypts: y points
@@ -339,23 +603,89 @@ class WaterTankData:
         assert Xpts.shape == Ypts.shape == Zpts.shape
         InputShape = Xpts.shape
         # convert to array and flatten
-        Xpts = np.array(Xpts).flatten()
-        Ypts = np.array(Ypts).flatten()
-        Zpts = np.array(Zpts).flatten()
-
-        try:
-            test = self.DoseCubeInterpolator
-        except AttributeError:
-            self.DoseCubeInterpolator = RegularGridInterpolator((self.x, self.y, self.z), self.DoseCube,
-                                                                bounds_error=False, fill_value=0)
-            # interpolation function
-        pts = np.stack([Xpts, Ypts, Zpts])
-        pts = pts.T  # take the tranpose to get the dimnesions right
-        InterpolatedData = self.DoseCubeInterpolator(pts)
-        InterpolatedData = np.reshape(InterpolatedData,InputShape)
+        Xpts = np.array(Xpts, dtype=float).flatten()
+        Ypts = np.array(Ypts, dtype=float).flatten()
+        Zpts = np.array(Zpts, dtype=float).flatten()
+
+        Indices, Weights, InBounds = self._GetInterpolationWeights(Xpts, Ypts, Zpts)
+        InterpolatedData = np.zeros(Xpts.shape)
+        # sum over the corners of the voxel containing each point; axes with no weight above the lower corner
+        # only need the lower corner:
+        Offsets = [(0, 1) if AxisWeights is not None else (0,) for AxisWeights in Weights]
+        for dx in Offsets[0]:
+            for dy in Offsets[1]:
+                for dz in Offsets[2]:
+                    Corner = self.DoseCube[Indices[0] + dx, Indices[1] + dy, Indices[2] + dz]
+                    for AxisWeights, Offset in zip(Weights, (dx, dy, dz)):
+                        if AxisWeights is not None:
+                            Corner = Corner * (AxisWeights if Offset else 1 - AxisWeights)
+                    InterpolatedData = InterpolatedData + Corner
+        if InBounds is not None:
+            InterpolatedData[~InBounds] = 0
+        InterpolatedData = np.reshape(InterpolatedData, InputShape)
 
         return InterpolatedData
 
+    def _GetInterpolationWeights(self, Xpts, Ypts, Zpts):
+        """
+        For each axis, find the voxel centre below each point and the weight of the voxel centre above it.
+        Results are cached in WaterTankData._InterpolationCache, which is shared between instances so that e.g. the
+        ground truth and the current result can reuse each other's weights.
+
+        :returns: Indices: the lower voxel index on each axis, Weights: the weight of the upper voxel on each axis, or
+            None where every point is on a voxel centre, and InBounds: a mask of the points inside the dose cube, or
+            None if they all are
+        """
+        Key = hashlib.sha1()
+        for Axis in (self.x, self.y, self.z, Xpts, Ypts, Zpts):
+            Key.update(np.ascontiguousarray(Axis, dtype=float).tobytes())
+            Key.update(b'|')
+        Key = Key.hexdigest()
+        with WaterTankData._InterpolationCacheLock:
+            if Key in WaterTankData._InterpolationCache:
+                WaterTankData._InterpolationCache[Key] = WaterTankData._InterpolationCache.pop(Key)  # most recent
+                return WaterTankData._InterpolationCache[Key]
+
+        Indices = []
+        Weights = []
+        InBounds = np.ones(Xpts.shape, dtype=bool)
+        for Grid, Points in zip((self.x, self.y, self.z), (Xpts, Ypts, Zpts)):
+            Grid = np.asarray(Grid, dtype=float).ravel()
+            InBounds &= (Points >= Grid[0]) & (Points <= Grid[-1])
+            if Grid.size < 2:
+                Indices.append(np.zeros(Points.shape, dtype=np.intp))
+                Weights.append(None)
+                continue
+            Spacing = np.diff(Grid)
+            if np.allclose(Spacing, Spacing[0]):
+                # uniform grid, so the voxel can be calculated directly
+                Position = (Points - Grid[0]) / Spacing[0]
+            else:
+                Lower = np.clip(np.searchsorted(Grid, Points, side='right') - 1, 0, Grid.size - 2)
+                Position = Lower + (Points - Grid[Lower]) / Spacing[Lower]
+            # snap points within rounding error of a voxel centre onto it:
+            Nearest = np.rint(Position)
+            OnGrid = np.abs(Position - Nearest) < 1e-9
+            Position = np.where(OnGrid, Nearest, Position)
+            Position = np.where(InBounds, Position, 0)  # out of bounds points are set to 0 afterwards
+            Lower = np.clip(np.floor(Position).astype(np.intp), 0, Grid.size - 2)
+            AxisWeights = np.clip(Position - Lower, 0, 1)
+            if np.all(AxisWeights == 0):
+                AxisWeights = None
+            elif np.all((AxisWeights == 0) | (AxisWeights == 1)):
+                # on grid, but some points are on the last voxel centre
+                Lower = Lower + AxisWeights.astype(np.intp)
+                AxisWeights = None
+            Indices.append(Lower)
+            Weights.append(AxisWeights)
+        Result = (Indices, Weights, None if np.all(InBounds) else InBounds)
+
+        with WaterTankData._InterpolationCacheLock:
+            WaterTankData._InterpolationCache[Key] = Result
+            while len(WaterTankData._InterpolationCache) > WaterTankData._InterpolationCacheSize:
+                WaterTankData._InterpolationCache.pop(next(iter(WaterTankData._InterpolationCache)))
+        return Result
+
     def Plot_DosePlanes(self, AddColorBar=False): # pragma: no cover
         """
         Use the DoseCube data to create a plot through each of the cardinal planes.
@@ -602,14 +932,205 @@ def compare_multiple_results(BinFiles, abs_dose=False, custom_legend_names=None)
     plt.show()
 
 
+def ExtractDataFromResults(ResultsFiles, Queries, Threads=1, **kwds):
+    """
+    Read several results files, e.g. all the results of an optimisation, and extract the same points from each one
+    (see WaterTankData.ExtractDataFromDoseCube). Files are read Threads at a time, and each one is discarded once its
+    data has been extracted, so only the extracted data are kept in memory. The data for each query are stacked with
+    one row per file, so objective functions can be calculated for every file at once with numpy.
+
+    Basic use::
+
+        Profile = (GroundTruth.x, np.zeros(GroundTruth.x.shape), np.zeros(GroundTruth.x.shape))
+        DepthDose = (np.zeros(GroundTruth.z.shape), np.zeros(GroundTruth.z.shape), GroundTruth.z)
+        Profiles, DepthDoses = ExtractDataFromResults(ResultsFiles, [Profile, DepthDose], Threads=4)
+        Profiles = Profiles * 100 / Profiles.max(axis=1, keepdims=True)  # normalise every profile at once
+
+    :param ResultsFiles: the results files to read
+    :type ResultsFiles: list of str or Path
+    :param Queries: the points to extract, as a list of (Xpts, Ypts, Zpts)
+    :type Queries: list
+    :param Threads: number of files to read at the same time
+    :type Threads: int, optional
+    :param kwds: any other WaterTankData options
+    :returns: a list with one array per query, of shape (number of files,) + the shape of the query points
+    """
+
+    def ExtractData(ResultsFile):
+        """
+        read one file and extract every query from it
+        """
+        path, file = os.path.split(str(ResultsFile))
+        Results = WaterTankData(path, file, **kwds)
+        return [Results.ExtractDataFromDoseCube(*Query) for Query in Queries]
+
+    if Threads > 1:
+        with ThreadPoolExecutor(max_workers=Threads) as Pool:
+            ExtractedData = list(Pool.map(ExtractData, ResultsFiles))
+    else:
+        ExtractedData = [ExtractData(ResultsFile) for ResultsFile in ResultsFiles]
+    return [np.stack([FileData[i] for FileData in ExtractedData]) if ExtractedData
+            else np.zeros((0,) + np.shape(Query[0])) for i, Query in enumerate(Queries)]
+
+
+def _get_binary_log_locations(LogFileLoc):
+    """
+    The binary log is stored next to the text log: OptimisationLogs.bin holds the values as rows of float64, and
+    OptimisationLogs.bin.json holds the column names
+    """
+    DataLoc = Path(LogFileLoc).with_suffix('.bin')
+    return DataLoc, Path(str(DataLoc) + '.json')
+
+
+def FormatLogEntry(Entry):
+    """
+    Format one log entry the way it appears in OptimisationLogs.txt
+
+    :param Entry: the values logged for one iteration, e.g. {'Itteration': 0, 'x': 1.0, 'ObjectiveFunction': 2.0}
+    :type Entry: dict
+    :returns: the formatted line, including the new line character
+    """
+    Line = ''
+    for key, value in Entry.items():
+        if key == 'Itteration':
+            Line = Line + f'{key}: {int(value)}'
+        else:
+            Line = Line + f', {key}: {value: 1.2f}'
+    return Line + '\n'
+
+
+def AppendToBinaryLog(LogFileLoc, Entry):
+    """
+    Add one iteration to the binary log which sits alongside the text log at LogFileLoc. Values are stored at full
+    precision, and rows are only ever appended, so it can be read incrementally with LogReader.
+    The columns are set by the first entry; any which are missing from later entries are stored as NaN. If an entry
+    has values which aren't in the log yet, the log is rewritten once with a new column for each, which is NaN for
+    the earlier entries.
+
+    :param LogFileLoc: location of the text log, e.g. BaseDirectory / SimulationName / logs / OptimisationLogs.txt
+    :type LogFileLoc: string or pathlib.Path
+    :param Entry: the values logged for this iteration, e.g. {'Itteration': 0, 'x': 1.0, 'ObjectiveFunction': 2.0}
+    :type Entry: dict
+    """
+    DataLoc, HeaderLoc = _get_binary_log_locations(LogFileLoc)
+    if not os.path.isfile(HeaderLoc):
+        Columns = []
+    else:
+        with open(HeaderLoc) as f:
+            Columns = json.load(f)['columns']
+    NewColumns = [column for column in Entry.keys() if column not in Columns]
+    if NewColumns:
+        if os.path.isfile(DataLoc) and len(Columns) > 0:
+            with open(DataLoc, 'rb') as f:
+                Rows = np.frombuffer(f.read(), dtype=np.float64).reshape(-1, len(Columns))
+            Rows = np.hstack([Rows, np.full([Rows.shape[0], len(NewColumns)], np.nan)])
+            TempLoc = Path(str(DataLoc) + '.tmp')
+            with open(TempLoc, 'wb') as f:
+                f.write(Rows.tobytes())
+            os.replace(TempLoc, DataLoc)
+        Columns = Columns + NewColumns
+        with open(HeaderLoc, 'w') as f:
+            json.dump({'columns': Columns, 'dtype': 'float64'}, f)
+    Row = np.array([Entry.get(column, np.nan) for column in Columns], dtype=np.float64)
+    with open(DataLoc, 'ab') as f:
+        f.write(Row.tobytes())
+
+
+class LogReader:
+    """
+    Reads the binary log written by AppendToBinaryLog. Each call to Read only reads the rows which have been added
+    since the last call, so following a running optimisation costs O(1) per iteration rather than re-reading the
+    whole log. If columns have been added to the log since the last call, the whole log is read again.
+
+    :param LogFileLoc: location of the text log, e.g. BaseDirectory / SimulationName / logs / OptimisationLogs.txt.
+        The binary log next to it is read
+    :type LogFileLoc: string or pathlib.Path
+    """
+
+    def __init__(self, LogFileLoc):
+        """
+        init method for LogReader. input options are in class docstring
+        """
+        self.DataLoc, self.HeaderLoc = _get_binary_log_locations(LogFileLoc)
+        self.Columns = None
+        self._BytesRead = 0
+        self._Rows = None  # grows by doubling, so appending is O(1) on average
+        self._NumberOfRows = 0
+
+    def Read(self):
+        """
+        Read any new rows from the log.
+
+        :returns: ResultsDict: dictionary of numpy arrays, one for each logged quantity
+        """
+        if not os.path.isfile(self.HeaderLoc):
+            return {}
+        with open(self.HeaderLoc) as f:
+            Columns = json.load(f)['columns']
+        if Columns != self.Columns:
+            self.Columns = Columns
+            self._BytesRead = 0
+            self._Rows = None
+            self._NumberOfRows = 0
+        RowBytes = 8 * len(self.Columns)
+        if os.path.isfile(self.DataLoc):
+            # only read complete rows, in case the writer is part way through a row
+            NewBytes = ((os.path.getsize(self.DataLoc) - self._BytesRead) // RowBytes) * RowBytes
+            if NewBytes > 0:
+                with open(self.DataLoc, 'rb') as f:
+                    f.seek(self._BytesRead)
+                    NewRows = np.frombuffer(f.read(NewBytes), dtype=np.float64).reshape(-1, len(self.Columns))
+                self._BytesRead = self._BytesRead + NewBytes
+                self._AppendRows(NewRows)
+        if self._Rows is None:
+            self._Rows = np.zeros([0, len(self.Columns)])
+        return {column: self._Rows[:self._NumberOfRows, i] for i, column in enumerate(self.Columns)}
+
+    def _AppendRows(self, NewRows):
+        """
+        add rows to the in memory copy of the log, doubling its size when it is full
+        """
+        RequiredRows = self._NumberOfRows + NewRows.shape[0]
+        if self._Rows is None or RequiredRows > self._Rows.shape[0]:
+            Capacity = max(RequiredRows, 2 * (0 if self._Rows is None else self._Rows.shape[0]), 64)
+            Rows = np.empty([Capacity, len(self.Columns)])
+            if self._Rows is not None:
+                Rows[:self._NumberOfRows] = self._Rows[:self._NumberOfRows]
+            self._Rows = Rows
+        self._Rows[self._NumberOfRows:RequiredRows] = NewRows
+        self._NumberOfRows = RequiredRows
+
+
+def ExportLogToText(LogFileLoc):
+    """
+    Write the text log at LogFileLoc from the binary log next to it. Any existing text log is overwritten.
+
+    :param LogFileLoc: location of the text log to write
+    :type LogFileLoc: string or pathlib.Path
+    """
+    ResultsDict = LogReader(LogFileLoc).Read()
+    with open(LogFileLoc, 'w') as f:
+        for row in range(len(ResultsDict.get('Itteration', []))):
+            f.write(FormatLogEntry({key: values[row] for key, values in ResultsDict.items()}))
+
+
 def ReadInLogFile(LogFileLoc):
     """
-    Read in a log file and return as a dictionary
+    Read in a log file and return as a dictionary. Text logs (OptimisationLogs.txt) hold values to two decimal
+    places; to read the binary log written alongside, which is faster and gives values at full precision, pass its
+    location instead (OptimisationLogs.bin).
 
     :param LogFileLoc: path to log file
     :type LogFileLoc: string or pathlib.Path
     """
 
+    if Path(LogFileLoc).suffix == '.bin':
+        DataLoc, HeaderLoc = _get_binary_log_locations(LogFileLoc)
+        if not os.path.isfile(HeaderLoc):
+            print(f'File not found:\n{HeaderLoc}\nQuitting')
+            sys.exit(1)
+        return {key: values.tolist() for key, values in LogReader(LogFileLoc).Read().items()}
+
     if not os.path.isfile(LogFileLoc):
         print(f'File not found:\n{LogFileLoc}\nQuitting')
         sys.exit(1)
@@ -648,14 +1169,24 @@ def PlotLogFile(LogFileLoc, save_loc=None): # pragma: no cover
         No error checking included! If not supplied, behaviour is instead to show the plot
     :type save_loc: string or pathlib.Path
     """
-    ResultsDict = ReadInLogFile(LogFileLoc)
+    PlotConvergence(ReadInLogFile(LogFileLoc), save_loc)
+
+
+def PlotConvergence(ResultsDict, save_loc=None): # pragma: no cover
+    """
+    Plot the convergence of an optimisation from an already loaded log (see ReadInLogFile and LogReader)
+
+    :param ResultsDict: the logged values, as returned by ReadInLogFile or LogReader.Read
+    :type ResultsDict: dict
+    :param save_loc: if supplied, will attempt to save the log file there without displaying it.
+        No error checking included! If not supplied, behaviour is instead to show the plot
+    :type save_loc: string or pathlib.Path
+    """
+    ResultsDict = dict(ResultsDict)  # don't pop from the caller's dictionary
     Itteration = ResultsDict.pop('Itteration')
     OF = ResultsDict.pop('ObjectiveFunction')
 
-    LowestVal = np.ones(np.size(OF)) * OF[0]
-    for i, val in enumerate(LowestVal):
-        if OF[i] < LowestVal[i]:
-            LowestVal[i:] = OF[i]
+    LowestVal = np.minimum.accumulate(OF)
 
     fig, axs = plt.subplots(nrows=1, ncols=1, figsize=(10, 5))
     axs.plot(Itteration, LowestVal, '-k', linewidth=2)
@@ -687,6 +1218,767 @@ def PlotLogFile(LogFileLoc, save_loc=None): # pragma: no cover
         plt.show()
 
 
+def PlotRetrospectiveModelFit(ItterationVector, OF, mean, std, save_loc): # pragma: no cover
+    """
+    Plot the objective function at each iteration next to what the final model predicts for it
+
+    :param ItterationVector: iteration numbers
+    :param OF: objective function values, with the sign used internally by the optimiser
+    :param mean: predicted objective function at each iteration
+    :param std: standard deviation of the prediction at each iteration
+    :param save_loc: where to save the plot
+    :type save_loc: string or pathlib.Path
+    """
+    fig, axs = plt.subplots(nrows=1, ncols=1, figsize=(5, 5))
+    axs.plot(ItterationVector, OF, 'C1-x')
+    axs.set_xlabel('Itteration number', fontsize=FigureSpecs.LabelFontSize)
+    axs.set_ylabel('Objective function', fontsize=FigureSpecs.LabelFontSize)
+    axs.grid(True)
+    axs.plot(ItterationVector, mean, 'C0')
+    axs.fill_between(ItterationVector, mean + std, mean - std, alpha=0.3, color='C0')
+    axs.legend(['Actual', 'Predicted', 'Std.'])
+    axs.set_title('Retrospective Model Fit', fontsize=FigureSpecs.TitleFontSize)
+    plt.savefig(save_loc)
+    plt.close(fig)
+
+
+def PlotPredictedVersusActual(Actual, Predicted, save_loc): # pragma: no cover
+    """
+    Produce a scatter plot of the predicted versus actual objective function values, and print spearman and pearson
+    correlation coefficient to it
+
+    :param Actual: objective function values
+    :param Predicted: the values which were predicted before each point was simulated
+    :param save_loc: where to save the plot
+    :type save_loc: string or pathlib.Path
+    """
+    fig, axs = plt.subplots(nrows=1, ncols=1, figsize=(5, 5))
+    axs.scatter(Actual, Predicted)
+    axs.set_xlabel('Actual', fontsize=FigureSpecs.LabelFontSize)
+    axs.set_ylabel('Predicted', fontsize=FigureSpecs.LabelFontSize)
+    NewMinLim = np.min([axs.get_ylim(), axs.get_xlim()])
+    NewMaxLim = np.max([axs.get_ylim(), axs.get_xlim()])
+    axs.set_ylim([NewMinLim, NewMaxLim])
+    axs.set_xlim([NewMinLim, NewMaxLim])
+    axs.plot([NewMinLim, NewMaxLim], [NewMinLim, NewMaxLim], 'r--')
+
+    # Assess and print correlation metrics:
+    if len(Predicted) > 2:
+        Pearson = stats.pearsonr(Actual, Predicted)
+        Spearman = stats.spearmanr(Actual, Predicted)
+        plt.text(NewMinLim + abs(NewMinLim * 0.2), NewMaxLim - (abs(NewMaxLim * 0.2)),
+                 f'Spearman: {Spearman[0]: 1.1f}\nPearson: {Pearson[0]: 1.1f}',
+                 fontsize=FigureSpecs.LabelFontSize)
+
+    axs.grid(True)
+    axs.set_title('Actual versus predicted correlation', fontsize=FigureSpecs.TitleFontSize)
+    plt.tight_layout()
+    plt.savefig(save_loc)
+    plt.close(fig)
+
+
+def PlotSingleParameter(param, PointsToVary, mean, std, save_loc): # pragma: no cover
+    """
+    Plot the predicted objective function as one parameter varies
+
+    :param param: name of the parameter
+    :type param: str
+    :param PointsToVary: values of the parameter
+    :param mean: predicted objective function at each value
+    :param std: standard deviation of the prediction at each value
+    :param save_loc: where to save the plot
+    :type save_loc: string or pathlib.Path
+    """
+    fig = plt.figure()
+    plt.plot(PointsToVary, mean)
+    plt.fill_between(PointsToVary, mean + std, mean - std, alpha=0.5, color='C0')
+    plt.xlabel(param)
+    plt.ylabel('Predicted Objective function value')
+    plt.title(f'Single parameter plot for {param}')
+    plt.grid()
+    plt.savefig(save_loc)
+    plt.close(fig)
+
+
+class GaussianProcessSlicer:
+    """
+    Predict a fitted gaussian process along slices through a point: for each parameter, the prediction as that
+    parameter varies and the others are held constant, and optionally the same for each pair of parameters.
+    All slices are predicted together. For Matern and RBF kernels, the distance from the centre point to each
+    training point is split into one term per parameter; these terms are cached, so each slice only has to update
+    the terms for the parameters it varies. Other kernels fall back to a single gp.predict over all slices.
+
+    :param gp: a fitted sklearn.gaussian_process.GaussianProcessRegressor
+    """
+
+    def __init__(self, gp):
+        """
+        init method for GaussianProcessSlicer. input options are in class docstring
+        """
+        self.gp = gp
+        self._CacheID = None  # (training data, length scales, centre) the cached distances are for
+        self._ScaledDistances = None
+
+    def _KernelOfDistance(self):
+        """
+        Return a function giving the kernel as a function of scaled distance, or None if the kernel or the type of
+        gaussian process isn't supported, or the gaussian process hasn't been fit yet
+        """
+        if type(self.gp).predict is not GaussianProcessRegressor.predict:
+            return None  # e.g. SparseGaussianProcessRegressor; the exact formulae below don't apply
+        kernel = getattr(self.gp, 'kernel_', None)
+        if isinstance(kernel, Matern):
+            nu = kernel.nu
+        elif isinstance(kernel, RBF):
+            nu = np.inf
+        else:
+            return None
+        if nu == 0.5:
+            return lambda d: np.exp(-d)
+        elif nu == 1.5:
+            return lambda d: (1 + np.sqrt(3) * d) * np.exp(-np.sqrt(3) * d)
+        elif nu == 2.5:
+            return lambda d: (1 + np.sqrt(5) * d + 5 * d ** 2 / 3) * np.exp(-np.sqrt(5) * d)
+        elif np.isinf(nu):
+            return lambda d: np.exp(-d ** 2 / 2)
+        return None
+
+    def _GetScaledDistances(self, Centre, LengthScales):
+        """
+        Per parameter squared distance between the centre point and each training point, in units of length scale.
+        Reused until the gaussian process is refit or the centre point changes
+        """
+        X_train = self.gp.X_train_
+        if self._CacheID is None or not (self._CacheID[0] is X_train and np.array_equal(self._CacheID[1], LengthScales)
+                                         and np.array_equal(self._CacheID[2], Centre)):
+            self._ScaledDistances = ((Centre[:, None] - X_train.T) / LengthScales[:, None]) ** 2
+            self._CacheID = (X_train, LengthScales.copy(), Centre.copy())
+        return self._ScaledDistances
+
+    def Predict(self, Centre, Bounds, Nsamples=100, Pairwise=False, PairwiseSamples=25):
+        """
+        Predict the mean and standard deviation of the gaussian process along each slice.
+
+        :param Centre: the point the slices pass through, in the order of the gaussian process inputs
+        :type Centre: array
+        :param Bounds: (lower, upper) for each input
+        :type Bounds: array-like of shape (n_parameters, 2)
+        :param Nsamples: number of points along each single parameter slice
+        :type Nsamples: int, optional
+        :param Pairwise: if True, also predict a PairwiseSamples x PairwiseSamples grid for each pair of parameters
+        :type Pairwise: bool, optional
+        :param PairwiseSamples: number of points along each side of the pairwise grids
+        :type PairwiseSamples: int, optional
+        :returns: Slices: {i: (values, mean, std)} for each input i, and
+            PairwiseSlices: {(i, j): (values_i, values_j, mean, std)} where mean and std have shape
+            (PairwiseSamples, PairwiseSamples) and are indexed [values_i, values_j]. Empty unless Pairwise
+        """
+        Centre = np.asarray(Centre, dtype=float)
+        Bounds = np.asarray(Bounds, dtype=float)
+        NParameters = Centre.shape[0]
+        Values = [np.linspace(Bounds[i, 0], Bounds[i, 1], Nsamples) for i in range(NParameters)]
+        Pairs = [(i, j) for i in range(NParameters) for j in range(i + 1, NParameters)] if Pairwise else []
+        PairValues = [np.linspace(Bounds[i, 0], Bounds[i, 1], PairwiseSamples) for i in range(NParameters)]
+
+        KernelOfDistance = self._KernelOfDistance()
+        if KernelOfDistance is None:
+            # build every slice into one design matrix and predict once
+            DesignMatrix = []
+            for i in range(NParameters):
+                Points = np.tile(Centre, (Nsamples, 1))
+                Points[:, i] = Values[i]
+                DesignMatrix.append(Points)
+            for i, j in Pairs:
+                Points = np.tile(Centre, (PairwiseSamples ** 2, 1))
+                Grid_i, Grid_j = np.meshgrid(PairValues[i], PairValues[j], indexing='ij')
+                Points[:, i] = Grid_i.ravel()
+                Points[:, j] = Grid_j.ravel()
+                DesignMatrix.append(Points)
+            mean, std = self.gp.predict(np.vstack(DesignMatrix), return_std=True)
+        else:
+            LengthScales = np.broadcast_to(np.asarray(self.gp.kernel_.length_scale, dtype=float),
+                                           (NParameters,)).copy()
+            X_train = self.gp.X_train_
+            ScaledDistances = self._GetScaledDistances(Centre, LengthScales)
+            TotalDistance = ScaledDistances.sum(axis=0)  # squared distance from the centre to each training point
+            SquaredDistances = []
+            for i in range(NParameters):
+                Varying = ((Values[i][:, None] - X_train[:, i]) / LengthScales[i]) ** 2
+                SquaredDistances.append(TotalDistance - ScaledDistances[i] + Varying)
+            for i, j in Pairs:
+                Varying_i = ((PairValues[i][:, None] - X_train[:, i]) / LengthScales[i]) ** 2
+                Varying_j = ((PairValues[j][:, None] - X_train[:, j]) / LengthScales[j]) ** 2
+                Grid = (TotalDistance - ScaledDistances[i] - ScaledDistances[j]) + Varying_i[:, None, :] \
+                    + Varying_j[None, :, :]
+                SquaredDistances.append(Grid.reshape(-1, X_train.shape[0]))
+            K_trans = KernelOfDistance(np.sqrt(np.maximum(np.vstack(SquaredDistances), 0)))
+            mean = K_trans @ self.gp.alpha_
+            V = solve_triangular(self.gp.L_, K_trans.T, lower=True, check_finite=False)
+            var = np.maximum(1 - np.einsum('ij,ij->j', V, V), 0)  # Matern and RBF are 1 at zero distance
+            y_train_std = np.squeeze(getattr(self.gp, '_y_train_std', 1))
+            mean = y_train_std * np.squeeze(mean) + np.squeeze(getattr(self.gp, '_y_train_mean', 0))
+            std = np.sqrt(var) * y_train_std
+
+        Slices = {}
+        Start = 0
+        for i in range(NParameters):
+            Slices[i] = (Values[i], mean[Start:Start + Nsamples], std[Start:Start + Nsamples])
+            Start = Start + Nsamples
+        PairwiseSlices = {}
+        for i, j in Pairs:
+            End = Start + PairwiseSamples ** 2
+            PairwiseSlices[(i, j)] = (PairValues[i], PairValues[j],
+                                      mean[Start:End].reshape(PairwiseSamples, PairwiseSamples),
+                                      std[Start:End].reshape(PairwiseSamples, PairwiseSamples))
+            Start = End
+        return Slices, PairwiseSlices
+
+
+def heteroscedastic_alpha(alpha, noise_variance, y, normalize_y, y_std=None):
+    """
+    The alpha (the variance added to the diagonal of the kernel matrix) to fit a gaussian process with when the
+    noise of each observation has been measured, e.g. the Monte Carlo variance of each objective function value.
+    alpha is in the units of the (normalised) targets, so with normalize_y the measured variances are divided by
+    the variance of y (or y_std ** 2). Observations without a measurement (noise_variance is shorter than y, e.g. the constant
+    liar's pending points) get the mean measured variance.
+
+    :param alpha: the usual gaussian process alpha, used on its own if noise_variance is None
+    :type alpha: float or array
+    :param noise_variance: measured noise variance of the first len(noise_variance) observations, in the units of y
+    :type noise_variance: array or None
+    :param y: the targets which will be fit
+    :type y: array
+    :param normalize_y: whether the gaussian process normalises the targets
+    :type normalize_y: bool
+    :param y_std: the standard deviation the targets are normalised by, if it isn't that of y
+    :type y_std: float, optional
+    :returns: alpha: float or array with one value per observation
+    """
+    if noise_variance is None:
+        return alpha
+    noise_variance = np.asarray(noise_variance, dtype=float)[:len(y)]
+    if len(noise_variance) < len(y):
+        Fill = np.mean(noise_variance) if len(noise_variance) else 0
+        noise_variance = np.concatenate([noise_variance, np.full(len(y) - len(noise_variance), Fill)])
+    if normalize_y and y_std is not None:
+        noise_variance = noise_variance / y_std ** 2
+    elif normalize_y and np.std(y) > 0:
+        noise_variance = noise_variance / np.var(y)
+    return alpha + noise_variance
+
+
+class IncrementalGaussianProcessRegressor(GaussianProcessRegressor):
+    """
+    A drop in replacement for sklearn's GaussianProcessRegressor which avoids refitting from scratch every time a
+    point is added. bayes_opt calls fit with all the observations so far each time it suggests a point; when the new
+    training data is the previous training data with some rows added (or, as with the constant liar, removed from
+    the end), the existing Cholesky factor is extended (or truncated) and the kernel hyperparameters are kept.
+    This costs O(n^2) per new point rather than the O(n^3) per restart of a full fit.
+    With noise_variance and normalize_y, the targets are normalised by their mean and standard deviation at the last
+    full fit until the next one; the measured noise is then the same in normalised units for every fit, so the
+    factor stays valid.
+    The hyperparameters are fully re-optimised every refit_every new points, or sooner if the log marginal
+    likelihood per point drifts by more than lml_tolerance from its value at the last full fit. These refits are
+    warm started from the previous hyperparameters.
+    Parameters other than those below are the same as for GaussianProcessRegressor.
+
+    :param refit_every: re-optimise the hyperparameters once this many points have been added since the last time.
+        1 re-optimises on every fit, which is the same as GaussianProcessRegressor
+    :type refit_every: int, optional
+    :param lml_tolerance: also re-optimise if the log marginal likelihood per point changes by more than this. None
+        to only refit on the refit_every schedule
+    :type lml_tolerance: float, optional
+    :param warm_restarts: number of random restarts for refits after the first; the first fit uses
+        n_restarts_optimizer. None to always use n_restarts_optimizer
+    :type warm_restarts: int, optional
+    :param noise_variance: measured noise variance of each observation, in the units of y. See
+        heteroscedastic_alpha
+    :type noise_variance: array, optional
+    """
+
+    def __init__(self, kernel=None, *, alpha=1e-10, optimizer='fmin_l_bfgs_b', n_restarts_optimizer=0,
+                 normalize_y=False, copy_X_train=True, n_targets=None, random_state=None, refit_every=10,
+                 lml_tolerance=None, warm_restarts=None, noise_variance=None):
+        """
+        init method for IncrementalGaussianProcessRegressor. input options are in class docstring
+        """
+        super().__init__(kernel=kernel, alpha=alpha, optimizer=optimizer,
+                         n_restarts_optimizer=n_restarts_optimizer, normalize_y=normalize_y,
+                         copy_X_train=copy_X_train, n_targets=n_targets, random_state=random_state)
+        self.refit_every = refit_every
+        self.lml_tolerance = lml_tolerance
+        self.warm_restarts = warm_restarts
+        self.noise_variance = noise_variance
+
+    def _full_fit(self, X, y):
+        """
+        Re-optimise the hyperparameters, starting from the previous ones if there are any
+        """
+        InitialKernel = self.kernel
+        InitialRestarts = self.n_restarts_optimizer
+        UserAlpha = self.alpha
+        if hasattr(self, 'kernel_'):
+            self.kernel = self.kernel_
+            if self.warm_restarts is not None:
+                self.n_restarts_optimizer = self.warm_restarts
+        y_std = np.std(y) if np.std(y) > 0 else 1.0  # as GaussianProcessRegressor normalises y
+        self.alpha = heteroscedastic_alpha(UserAlpha, self.noise_variance, y, self.normalize_y, y_std)
+        try:
+            super().fit(X, y)
+        finally:
+            self.kernel = InitialKernel
+            self.n_restarts_optimizer = InitialRestarts
+            self.alpha = UserAlpha
+        self._alpha_train = heteroscedastic_alpha(UserAlpha, self.noise_variance, y, self.normalize_y, y_std)
+        self.n_full_fits_ = getattr(self, 'n_full_fits_', 0) + 1
+        self._n_at_full_fit = self.X_train_.shape[0]
+        self._lml_per_point_at_full_fit = self.log_marginal_likelihood_value_ / self.X_train_.shape[0]
+        return self
+
+    def _shared_rows(self, X):
+        """
+        Number of leading rows of X which are the same as the current training data
+        """
+        NRows = min(X.shape[0], self.X_train_.shape[0])
+        Same = np.all(X[:NRows] == self.X_train_[:NRows], axis=1)
+        return NRows if Same.all() else int(np.argmin(Same))
+
+    def fit(self, X, y):
+        """
+        Fit the gaussian process to X, y. See the class docstring for when the hyperparameters are re-optimised.
+
+        :param X: training inputs, shape (n_samples, n_features)
+        :param y: training targets, shape (n_samples,)
+        :returns: self
+        """
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if not hasattr(self, 'L_') or self.optimizer is None or y.ndim > 1 \
+                or X.ndim != 2 or X.shape[1] != self.X_train_.shape[1]:
+            return self._full_fit(X, y)
+        Shared = self._shared_rows(X)
+        if Shared == 0 or X.shape[0] - self._n_at_full_fit >= self.refit_every:
+            return self._full_fit(X, y)
+
+        # renormalising the targets would change the measured noise of every point in normalised units
+        FixedNormalisation = self.noise_variance is not None
+        alpha = np.broadcast_to(heteroscedastic_alpha(self.alpha, self.noise_variance, y, self.normalize_y,
+                                                      self._y_train_std if FixedNormalisation else None), y.shape)
+        if not np.array_equal(alpha[:Shared], np.broadcast_to(self._alpha_train, self.y_train_.shape)[:Shared]):
+            # the noise of the existing points has changed, so the factor is recalculated with the same
+            # hyperparameters
+            Shared = 0
+            L = np.zeros((0, 0))
+        else:
+            L = self.L_[:Shared, :Shared]
+        if X.shape[0] > Shared:
+            # block Cholesky update; a rank one update when a single point is added
+            X_new = X[Shared:]
+            K_cross = self.kernel_(X[:Shared], X_new)
+            K_new = self.kernel_(X_new)
+            K_new[np.diag_indices_from(K_new)] += alpha[Shared:]
+            L_cross = solve_triangular(L, K_cross, lower=True, check_finite=False).T
+            try:
+                L_new = cholesky(K_new - L_cross @ L_cross.T, lower=True, check_finite=False)
+            except np.linalg.LinAlgError:
+                return self._full_fit(X, y)
+            L = np.block([[L, np.zeros((Shared, X_new.shape[0]))], [L_cross, L_new]])
+
+        if self.normalize_y and not FixedNormalisation:
+            self._y_train_mean = np.mean(y, axis=0)
+            self._y_train_std = np.std(y, axis=0) if np.std(y, axis=0) > 0 else 1.0
+        y_normalised = (y - self._y_train_mean) / self._y_train_std
+        self.X_train_ = np.copy(X)
+        self.y_train_ = y_normalised
+        self.L_ = L
+        self._alpha_train = alpha
+        self.alpha_ = cho_solve((L, True), y_normalised, check_finite=False)
+        self.log_marginal_likelihood_value_ = -0.5 * y_normalised @ self.alpha_ - np.log(np.diag(L)).sum() \
+            - 0.5 * X.shape[0] * np.log(2 * np.pi)
+        if self.lml_tolerance is not None and abs(self.log_marginal_likelihood_value_ / X.shape[0]
+                                                  - self._lml_per_point_at_full_fit) > self.lml_tolerance:
+            return self._full_fit(X, y)
+        return self
+
+
+class SparseGaussianProcessRegressor(GaussianProcessRegressor):
+    """
+    A drop in replacement for sklearn's GaussianProcessRegressor whose cost grows linearly rather than cubically with
+    the number of observations, for long optimisations with thousands of points. Once there are more than
+    n_inducing observations, the model is a
+    `FITC <https://papers.nips.cc/paper/2005/hash/4491777b1aa8b5b32c2e8666dbe1a495-Abstract.html>`_
+    sparse gaussian process: every observation is used, but only through its covariance with n_inducing inducing
+    points chosen from the observations. The points with the highest targets (the optimiser maximises) make up
+    half of the inducing points, and the rest are spread over the remaining observations.
+    The kernel hyperparameters are optimised, as usual, by fitting an exact gaussian process to the inducing points
+    only. Fitting then costs O(n * n_inducing^2) and predicting O(n_inducing^2) per point.
+    With n_inducing or fewer observations this is identical to GaussianProcessRegressor.
+    Parameters other than those below are the same as for GaussianProcessRegressor.
+
+    :param n_inducing: number of inducing points
+    :type n_inducing: int, optional
+    :param noise_variance: measured noise variance of each observation, in the units of y. See
+        heteroscedastic_alpha
+    :type noise_variance: array, optional
+    """
+
+    def __init__(self, kernel=None, *, alpha=1e-10, optimizer='fmin_l_bfgs_b', n_restarts_optimizer=0,
+                 normalize_y=False, copy_X_train=True, n_targets=None, random_state=None, n_inducing=200,
+                 noise_variance=None):
+        """
+        init method for SparseGaussianProcessRegressor. input options are in class docstring
+        """
+        super().__init__(kernel=kernel, alpha=alpha, optimizer=optimizer,
+                         n_restarts_optimizer=n_restarts_optimizer, normalize_y=normalize_y,
+                         copy_X_train=copy_X_train, n_targets=n_targets, random_state=random_state)
+        self.n_inducing = n_inducing
+        self.noise_variance = noise_variance
+
+    def _select_inducing_points(self, X, y):
+        """
+        Indices of the inducing points: the n_inducing // 2 highest targets, then the point furthest from those
+        already chosen, repeatedly, until there are n_inducing
+        """
+        Chosen = list(np.argsort(y)[::-1][:self.n_inducing // 2])
+        Range = X.max(axis=0) - X.min(axis=0)
+        X_scaled = X / np.where(Range > 0, Range, 1)
+        Distance = np.min(((X_scaled[:, None, :] - X_scaled[None, Chosen, :]) ** 2).sum(axis=2), axis=1)
+        while len(Chosen) < self.n_inducing:
+            Next = int(np.argmax(Distance))
+            Chosen.append(Next)
+            Distance = np.minimum(Distance, ((X_scaled - X_scaled[Next]) ** 2).sum(axis=1))
+        return np.array(Chosen)
+
+    def fit(self, X, y):
+        """
+        Fit the gaussian process to X, y.
+
+        :param X: training inputs, shape (n_samples, n_features)
+        :param y: training targets, shape (n_samples,)
+        :returns: self
+        """
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.sparse_ = X.shape[0] > self.n_inducing
+        UserAlpha = self.alpha
+        alpha = heteroscedastic_alpha(UserAlpha, self.noise_variance, y, self.normalize_y)
+        if not self.sparse_:
+            self.alpha = alpha
+            try:
+                return super().fit(X, y)
+            finally:
+                self.alpha = UserAlpha
+
+        Inducing = self._select_inducing_points(X, y)
+        if np.ndim(alpha) > 0:
+            self.alpha = alpha[Inducing]
+        alpha = np.broadcast_to(alpha, y.shape)
+        try:
+            super().fit(X[Inducing], y[Inducing])  # sets kernel_
+        finally:
+            self.alpha = UserAlpha
+
+        if self.normalize_y:
+            self._y_train_mean = np.mean(y, axis=0)
+            self._y_train_std = np.std(y, axis=0) if np.std(y, axis=0) > 0 else 1.0
+        else:
+            self._y_train_mean = np.zeros(1)
+            self._y_train_std = np.ones(1)
+        y_normalised = (y - self._y_train_mean) / self._y_train_std
+
+        self.inducing_points_ = X[Inducing]
+        K_uu = self.kernel_(self.inducing_points_)
+        K_uu[np.diag_indices_from(K_uu)] += 1e-8 * np.mean(np.diag(K_uu))  # jitter, for numerical stability
+        self._L_uu = cholesky(K_uu, lower=True, check_finite=False)
+        V = solve_triangular(self._L_uu, self.kernel_(self.inducing_points_, X), lower=True, check_finite=False)
+        # FITC: the diagonal of the exact covariance is kept, plus the noise:
+        Lambda = np.maximum(self.kernel_.diag(X) - np.einsum('ij,ij->j', V, V), 0) + alpha
+        V_scaled = V / np.sqrt(Lambda)
+        A = V_scaled @ V_scaled.T
+        A[np.diag_indices_from(A)] += 1
+        self._L_A = cholesky(A, lower=True, check_finite=False)
+        self._weights = cho_solve((self._L_A, True), V_scaled @ (y_normalised / np.sqrt(Lambda)),
+                                  check_finite=False)
+        self.X_train_ = np.copy(X)
+        self.y_train_ = y_normalised
+        # these only describe the exact fit to the inducing points, so are removed to avoid confusion
+        del self.L_, self.alpha_
+        return self
+
+    def predict(self, X, return_std=False, return_cov=False):
+        """
+        Predict using the gaussian process. See GaussianProcessRegressor.predict
+
+        :param X: points to predict, shape (n_points, n_features)
+        :param return_std: if True, also return the standard deviation at each point
+        :param return_cov: if True, also return the covariance between the points
+        :returns: mean, and std or cov if requested
+        """
+        if not getattr(self, 'sparse_', False):
+            return super().predict(X, return_std=return_std, return_cov=return_cov)
+        if return_std and return_cov:
+            raise RuntimeError('At most one of return_std or return_cov can be requested.')
+        X = np.asarray(X, dtype=float)
+        y_train_std = np.squeeze(self._y_train_std)
+        V = solve_triangular(self._L_uu, self.kernel_(self.inducing_points_, X), lower=True, check_finite=False)
+        mean = y_train_std * (V.T @ self._weights) + np.squeeze(self._y_train_mean)
+        if not (return_std or return_cov):
+            return mean
+        W = solve_triangular(self._L_A, V, lower=True, check_finite=False)
+        if return_cov:
+            cov = self.kernel_(X) - V.T @ V + W.T @ W
+            return mean, cov * y_train_std ** 2
+        var = self.kernel_.diag(X) - np.einsum('ij,ij->j', V, V) + np.einsum('ij,ij->j', W, W)
+        return mean, np.sqrt(np.maximum(var, 0)) * y_train_std
+
+
+def _refine_acquisition_candidates(Acquisition, gp, bounds, Candidates):
+    """
+    Runs in a worker process of PooledUpperConfidenceBound: minimise -1 * UCB with L-BFGS-B starting from each of
+    Candidates. The acquisition function and gp are sent with every call, since the gp changes between suggestions
+    """
+    acq = Acquisition._get_acq(gp=gp)
+    return [Acquisition._refine(acq, x0, bounds) for x0 in Candidates]
+
+
+def _start_acquisition_worker():
+    """
+    Does nothing; submitted by PooledUpperConfidenceBound.Start so that its worker processes are created straight away
+    """
+    return None
+
+
+class PooledUpperConfidenceBound(acquisition.UpperConfidenceBound):
+    """
+    The bayes_opt upper confidence bound acquisition function, maximised in a way which scales better to many
+    parameters. bayes_opt scores 10,000 random points and then runs 10 L-BFGS-B optimisations from other random
+    points, one after another. Instead, a `Sobol <https://en.wikipedia.org/wiki/Sobol_sequence>`_ pool of candidates
+    is scored with a single vectorised gp.predict, and only the best n_refine candidates are refined with L-BFGS-B,
+    optionally in parallel processes. The refined points from the previous suggestion are added to the pool, since
+    the acquisition function usually changes little between iterations.
+    Parameters other than those below are the same as for bayes_opt.acquisition.UpperConfidenceBound.
+
+    :param pool_size: number of candidates to score. Rounded up to a power of 2
+    :type pool_size: int, optional
+    :param n_refine: number of the best candidates to refine with L-BFGS-B
+    :type n_refine: int, optional
+    :param n_workers: number of processes to refine the candidates in, which is only worth it when the gaussian
+        process is slow to evaluate (many points or parameters). 1 refines in this process. The processes are created
+        by Start and reused for every suggestion until Close; until Start is called candidates are refined in this
+        process
+    :type n_workers: int, optional
+    """
+
+    def __init__(self, kappa=2.576, exploration_decay=None, exploration_decay_delay=None, random_state=None,
+                 pool_size=4096, n_refine=10, n_workers=1):
+        """
+        init method for PooledUpperConfidenceBound. input options are in class docstring
+        """
+        super().__init__(kappa=kappa, exploration_decay=exploration_decay,
+                         exploration_decay_delay=exploration_decay_delay, random_state=random_state)
+        self.pool_size = pool_size
+        self.n_refine = n_refine
+        self.n_workers = n_workers
+        self._gp = None  # the gp of the current suggestion
+        self._warm_starts = None  # refined points from the previous suggestion
+        self._workers = None  # ProcessPoolExecutor created by Start
+
+    def Start(self):
+        """
+        Create the worker processes, if n_workers > 1 and they aren't already running. Like BackgroundRenderer.Start,
+        this should be called before any other threads are started, as the processes are created by forking this one
+        where possible
+        """
+        if self.n_workers <= 1 or self._workers is not None:
+            return
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        self._workers = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=context)
+        # processes are otherwise only created as work is submitted, by which time other threads may be running:
+        Started = [self._workers.submit(_start_acquisition_worker) for _ in range(self.n_workers)]
+        for Future in Started:
+            Future.result()
+
+    def Close(self):
+        """
+        Stop the worker processes created by Start
+        """
+        if self._workers is None:
+            return
+        self._workers.shutdown()
+        self._workers = None
+
+    def _get_acq(self, gp, constraint=None):
+        """
+        As for bayes_opt, but keeps hold of the gp so that it can be sent to the worker processes
+        """
+        self._gp = gp
+        return super()._get_acq(gp=gp, constraint=constraint)
+
+    @staticmethod
+    def _refine(acq, x0, bounds):
+        """
+        Minimise acq (-1 * UCB) with L-BFGS-B starting from x0
+
+        :returns: (x, acq(x)), or (x0, inf) if the optimisation failed
+        """
+        res = minimize(acq, x0, bounds=bounds, method='L-BFGS-B')
+        if not res.success:
+            return x0, np.inf
+        return np.clip(res.x, bounds[:, 0], bounds[:, 1]), float(np.squeeze(res.fun))
+
+    def _acq_min(self, acq, bounds, n_random=10_000, n_l_bfgs_b=10):
+        """
+        Find the maximum of the acquisition function (the minimum of acq). n_random and n_l_bfgs_b are ignored in
+        favour of pool_size and n_refine
+        """
+        NParameters = bounds.shape[0]
+        Sampler = qmc.Sobol(d=NParameters, scramble=True, seed=self.random_state)
+        Pool = qmc.scale(Sampler.random_base2(int(np.ceil(np.log2(max(self.pool_size, 2))))),
+                         bounds[:, 0], bounds[:, 1])
+        if self._warm_starts is not None and self._warm_starts.shape[1] == NParameters:
+            Pool = np.vstack([self._warm_starts, Pool])
+        Scores = acq(Pool)
+        Best = np.argsort(Scores)[:self.n_refine]
+
+        if self._workers is not None and self._gp is not None:
+            Chunks = [Chunk for Chunk in np.array_split(Pool[Best], self.n_workers) if len(Chunk)]
+            Futures = [self._workers.submit(_refine_acquisition_candidates, self, self._gp, bounds, Chunk)
+                       for Chunk in Chunks]
+            Refined = [Result for Future in Futures for Result in Future.result()]
+        else:
+            Refined = [self._refine(acq, x0, bounds) for x0 in Pool[Best]]
+
+        Refined.append((Pool[Best[0]], Scores[Best[0]]))  # in case no refinement improved on the pool
+        self._warm_starts = np.array([x for x, _ in Refined])
+        x_min, _ = min(Refined, key=lambda result: result[1])
+        return x_min
+
+    def __getstate__(self):
+        """
+        The gp, warm starts and worker processes are runtime state and are not copied
+        """
+        state = self.__dict__.copy()
+        state['_gp'] = None
+        state['_warm_starts'] = None
+        state['_workers'] = None
+        return state
+
+
+def _render_plots(PlotQueue):
+    """
+    Runs in the BackgroundRenderer process. Takes (key, function, args) from PlotQueue and calls function(*args).
+    Whenever several plots with the same key are waiting, only the newest is drawn. None means stop.
+    """
+    plt.switch_backend('Agg')  # plots are only ever saved from here
+    Stop = False
+    while not Stop:
+        Waiting = [PlotQueue.get()]
+        while True:
+            try:
+                Waiting.append(PlotQueue.get_nowait())
+            except queue.Empty:
+                break
+        Latest = {}
+        for item in Waiting:
+            if item is None:
+                Stop = True
+            else:
+                key, function, args = pickle.loads(item)
+                Latest.pop(key, None)  # so that plots are drawn in the order of their newest request
+                Latest[key] = (function, args)
+        for key, (function, args) in Latest.items():
+            try:
+                function(*args)
+            except Exception as e:
+                logger.warning(f'failed to draw {key}: {e}')
+
+
+class BackgroundRenderer:
+    """
+    Draws diagnostic plots in a separate process, so that the optimisation doesn't wait for matplotlib. Plots are
+    requested with Submit; if several requests for the same plot are waiting, only the newest is drawn.
+    A separate process needs the 'fork' start method (Linux, and macOS if configured); where it isn't available, or
+    if InBackground is False, plots are simply drawn straight away.
+
+    :param InBackground: if False, plots are drawn straight away in this process
+    :type InBackground: bool, optional
+    """
+
+    def __init__(self, InBackground=True):
+        """
+        init method for BackgroundRenderer. input options are in class docstring
+        """
+        self.InBackground = InBackground and ('fork' in multiprocessing.get_all_start_methods())
+        self._Process = None
+        self._Queue = None
+
+    def __getstate__(self):
+        """
+        the process and queue can't be copied; they are restarted when next needed
+        """
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __setstate__(self, state):
+        """
+        restore the user settings
+        """
+        self.__dict__.update(state)
+        self._Process = None
+        self._Queue = None
+
+    def Start(self):
+        """
+        Start the rendering process, if it isn't already running. Submit will do this if needed, but it is best to
+        call Start before any other threads are started, as the process is created by forking this one.
+        """
+        if not self.InBackground:
+            return
+        if getattr(self, '_Process', None) is not None and self._Process.is_alive():
+            return
+        context = multiprocessing.get_context('fork')
+        self._Queue = context.Queue()
+        self._Process = context.Process(target=_render_plots, args=(self._Queue,))
+        self._Process.start()
+        # if the optimisation stops with an exception, Close is never called; python would then wait forever
+        atexit.register(self.Close)
+
+    def Submit(self, key, function, *args):
+        """
+        Request a plot.
+
+        :param key: identifies the plot, e.g. its file name. Older requests with the same key which haven't been drawn
+            yet are dropped
+        :type key: str
+        :param function: the function which draws the plot; it must be importable (e.g. a function in this module)
+        :param args: arguments to pass to function
+        """
+        if not self.InBackground:
+            function(*args)
+            return
+        self.Start()
+        # pickle now rather than in the queue's feeder thread, in case the caller goes on to modify args
+        self._Queue.put(pickle.dumps((key, function, args)))
+
+    def Close(self, wait=False):
+        """
+        Stop the rendering process once it has drawn all requested plots.
+
+        :param wait: if True, block until the process has finished. Otherwise it finishes in the background; python
+            waits for it before exiting
+        :type wait: bool, optional
+        """
+        if getattr(self, '_Process', None) is None:
+            return
+        self._Queue.put(None)
+        if wait:
+            self._Process.join()
+        self._Process = None
+        self._Queue = None
+
+
 def get_all_files(PathToData, file_extension):
     """
     quick script to just collect all the files in the Analysis path
@@ -755,4 +2047,423 @@ def generate_run_all_scripts_shell_script(script_location, scripts_to_run, topas
     # change file modifications:
     st = os.stat(FileName)
     os.chmod(FileName, st.st_mode | stat.S_IEXEC)
-    f.close()
\ No newline at end of file
+    f.close()
+
+
+class ReferenceDataCache:
+    """
+    Keeps reference results (e.g. the ground truth WaterTank.bin an objective function compares every iteration
+    against), and the data extracted from them, between calls of TopasObjectiveFunction. Each reference is only read
+    and summed once, and each set of points (e.g. a profile or depth dose) is only extracted from it once. Entries are
+    keyed on the path, size and modification time of the files, so they are refreshed if a file changes.
+    Create the cache once, at module level, so that it lasts for the whole optimisation: the ground truth is then
+    only read once however many iterations are run.
+    If CacheFile is supplied, the dose cubes are also saved to it, and the extracted data to a smaller file next to
+    it (e.g. ReferenceData.extracted.npz), so that a restarted optimisation doesn't need to read the references
+    again. Only one version of each reference is kept.
+
+    Basic use, in TopasObjectiveFunction.py::
+
+        from TopasOpt.utilities import WaterTankData, ReferenceDataCache
+        ReferenceData = ReferenceDataCache(Path(__file__).parent / 'ReferenceData.npz')
+
+        def TopasObjectiveFunction(ResultsLocation, iteration):
+            CurrentResults = WaterTankData(ResultsLocation, f'WaterTank_itt_{iteration}.bin')
+            GroundTruthResults = ReferenceData.GetWaterTankData(GroundTruthDataPath, 'WaterTank.bin')
+            OriginalDepthDose = ReferenceData.ExtractDataFromDoseCube(GroundTruthResults, Xpts, Ypts, Zpts)
+            CurrentDepthDose = CurrentResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
+            ...
+
+    :param CacheFile: .npz file to save the dose cubes in. Created if it doesn't exist. If None, data are only kept
+        in memory
+    :type CacheFile: str or Path, optional
+    """
+
+    def __init__(self, CacheFile=None):
+        """
+        init method for ReferenceDataCache. input options are in class docstring
+        """
+        self.CacheFile = CacheFile
+        self._WaterTankData = {}  # key: WaterTankData
+        self._Keys = {}  # id of a WaterTankData returned by GetWaterTankData: its key
+        self._Saved = {}  # name: array, as stored in CacheFile and ExtractedFile
+        self._Lock = threading.Lock()
+        self._WriteLock = threading.Lock()  # held while writing the files, so that readers aren't held up
+        self.ExtractedFile = None
+        if self.CacheFile is not None:
+            self.ExtractedFile = Path(self.CacheFile).with_suffix('.extracted.npz')
+            for File in [self.CacheFile, self.ExtractedFile]:
+                if not os.path.isfile(File):
+                    continue
+                try:
+                    with np.load(File) as Saved:
+                        self._Saved.update({Name: Saved[Name] for Name in Saved.files})
+                except Exception as e:
+                    logger.warning(f'could not read reference data cache {File}: {e}. Starting a new one')
+
+    def _GetKey(self, AnalysisPath, FileToAnalyse, **kwds):
+        """
+        :returns: FileKey: a hash of the file locations and the WaterTankData options, and StateKey: a hash of the
+            sizes and modification times of the files
+        """
+        if isinstance(FileToAnalyse, str):
+            FileToAnalyse = [FileToAnalyse]
+        FileKey = hashlib.sha1(repr(sorted(kwds.items())).encode())
+        StateKey = hashlib.sha1()
+        for file in FileToAnalyse:
+            FileLocation = Path(AnalysisPath) / file
+            if not os.path.isfile(FileLocation):
+                FileLocation = Path(str(FileLocation) + '.bin')
+            FileKey.update(str(FileLocation.resolve()).encode())
+            for StatFile in [FileLocation, Path(str(FileLocation) + 'header')]:
+                if os.path.isfile(StatFile):
+                    FileStats = os.stat(StatFile)
+                    StateKey.update(f'{FileStats.st_size}_{FileStats.st_mtime_ns}'.encode())
+        return FileKey.hexdigest()[:16], StateKey.hexdigest()[:16]
+
+    def GetWaterTankData(self, AnalysisPath, FileToAnalyse, **kwds):
+        """
+        The WaterTankData for a reference, read the first time it is requested (or loaded from CacheFile)
+
+        :param AnalysisPath: Location of result files
+        :type AnalysisPath: str or Path
+        :param FileToAnalyse: all result files to read in
+        :type FileToAnalyse: str, or list of strings
+        :param kwds: any other WaterTankData options
+        :returns: the WaterTankData. This is shared by every caller, so shouldn't be modified
+        """
+        FileKey, StateKey = self._GetKey(AnalysisPath, FileToAnalyse, **kwds)
+        Key = f'{FileKey}__{StateKey}'
+        with self._Lock:
+            if Key in self._WaterTankData:
+                return self._WaterTankData[Key]
+            DoseCube = self._Saved.get(f'{Key}__DoseCube')
+        Reference = WaterTankData(AnalysisPath, FileToAnalyse, DoseCube=DoseCube, **kwds)
+        with self._Lock:
+            for OldKey in list(self._WaterTankData):
+                if OldKey.startswith(FileKey + '__') and OldKey != Key:
+                    del self._WaterTankData[OldKey]  # the files have changed since this was read
+            self._WaterTankData[Key] = Reference
+            self._Keys = {ID: ReferenceKey for ID, ReferenceKey in self._Keys.items()
+                          if ReferenceKey in self._WaterTankData}
+            self._Keys[id(Reference)] = Key
+        if DoseCube is None:
+            self._Store(Key, {'DoseCube': Reference.DoseCube})
+        return Reference
+
+    def ExtractDataFromDoseCube(self, Reference, Xpts, Ypts, Zpts):
+        """
+        As WaterTankData.ExtractDataFromDoseCube, but the data extracted at each set of points is remembered
+
+        :param Reference: a WaterTankData returned by GetWaterTankData
+        :type Reference: WaterTankData
+        :param Xpts: x points
+        :param Ypts: y points
+        :param Zpts: z points
+        :returns: numpy array of Dose at [Xpts, Ypts, Zpts]. Shape is the same as the input coordinate arrays
+        """
+        Key = self._Keys.get(id(Reference))
+        if Key is None:
+            raise ValueError('Reference must be a WaterTankData returned by GetWaterTankData')
+        PointsKey = hashlib.sha1()
+        for Points in (Xpts, Ypts, Zpts):
+            Points = np.asarray(Points, dtype=float)
+            PointsKey.update(repr(Points.shape).encode())
+            PointsKey.update(np.ascontiguousarray(Points).tobytes())
+        Name = f'{Key}__{PointsKey.hexdigest()[:16]}'
+        with self._Lock:
+            if Name in self._Saved:
+                return self._Saved[Name].copy()
+        ExtractedData = Reference.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
+        self._Store(Key, {PointsKey.hexdigest()[:16]: ExtractedData})
+        return ExtractedData.copy()
+
+    def _Store(self, Key, Arrays):
+        """
+        Remember some arrays belonging to the reference Key, and save them. Entries for earlier versions of the same
+        files are removed. CacheFile is only rewritten when the dose cubes change, and ExtractedFile when the
+        extracted data do
+        """
+        FileKey = Key.split('__')[0]
+        with self._Lock:
+            Changed = [Name for Name in self._Saved
+                       if Name.startswith(FileKey + '__') and not Name.startswith(Key + '__')]
+            for Name in Changed:
+                del self._Saved[Name]  # the files have changed since this was stored
+            for Name, Array in Arrays.items():
+                self._Saved[f'{Key}__{Name}'] = Array
+                Changed.append(f'{Key}__{Name}')
+        if self.CacheFile is None:
+            return
+        with self._WriteLock:
+            with self._Lock:
+                Saved = dict(self._Saved)
+            for File, IsDoseCube, Save in [(self.CacheFile, True, np.savez_compressed),
+                                           (self.ExtractedFile, False, np.savez)]:
+                if not any(Name.endswith('__DoseCube') == IsDoseCube for Name in Changed):
+                    continue
+                # write to a temporary file first so that a crash can't leave a half written cache:
+                TemporaryFile = str(File) + '.tmp'
+                with open(TemporaryFile, 'wb') as f:
+                    Save(f, **{Name: Array for Name, Array in Saved.items()
+                               if Name.endswith('__DoseCube') == IsDoseCube})
+                os.replace(TemporaryFile, File)
+
+
+class SimulationCache:
+    """
+    A persistent on-disk cache of topas results, shared between optimisations. Each entry is keyed on a hash of the
+    fully rendered topas scripts, the topas executable, the G4 data location, and the shell script header; if a
+    model with identical inputs is requested again (e.g. a Nelder-Mead restart, a repeated suggestion, or the same
+    study in a different SimulationName), the stored results files and objective function are reused instead of
+    running topas.
+    The iteration number in file names and scripts (_itt_N) is ignored when hashing, and is replaced with the new
+    iteration number when results are restored. When the cache grows larger than MaxSizeGB, the least recently used
+    entries are deleted.
+
+    Basic use::
+
+        from TopasOpt.utilities import SimulationCache
+        Cache = SimulationCache('/data/TopasOptCache', MaxSizeGB=100)
+        Optimiser = NelderMeadOptimiser(..., SimulationCache=Cache)
+
+    :param CacheDirectory: where cached results are stored. Created if it doesn't exist
+    :type CacheDirectory: str or Path
+    :param MaxSizeGB: maximum size of the cache in GB
+    :type MaxSizeGB: float, optional
+    """
+
+    _IterationPlaceholder = '_itt_#'
+
+    def __init__(self, CacheDirectory, MaxSizeGB=50):
+        """
+        init method for SimulationCache. input options are in class docstring
+        """
+        self.CacheDirectory = Path(CacheDirectory)
+        self.MaxSizeGB = MaxSizeGB
+        self._FileHashes = {}  # (path, size, mtime): hash
+        if not os.path.isdir(self.CacheDirectory):
+            os.makedirs(self.CacheDirectory)
+
+    def __getstate__(self):
+        """
+        file hashes are only a speed up, no need to copy them when the optimiser is serialised
+        """
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __setstate__(self, state):
+        """
+        restore the user settings
+        """
+        self.__dict__.update(state)
+        self._FileHashes = {}
+
+    def HashFile(self, FileLocation):
+        """
+        Hash the contents of a file. Results are remembered for as long as the size and modification time of the file
+        don't change.
+
+        :param FileLocation: file to hash
+        :type FileLocation: str or Path
+        :returns: the hash as a hex string, or an empty string if the file doesn't exist
+        """
+        FileLocation = Path(FileLocation)
+        if not os.path.isfile(FileLocation):
+            return ''
+        FileStats = os.stat(FileLocation)
+        FileID = (str(FileLocation), FileStats.st_size, FileStats.st_mtime_ns)
+        if getattr(self, '_FileHashes', None) is None:
+            self._FileHashes = {}
+        if FileID not in self._FileHashes:
+            FileHash = hashlib.sha256()
+            with open(FileLocation, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    FileHash.update(chunk)
+            self._FileHashes[FileID] = FileHash.hexdigest()
+        return self._FileHashes[FileID]
+
+    def _RemoveIteration(self, text, Itteration):
+        """
+        Replace the iteration tag _itt_N in text with a placeholder
+        """
+        return re.sub(f'_itt_{Itteration}(?![0-9])', self._IterationPlaceholder, text)
+
+    def _EntryDirectory(self, CacheKey):
+        """
+        The directory a cache entry is stored in
+        """
+        return self.CacheDirectory / CacheKey
+
+    def GetKey(self, TopasScripts, Itteration, TopasLocation, G4dataLocation, ShellScriptHeader=None,
+               UpstreamKeys=None, ScriptDirectory=None):
+        """
+        Calculate the cache key for a model.
+
+        :param TopasScripts: the scripts returned by GenerateTopasScripts; each script is a list of lines
+        :type TopasScripts: list
+        :param Itteration: the iteration the scripts were generated for
+        :type Itteration: int
+        :param TopasLocation: location of the topas installation. The topas executable is hashed, so that changing
+            version invalidates the cache
+        :type TopasLocation: str or Path
+        :param G4dataLocation: location of G4data files
+        :type G4dataLocation: str or Path
+        :param ShellScriptHeader: the header of the shell script used to run topas
+        :type ShellScriptHeader: str, optional
+        :param UpstreamKeys: when caching a single stage of a multi-stage model, the keys of the stages whose
+            outputs (e.g. phase space files) it reads
+        :type UpstreamKeys: list, optional
+        :param ScriptDirectory: the directory topas is run from. Include files with relative paths are found relative
+            to this directory, rather than the current working directory
+        :type ScriptDirectory: str or Path, optional
+        :returns: CacheKey: a string identifying the model
+        """
+        KeyHash = hashlib.sha256()
+        for script in TopasScripts:
+            for line in script:
+                line = self._RemoveIteration(line, Itteration)
+                KeyHash.update(line.encode())
+                KeyHash.update(b'\n')
+                if 'includefile' in line.lower() and '=' in line:
+                    # an include file can change without the line which includes it changing
+                    for IncludeFile in line.split('=', 1)[1].replace('"', '').split():
+                        IncludeFile = Path(os.path.expanduser(IncludeFile))
+                        if ScriptDirectory is not None and not IncludeFile.is_absolute():
+                            IncludeFile = Path(ScriptDirectory) / IncludeFile
+                        KeyHash.update(self.HashFile(IncludeFile).encode())
+            KeyHash.update(b'\x00')  # script boundary
+        KeyHash.update(self.HashFile(Path(os.path.expanduser(str(TopasLocation))) / 'bin' / 'topas').encode())
+        KeyHash.update(str(G4dataLocation).encode())
+        KeyHash.update(str(ShellScriptHeader).encode())
+        if UpstreamKeys is not None:
+            for UpstreamKey in UpstreamKeys:
+                KeyHash.update(UpstreamKey.encode())
+        return KeyHash.hexdigest()
+
+    def _ReadEntry(self, CacheKey):
+        """
+        Read the metadata of a cache entry, or return None if there is no (complete) entry
+        """
+        MetaDataLocation = self._EntryDirectory(CacheKey) / 'metadata.json'
+        if not os.path.isfile(MetaDataLocation):
+            return None
+        with open(MetaDataLocation) as f:
+            return json.load(f)
+
+    def _WriteEntry(self, CacheKey, MetaData):
+        """
+        Write the metadata of a cache entry. The file is renamed into place so a half written entry is never read
+        """
+        MetaDataLocation = self._EntryDirectory(CacheKey) / 'metadata.json'
+        TempLocation = self._EntryDirectory(CacheKey) / 'metadata.json.tmp'
+        with open(TempLocation, 'w') as f:
+            json.dump(MetaData, f)
+        os.replace(TempLocation, MetaDataLocation)
+
+    def RestoreResults(self, CacheKey, ResultsDirectory, Itteration):
+        """
+        If CacheKey is in the cache, copy its results files to ResultsDirectory, named for iteration Itteration.
+
+        :param CacheKey: key from GetKey
+        :type CacheKey: str
+        :param ResultsDirectory: where to copy the results
+        :type ResultsDirectory: str or Path
+        :param Itteration: iteration number to give the results files
+        :type Itteration: int
+        :returns: True if the results were restored, False if this model is not in the cache
+        """
+        MetaData = self._ReadEntry(CacheKey)
+        if MetaData is None:
+            return False
+        for CachedFile in MetaData['ResultsFiles']:
+            NewName = CachedFile.replace(self._IterationPlaceholder, f'_itt_{Itteration}')
+            shutil.copyfile(self._EntryDirectory(CacheKey) / CachedFile, Path(ResultsDirectory) / NewName)
+        os.utime(self._EntryDirectory(CacheKey) / 'metadata.json')  # mark as recently used
+        return True
+
+    def GetCachedFiles(self, CacheKey, Itteration):
+        """
+        Return the locations of the files stored in the cache for CacheKey, so that they can be hard linked rather
+        than copied. A hard link keeps the file even if the entry is later evicted, which a symbolic link wouldn't.
+
+        :param CacheKey: key from GetKey
+        :type CacheKey: str
+        :param Itteration: iteration number the files will be used for
+        :type Itteration: int
+        :returns: list of (cached file location, file name for this iteration), or None if this model is not in
+            the cache
+        """
+        MetaData = self._ReadEntry(CacheKey)
+        if MetaData is None:
+            return None
+        os.utime(self._EntryDirectory(CacheKey) / 'metadata.json')  # mark as recently used
+        return [(self._EntryDirectory(CacheKey) / CachedFile,
+                 CachedFile.replace(self._IterationPlaceholder, f'_itt_{Itteration}'))
+                for CachedFile in MetaData['ResultsFiles']]
+
+    def GetObjectiveFunction(self, CacheKey, ObjectiveFunctionHash):
+        """
+        Return the cached objective function value for a model, or None if it isn't known. Values calculated with
+        a different objective function are ignored.
+
+        :param CacheKey: key from GetKey
+        :type CacheKey: str
+        :param ObjectiveFunctionHash: identifies the objective function, e.g. a hash of TopasObjectiveFunction.py
+        :type ObjectiveFunctionHash: str
+        :returns: the objective function value (or [value, uncertainty]) or None
+        """
+        MetaData = self._ReadEntry(CacheKey)
+        if MetaData is None:
+            return None
+        return MetaData['ObjectiveFunctions'].get(ObjectiveFunctionHash)
+
+    def StoreResults(self, CacheKey, ResultsFiles, Itteration, ObjectiveFunction=None, ObjectiveFunctionHash=None):
+        """
+        Add a model to the cache. If it is already there, only the objective function value is updated.
+
+        :param CacheKey: key from GetKey
+        :type CacheKey: str
+        :param ResultsFiles: full paths of all the results files written by this model
+        :type ResultsFiles: list
+        :param Itteration: the iteration which wrote the results files
+        :type Itteration: int
+        :param ObjectiveFunction: objective function value calculated from these results, or (value, uncertainty)
+        :type ObjectiveFunction: float or tuple, optional
+        :param ObjectiveFunctionHash: identifies the objective function, e.g. a hash of TopasObjectiveFunction.py
+        :type ObjectiveFunctionHash: str, optional
+        """
+        MetaData = self._ReadEntry(CacheKey)
+        if MetaData is None:
+            EntryDirectory = self._EntryDirectory(CacheKey)
+            if not os.path.isdir(EntryDirectory):
+                os.mkdir(EntryDirectory)
+            MetaData = {'ResultsFiles': [], 'ObjectiveFunctions': {}}
+            for ResultsFile in ResultsFiles:
+                CachedFile = self._RemoveIteration(os.path.split(ResultsFile)[1], Itteration)
+                shutil.copyfile(ResultsFile, EntryDirectory / CachedFile)
+                MetaData['ResultsFiles'].append(CachedFile)
+        if ObjectiveFunction is not None and ObjectiveFunctionHash is not None:
+            MetaData['ObjectiveFunctions'][ObjectiveFunctionHash] = float(ObjectiveFunction) \
+                if np.ndim(ObjectiveFunction) == 0 else [float(value) for value in ObjectiveFunction]
+        self._WriteEntry(CacheKey, MetaData)
+        self._Evict()
+
+    def _Evict(self):
+        """
+        Delete the least recently used entries until the cache is smaller than MaxSizeGB
+        """
+        Entries = []
+        TotalSize = 0
+        for CacheKey in os.listdir(self.CacheDirectory):
+            EntryDirectory = self._EntryDirectory(CacheKey)
+            if not os.path.isfile(EntryDirectory / 'metadata.json'):
+                continue
+            EntrySize = sum(entry.stat().st_size for entry in os.scandir(EntryDirectory) if entry.is_file())
+            LastUsed = os.stat(EntryDirectory / 'metadata.json').st_mtime
+            Entries.append((LastUsed, EntrySize, EntryDirectory))
+            TotalSize = TotalSize + EntrySize
+        for LastUsed, EntrySize, EntryDirectory in sorted(Entries):
+            if TotalSize <= self.MaxSizeGB * 1e9:
+                break
+            shutil.rmtree(EntryDirectory, ignore_errors=True)
+            TotalSize = TotalSize - EntrySize
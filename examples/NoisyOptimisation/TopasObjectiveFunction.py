@@ -1,57 +1,75 @@
 import os
-from TopasOpt.utilities import WaterTankData
+from TopasOpt.utilities import ReferenceDataCache, ExtractDataFromResults
 import numpy as np
 from pathlib import Path
 
-def CalculateObjectiveFunction(TopasResults, GroundTruthResults, take_abs):
+ReferenceData = ReferenceDataCache()
+
+def GetGroundTruth():
     """
-    In this example, for metrics I am going to calculate the RMS error between the desired and actual
-    profile and PDD. I will use normalised values to account for the fact that there may be different numbers of
-    particles used between the different simulations
+    Read (or look up) the ground truth, and define the points we want to compare at
     """
+    GroundTruthDataPath = str(Path(r'/home/brendan/Downloads/SimpleCollimatorExample_TopasFiles/Results'))
+    # GroundTruthDataPath = str(
+    #     Path(r'Z:\python\TopasOpt\examples\NoisyOptimisation\SimpleCollimatorExample_TopasFiles\Results'))
+
+    # this assumes that you stored the base files in the same directory as this file, updated if needed
+    GroundTruthDataFile = 'WaterTank.bin'
+    GroundTruthResults = ReferenceData.GetWaterTankData(GroundTruthDataPath, GroundTruthDataFile)
 
     # define the points we want to collect our profile at:
     Xpts = np.linspace(GroundTruthResults.x.min(), GroundTruthResults.x.max(), 100)  # profile over entire X range
     Ypts = np.zeros(Xpts.shape)
     Zpts = GroundTruthResults.PhantomSizeZ * np.ones(Xpts.shape)  # at the middle of the water tank
-
-    OriginalProfile = GroundTruthResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
-    OriginalProfileNorm = OriginalProfile * 100 / OriginalProfile.max()
-    CurrentProfile = TopasResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
-    CurrentProfileNorm = CurrentProfile * 100 / CurrentProfile.max()
-    ProfileDifference = OriginalProfileNorm - CurrentProfileNorm
-
+    ProfilePoints = (Xpts, Ypts, Zpts)
     # define the points we want to collect our DD at:
     Zpts = GroundTruthResults.z
     Xpts = np.zeros(Zpts.shape)
     Ypts = np.zeros(Zpts.shape)
+    DepthDosePoints = (Xpts, Ypts, Zpts)
+
+    OriginalProfile = ReferenceData.ExtractDataFromDoseCube(GroundTruthResults, *ProfilePoints)
+    OriginalDepthDose = ReferenceData.ExtractDataFromDoseCube(GroundTruthResults, *DepthDosePoints)
+    return ProfilePoints, DepthDosePoints, OriginalProfile, OriginalDepthDose
+
+
+def CalculateObjectiveFunction(CurrentProfiles, CurrentDepthDoses, OriginalProfile, OriginalDepthDose, take_abs):
+    """
+    In this example, for metrics I am going to calculate the RMS error between the desired and actual
+    profile and PDD. I will use normalised values to account for the fact that there may be different numbers of
+    particles used between the different simulations.
+    Each row of CurrentProfiles and CurrentDepthDoses is a different result, so the objective function of every
+    result is calculated at once
+    """
+    OriginalProfileNorm = OriginalProfile * 100 / OriginalProfile.max()
+    CurrentProfileNorm = CurrentProfiles * 100 / CurrentProfiles.max(axis=1, keepdims=True)
+    ProfileDifference = OriginalProfileNorm - CurrentProfileNorm
 
-    OriginalDepthDose = GroundTruthResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
-    CurrentDepthDose = TopasResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
     OriginalDepthDoseNorm = OriginalDepthDose * 100 /np.max(OriginalDepthDose)
-    CurrentDepthDoseNorm = CurrentDepthDose * 100 / np.max(CurrentDepthDose)
+    CurrentDepthDoseNorm = CurrentDepthDoses * 100 / CurrentDepthDoses.max(axis=1, keepdims=True)
     DepthDoseDifference = OriginalDepthDoseNorm - CurrentDepthDoseNorm
 
 
     if take_abs:
-        ObjectiveFunction = np.mean(abs(ProfileDifference)) + np.mean(abs(DepthDoseDifference))
+        ObjectiveFunction = np.mean(abs(ProfileDifference), axis=1) + np.mean(abs(DepthDoseDifference), axis=1)
     else:
-        ObjectiveFunction = np.mean((ProfileDifference)) + np.mean((DepthDoseDifference))
+        ObjectiveFunction = np.mean((ProfileDifference), axis=1) + np.mean((DepthDoseDifference), axis=1)
     return ObjectiveFunction
 
 
-def TopasObjectiveFunction(ResultsLocation, iteration, take_abs=True):
+def TopasObjectiveFunctionBatch(ResultsLocation, iterations, take_abs=True):
+    """
+    The objective function of many iterations at once; the results are read 4 at a time
+    """
+    ProfilePoints, DepthDosePoints, OriginalProfile, OriginalDepthDose = GetGroundTruth()
+    ResultsFiles = [Path(ResultsLocation) / f'WaterTank_itt_{iteration}.bin' for iteration in iterations]
+    CurrentProfiles, CurrentDepthDoses = ExtractDataFromResults(ResultsFiles, [ProfilePoints, DepthDosePoints],
+                                                                Threads=4)
+    return CalculateObjectiveFunction(CurrentProfiles, CurrentDepthDoses, OriginalProfile, OriginalDepthDose,
+                                      take_abs)
 
-    ResultsFile = ResultsLocation / f'WaterTank_itt_{iteration}.bin'
-    path, file = os.path.split(ResultsFile)
-    CurrentResults = WaterTankData(path, file)
-    GroundTruthDataPath = str(Path(r'/home/brendan/Downloads/SimpleCollimatorExample_TopasFiles/Results'))
-    # GroundTruthDataPath = str(
-    #     Path(r'Z:\python\TopasOpt\examples\NoisyOptimisation\SimpleCollimatorExample_TopasFiles\Results'))
 
-    # this assumes that you stored the base files in the same directory as this file, updated if needed
-    GroundTruthDataFile = 'WaterTank.bin'
-    GroundTruthResults = WaterTankData(GroundTruthDataPath, GroundTruthDataFile)
-    
-    OF = CalculateObjectiveFunction(CurrentResults, GroundTruthResults, take_abs)
+def TopasObjectiveFunction(ResultsLocation, iteration, take_abs=True):
+
+    OF = TopasObjectiveFunctionBatch(ResultsLocation, [iteration], take_abs)[0]
     return OF
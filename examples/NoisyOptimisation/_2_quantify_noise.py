@@ -1,7 +1,7 @@
 from pathlib import Path
 from TopasOpt.utilities import get_all_files
 import numpy as np
-from TopasObjectiveFunction import TopasObjectiveFunction
+from TopasObjectiveFunction import TopasObjectiveFunctionBatch
 from matplotlib import pyplot as plt
 
 def plot_objective_function_variability(BoxPlotData, labels=None):
@@ -35,11 +35,8 @@ j = 0
 for sim in sims_to_investigate:
     data_loc = data_dir / sim / 'Results'
     results = get_all_files(data_loc, 'bin')
-    iteration = 0
-    for result in results:
-        objective_value = TopasObjectiveFunction(data_loc, iteration)
-        of_results[j].append(objective_value)
-        iteration += 1
+    # every result is read and evaluated in one pass:
+    of_results[j].extend(TopasObjectiveFunctionBatch(data_loc, range(len(results))))
     print(f'mean for {sim}: {np.mean(of_results[j]): 1.10f} ')
     print(f'standard deviation for {sim}: {np.std(of_results[j]): 1.10f} ')
     j += 1
@@ -1,6 +1,6 @@
 import numpy as np
 from pathlib import Path
-from TopasObjectiveFunction import TopasObjectiveFunction
+from TopasObjectiveFunction import TopasObjectiveFunctionBatch
 from TopasOpt.utilities import get_all_files
 from bayes_opt import BayesianOptimization
 from bayes_opt import UtilityFunction
@@ -37,15 +37,14 @@ j = 0
 for sim in sims_to_investigate:
     data_loc = data_dir / sim / 'Results'
     results = get_all_files(data_loc, 'bin')
-    iteration = 0
     utility = UtilityFunction(kind="ucb", kappa=2.5, xi=0.0)
     optimizer = BayesianOptimization(f=None,pbounds=pbounds,  verbose=2, random_state=1)
     optimizer.set_gp_params(kernel=custom_kernel)
-    for result in results:
-        objective_value = TopasObjectiveFunction(data_loc, iteration, take_abs=True)
-        # note we added a new parameter so we aren't automatically taking absolute values
+    # every result is read and evaluated in one pass:
+    objective_values = TopasObjectiveFunctionBatch(data_loc, range(len(results)), take_abs=True)
+    # note we added a new parameter so we aren't automatically taking absolute values
+    for objective_value in objective_values:
         of_results[j].append(objective_value)
-        iteration += 1
         optimizer.register(params=parameter_values, target=objective_value)
     # because we are running this in a pretty weird way we have to manually fit the model:
     optimizer._gp.fit(optimizer._space.params, optimizer._space.target)
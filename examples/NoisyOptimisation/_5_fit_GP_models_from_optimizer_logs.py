@@ -1,5 +1,5 @@
 import numpy as np
-from TopasObjectiveFunction import TopasObjectiveFunction
+from TopasObjectiveFunction import TopasObjectiveFunctionBatch
 from TopasOpt.utilities import get_all_files
 from noise_box_plots import plot_gp_model_versus_data
 from sklearn.gaussian_process.kernels import Matern, WhiteKernel
@@ -33,12 +33,9 @@ for n_particles in [10e3, 20e3, 30e3, 40e3, 50e3]:
     if test_sim_name in sims_to_investigate:
         data_loc = data_dir / test_sim_name / 'Results'
         results = get_all_files(data_loc, 'bin')
-        iteration = 0
-        for result in results:
-            objective_value = TopasObjectiveFunction(data_loc, iteration, take_abs=True)
-            # note we added a new parameter so we aren't automatically taking absolute values
-            of_results[j].append(objective_value)
-            iteration += 1
+        # every result is read and evaluated in one pass:
+        of_results[j].extend(TopasObjectiveFunctionBatch(data_loc, range(len(results)), take_abs=True))
+        # note we added a new parameter so we aren't automatically taking absolute values
         j += 1
 
     # update simulation name:
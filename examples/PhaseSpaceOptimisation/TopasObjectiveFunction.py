@@ -1,8 +1,10 @@
 import os
-from TopasOpt.utilities import WaterTankData
+from TopasOpt.utilities import WaterTankData, ReferenceDataCache
 import numpy as np
 from pathlib import Path
 
+ReferenceData = ReferenceDataCache()
+
 def CalculateObjectiveFunction(TopasResults, GroundTruthResults):
     """
     In this example, for metrics I am going to calculate the RMS error between the desired and actual
@@ -15,7 +17,7 @@ def CalculateObjectiveFunction(TopasResults, GroundTruthResults):
     Ypts = np.zeros(Xpts.shape)
     Zpts = GroundTruthResults.PhantomSizeZ * np.ones(Xpts.shape)  # at the middle of the water tank
 
-    OriginalProfile = GroundTruthResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
+    OriginalProfile = ReferenceData.ExtractDataFromDoseCube(GroundTruthResults, Xpts, Ypts, Zpts)
     OriginalProfileNorm = OriginalProfile * 100 / OriginalProfile.max()
     CurrentProfile = TopasResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
     CurrentProfileNorm = CurrentProfile * 100 / CurrentProfile.max()
@@ -26,7 +28,7 @@ def CalculateObjectiveFunction(TopasResults, GroundTruthResults):
     Xpts = np.zeros(Zpts.shape)
     Ypts = np.zeros(Zpts.shape)
 
-    OriginalDepthDose = GroundTruthResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
+    OriginalDepthDose = ReferenceData.ExtractDataFromDoseCube(GroundTruthResults, Xpts, Ypts, Zpts)
     CurrentDepthDose = TopasResults.ExtractDataFromDoseCube(Xpts, Ypts, Zpts)
     OriginalDepthDoseNorm = OriginalDepthDose * 100 /np.max(OriginalDepthDose)
     CurrentDepthDoseNorm = CurrentDepthDose * 100 / np.max(CurrentDepthDose)
@@ -44,7 +46,7 @@ def TopasObjectiveFunction(ResultsLocation, iteration):
     GroundTruthDataPath = str(Path(__file__).parent / 'SimpleCollimatorExample_TopasFiles' / 'Results')
     # this assumes that you stored the base files in the same directory as this file, updated if needed
     GroundTruthDataFile = 'WaterTank.bin'
-    GroundTruthResults = WaterTankData(GroundTruthDataPath, GroundTruthDataFile)
+    GroundTruthResults = ReferenceData.GetWaterTankData(GroundTruthDataPath, GroundTruthDataFile)
 
     OF = CalculateObjectiveFunction(CurrentResults, GroundTruthResults)
     return OF
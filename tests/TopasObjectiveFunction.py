@@ -2,4 +2,19 @@
 This does nothing, it is just here to enable tests to run
 """
 def TopasObjectiveFunction(ResultsLocation, iteration):
-    return 0
\ No newline at end of file
+    return 0
+
+
+def TopasObjectiveFunctionWithUncertainty(ResultsLocation, iteration):
+    """
+    for tests with bayes_MeasuredNoise. In testing mode the objective function is replaced by the rosenbrock
+    function, so only the uncertainty is used
+    """
+    return 0, 0.1
+
+
+def TopasPartialObjectiveFunction(ResultsLocation, iteration):
+    """
+    pretends every simulation is clearly worse than the best so far, to test early termination
+    """
+    return 100, 1
@@ -11,7 +11,8 @@ from pathlib import Path
 this_dir = Path(__file__).parent
 sys.path.insert(0, str(this_dir.parent))
 
-from TopasOpt.TopasScriptGenerator import generate_topas_script_generator
+from TopasOpt.TopasScriptGenerator import generate_topas_script_generator, find_script_dependencies, \
+    get_script_run_order, set_number_of_threads, split_topas_script, has_mergeable_outputs
 from pathlib import Path
 
 def test_topas_script_generator():
@@ -23,3 +24,56 @@ def test_topas_script_generator():
 
 
     generate_topas_script_generator(this_directory, Input_files)
+
+
+def test_script_run_order():
+    """
+    WaterTank reads the phase space written by SimpleCollimator so must run after it. A second scorer reading the
+    same phase space is independent of WaterTank so can run alongside it.
+    """
+    sys.path.insert(0, str(Path(__file__).parent))
+    from GenerateTopasScripts import GenerateTopasScripts
+    (SimpleCollimator, WaterTank), ScriptNames = GenerateTopasScripts('.', 3)
+    SecondWaterTank = [line.replace('WaterTank_itt', 'SecondWaterTank_itt') for line in WaterTank]
+
+    assert find_script_dependencies([SimpleCollimator, WaterTank, SecondWaterTank]) == [set(), {0}, {0}]
+    assert get_script_run_order([SimpleCollimator, WaterTank, SecondWaterTank]) == [[0], [1, 2]]
+    assert get_script_run_order([WaterTank, SecondWaterTank]) == [[0, 1]]
+
+    set_number_of_threads(WaterTank, 4)
+    assert 'i:Ts/NumberOfThreads = 4' in WaterTank
+    assert not any('NumberOfThreads = 0' in line for line in WaterTank)
+
+
+def test_split_topas_script():
+    """
+    splitting SimpleCollimator into three jobs should share out its histories, give each job its own seed and
+    its own phase space file. WaterTank doesn't set the number of histories so can't be split
+    """
+    sys.path.insert(0, str(Path(__file__).parent))
+    from GenerateTopasScripts import GenerateTopasScripts
+    (SimpleCollimator, WaterTank), ScriptNames = GenerateTopasScripts('.', 3)
+
+    Scripts, Histories = split_topas_script(SimpleCollimator, 3)
+    assert Histories == [166667, 166667, 166666]
+    for k, Script in enumerate(Scripts):
+        assert f'i:Ts/Seed = {k + 1}' in Script
+        assert any(f'coll_PhaseSpace_split_{k}_itt_3' in line for line in Script)
+        assert not any('coll_PhaseSpace_itt_3' in line for line in Script)
+    Scripts, Histories = split_topas_script(WaterTank, 3)
+    assert Histories is None
+    assert Scripts == [WaterTank]
+
+
+def test_has_mergeable_outputs():
+    """
+    the binary dose in WaterTank can be merged after splitting, but the phase space from SimpleCollimator can't, and
+    neither can a csv dose (the topas default)
+    """
+    sys.path.insert(0, str(Path(__file__).parent))
+    from GenerateTopasScripts import GenerateTopasScripts
+    (SimpleCollimator, WaterTank), ScriptNames = GenerateTopasScripts('.', 3)
+
+    assert has_mergeable_outputs(WaterTank)
+    assert not has_mergeable_outputs(SimpleCollimator)
+    assert not has_mergeable_outputs([line for line in WaterTank if 'OutputType' not in line])
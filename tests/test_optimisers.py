@@ -10,6 +10,8 @@ because it does not allow direct user interaction (will throw an error if anyone
 """
 
 import os
+import shutil
+import subprocess
 import sys
 import numpy as np
 from pathlib import Path
@@ -17,7 +19,10 @@ from pathlib import Path
 this_dir = Path(__file__).parent
 sys.path.insert(0, str(this_dir.parent))
 from TopasOpt import Optimisers as to
-from TopasOpt.utilities import ReadInLogFile
+from TopasOpt.utilities import ReadInLogFile, SimulationCache, AppendToBinaryLog, ExportLogToText
+from TopasOpt.Executors import FakeSchedulerExecutor, SlurmExecutor
+from GenerateTopasScripts import GenerateTopasScripts
+from TopasObjectiveFunction import TopasObjectiveFunctionWithUncertainty
 
 # set up file structure (same for all tests)
 BaseDirectory = Path('./temp_test').resolve()
@@ -37,6 +42,29 @@ optimisation_params['Nitterations'] = 100
 ReadMeText = 'This directory only exists for testing; it can be deleted'
 
 
+class Interrupt(Exception):
+    """
+    stands in for an optimisation being killed
+    """
+
+
+def InterruptAt(Optimiser, Itteration):
+    """
+    make Optimiser stop with Interrupt when it evaluates the objective function of iteration Itteration
+    """
+    ObjectiveFunction = Optimiser.TopasObjectiveFunction
+
+    def InterruptedObjectiveFunction(ResultsLocation, iteration):
+        """
+        the original objective function, until Itteration
+        """
+        if iteration == Itteration:
+            raise Interrupt
+        return ObjectiveFunction(ResultsLocation, iteration)
+
+    Optimiser.TopasObjectiveFunction = InterruptedObjectiveFunction
+
+
 
 def test_Nelder_Mead():
     ## Test Nelder Mead:
@@ -71,6 +99,74 @@ def test_Nelder_Mead_UserDefinedSimplex():
     assert 0.9 <= best_y <= 1.1  # test answer within plus/minus 10% of truth
 
 
+def test_Nelder_MeadRestart():
+    """
+    stop an optimisation after 20 iterations and restart it for 40. The simplex is restored from the checkpoint,
+    so the result should be identical to running 40 iterations in one go
+    """
+    NM_params = dict(optimisation_params, Nitterations=40)
+    for Nitterations, SimulationName_ in [(40, 'development_test_NM_full'), (20, 'development_test_NM_restart')]:
+        Optimiser = to.NelderMeadOptimiser(optimisation_params=dict(NM_params, Nitterations=Nitterations),
+                                           BaseDirectory=BaseDirectory, SimulationName=SimulationName_,
+                                           OptimisationDirectory=OptimisationDirectory, TopasLocation='testing_mode',
+                                           ReadMeText=ReadMeText, Overwrite=True, KeepAllResults=False,
+                                           NM_StartingSimplex=.1)
+        Optimiser.RunOptimisation()
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=NM_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_NM_restart',
+                                       OptimisationDirectory=OptimisationDirectory, TopasLocation='testing_mode',
+                                       ReadMeText=ReadMeText, Overwrite=True, KeepAllResults=False,
+                                       NM_StartingSimplex=.1)
+    Optimiser.RestartOptimisation()
+    Full = ReadInLogFile(BaseDirectory / 'development_test_NM_full' / 'logs' / 'OptimisationLogs.bin')
+    Restarted = ReadInLogFile(BaseDirectory / 'development_test_NM_restart' / 'logs' / 'OptimisationLogs.bin')
+    assert Restarted['Itteration'] == list(range(40))
+    assert np.allclose(Restarted['x'], Full['x'])
+    assert np.allclose(Restarted['ObjectiveFunction'], Full['ObjectiveFunction'])
+    # the simplex is restored rather than rebuilt, and no point is ever simulated twice:
+    assert Optimiser._NelderMeadSteps > 0
+    assert len(np.unique(np.array([Restarted['x'], Restarted['y']]).T, axis=0)) == 40
+
+
+def test_Nelder_MeadSpeculative():
+    """
+    the speculative variant simulates all the candidate points of each step at once, so it takes more simulations
+    but should follow exactly the same path to exactly the same answer
+    """
+    Results = []
+    for NM_Speculative in [False, True]:
+        Optimiser = to.NelderMeadOptimiser(optimisation_params=dict(optimisation_params, Nitterations=300),
+                                           BaseDirectory=BaseDirectory, SimulationName=SimulationName,
+                                           OptimisationDirectory=OptimisationDirectory, TopasLocation='testing_mode',
+                                           ReadMeText=ReadMeText, Overwrite=True, KeepAllResults=False,
+                                           NM_StartingSimplex=.1, NM_Speculative=NM_Speculative)
+        Optimiser.RunOptimisation()
+        Results.append(Optimiser.NelderMeadRes)
+    Sequential, Speculative = Results
+    assert Sequential.success and Speculative.success
+    assert Speculative.nit == Sequential.nit
+    assert np.array_equal(Speculative.final_simplex[0], Sequential.final_simplex[0])
+    assert Speculative.nfev > Sequential.nfev
+    assert np.allclose(Speculative.x, [1, 1], atol=0.01)
+
+
+def test_Nelder_MeadBudget():
+    """
+    when MaxItterations doesn't leave room for all the vertices of the starting simplex, the remaining iterations
+    are still used, whether or not the vertices would otherwise be simulated at the same time
+    """
+    for NM_Speculative in [False, True]:
+        Optimiser = to.NelderMeadOptimiser(optimisation_params=dict(optimisation_params, Nitterations=2),
+                                           BaseDirectory=BaseDirectory, SimulationName=SimulationName,
+                                           OptimisationDirectory=OptimisationDirectory, TopasLocation='testing_mode',
+                                           ReadMeText=ReadMeText, Overwrite=True, KeepAllResults=False,
+                                           NM_StartingSimplex=.1, NM_Speculative=NM_Speculative)
+        Optimiser.RunOptimisation()
+        assert Optimiser.Itteration == 2
+        ResultsDict = ReadInLogFile(BaseDirectory / SimulationName / 'logs' / 'OptimisationLogs.bin')
+        assert ResultsDict['Itteration'] == [0, 1]
+
+
 def test_Bayesian():
     ## Test Bayesian
     optimisation_params['Nitterations'] = 200
@@ -106,8 +202,104 @@ def test_BayesianRestart():
     best_y = ResultsDict['y'][best_solution_number]
     assert 0.9 <= best_x <= 1.1  # test answer within plus/minus 10% of truth
     assert 0.9 <= best_y <= 1.1  # test answer within plus/minus 10% of truth
+
+
+def test_BayesianCheckpointRestart():
+    """
+    stop an optimisation after 12 iterations and restart it for 20. The gaussian process is restored from the
+    checkpoint rather than refit, so the result should be identical to running 20 iterations in one go
+    """
+    checkpoint_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([2, 2]),
+                         'LowerBounds': np.array([-2, -2]), 'start_point': np.array([0, 0]), 'Nitterations': 20}
+    checkpoint_settings = dict(BaseDirectory=BaseDirectory, OptimisationDirectory=OptimisationDirectory,
+                               TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                               KeepAllResults=False, bayes_length_scales=.2, bayes_GPRefitInterval=5)
+    Full = to.BayesianOptimiser(optimisation_params=checkpoint_params,
+                                SimulationName='development_test_bayes_full', **checkpoint_settings)
+    Full.RunOptimisation()
+
+    Optimiser = to.BayesianOptimiser(optimisation_params=checkpoint_params,
+                                     SimulationName='development_test_bayes_restart', **checkpoint_settings)
+    InterruptAt(Optimiser, 12)
+    try:
+        Optimiser.RunOptimisation()
+        assert False  # the optimisation should have been interrupted
+    except Interrupt:
+        pass
+
+    Optimiser = to.BayesianOptimiser(optimisation_params=checkpoint_params,
+                                     SimulationName='development_test_bayes_restart', **checkpoint_settings)
+    Optimiser.RestartOptimisation()
+    # any refit on restoring would be one more full fit than the uninterrupted run needed:
+    assert Optimiser.optimizer._gp.n_full_fits_ == Full.optimizer._gp.n_full_fits_
+    FullLog = ReadInLogFile(BaseDirectory / 'development_test_bayes_full' / 'logs' / 'OptimisationLogs.bin')
+    RestartedLog = ReadInLogFile(BaseDirectory / 'development_test_bayes_restart' / 'logs' / 'OptimisationLogs.bin')
+    assert RestartedLog['Itteration'] == list(range(20))
+    assert np.allclose(RestartedLog['x'], FullLog['x'])
+    assert np.allclose(RestartedLog['y'], FullLog['y'])
+    assert np.allclose(RestartedLog['ObjectiveFunction'], FullLog['ObjectiveFunction'])
 #
 
+hybrid_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([2, 2]),
+                 'LowerBounds': np.array([-2, -2]), 'start_point': np.array([0, 0]), 'Nitterations': 50}
+hybrid_settings = dict(OptimisationDirectory=OptimisationDirectory, TopasLocation='testing_mode',
+                       ReadMeText=ReadMeText, Overwrite=True, KeepAllResults=False, bayes_KappaDecayIterations=12,
+                       bayes_UCBkappa=6, bayes_GP_alpha=1e-6, hybrid_LocalItterations=20, hybrid_TrustRadius=0.2)
+
+
+def test_Hybrid():
+    """
+    after the bayesian search, the remaining iterations are spent on a trust region search around the best point
+    found. The optimum is inside the bounds here, so that there is something to refine
+    """
+    Optimiser = to.HybridOptimiser(optimisation_params=hybrid_params, BaseDirectory=BaseDirectory,
+                                   SimulationName='development_test_hybrid', **hybrid_settings)
+    Optimiser.RunOptimisation()
+    assert Optimiser.MaxItterations == 50
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_hybrid' / 'logs' / 'OptimisationLogs.bin')
+    ObjectiveFunction = ResultsDict['ObjectiveFunction']
+    # the refinement stops early only if there was nothing left worth simulating:
+    assert len(ObjectiveFunction) == 50 or Optimiser._TrustRadius < Optimiser.hybrid_MinTrustRadius
+    # the refinement simulated points, and found a better one than the bayesian search:
+    assert len(ObjectiveFunction) > 30
+    assert np.min(ObjectiveFunction[30:]) < np.min(ObjectiveFunction[:30])
+    # every refinement step is within the trust region around a point which had already been probed:
+    Points = np.array([ResultsDict['x'], ResultsDict['y']]).T
+    for n in range(30, len(Points)):
+        assert np.min(np.max(np.abs(Points[:n] - Points[n]), axis=1)) <= 0.2 * 4 + 1e-9
+
+
+def test_HybridRestart():
+    """
+    stop the optimisation of test_Hybrid part way through the refinement and restart it. The trust region is
+    restored from the checkpoint, so the result should be identical to running it in one go
+    """
+    Optimiser = to.HybridOptimiser(optimisation_params=hybrid_params, BaseDirectory=BaseDirectory,
+                                   SimulationName='development_test_hybrid_restart', **hybrid_settings)
+    InterruptAt(Optimiser, 35)
+    try:
+        Optimiser.RunOptimisation()
+        assert False  # the optimisation should have been interrupted
+    except Interrupt:
+        pass
+    TrustRadius = Optimiser._TrustRadius
+    assert TrustRadius < Optimiser.hybrid_TrustRadius  # so that restoring it makes a difference
+
+    Optimiser = to.HybridOptimiser(optimisation_params=hybrid_params, BaseDirectory=BaseDirectory,
+                                   SimulationName='development_test_hybrid_restart', **hybrid_settings)
+    Optimiser._SetCheckpointState(Optimiser._ReadCheckpoint())
+    assert Optimiser._TrustRadius == TrustRadius
+    Optimiser = to.HybridOptimiser(optimisation_params=hybrid_params, BaseDirectory=BaseDirectory,
+                                   SimulationName='development_test_hybrid_restart', **hybrid_settings)
+    Optimiser.RestartOptimisation()
+    Full = ReadInLogFile(BaseDirectory / 'development_test_hybrid' / 'logs' / 'OptimisationLogs.bin')
+    Restarted = ReadInLogFile(BaseDirectory / 'development_test_hybrid_restart' / 'logs' / 'OptimisationLogs.bin')
+    assert Restarted['Itteration'] == Full['Itteration']
+    assert np.allclose(Restarted['x'], Full['x'])
+    assert np.allclose(Restarted['y'], Full['y'])
+    assert np.allclose(Restarted['ObjectiveFunction'], Full['ObjectiveFunction'])
+
+
 def test_passing_wrong_parameters():
     """
     in this test I want to see what happens when I pass an optimiser parameters it should not be receiving, e.g.
@@ -133,3 +325,463 @@ def test_passing_wrong_parameters():
     except TypeError:
         # this is exactly what should happen
         pass
+
+
+def test_ConstantLiarStrategy():
+    """
+    a number is accepted as the lie whether or not it is written as a float, while anything else which isn't one of
+    bayes_opt's strategies is refused
+    """
+    Optimiser = to.BayesianOptimiser(optimisation_params=optimisation_params, BaseDirectory=BaseDirectory,
+                                     SimulationName=SimulationName, OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_BatchSize=2, bayes_ConstantLiarStrategy=-10)
+    assert Optimiser._batch_acquisition.strategy == -10.0
+    try:
+        to.BayesianOptimiser(optimisation_params=optimisation_params, BaseDirectory=BaseDirectory,
+                             SimulationName=SimulationName, OptimisationDirectory=OptimisationDirectory,
+                             TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                             KeepAllResults=False, bayes_BatchSize=2, bayes_ConstantLiarStrategy='median')
+        assert False  # arriving here counts as failure
+    except SystemExit:
+        pass
+
+
+def test_BayesianBatch():
+    """
+    with bayes_BatchSize > 1, several points are suggested and simulated together in each round.
+    we check that exactly Nitterations are carried out and that the optimiser still makes progress, also when the
+    gaussian process is only refit every few iterations
+    """
+    batch_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 30}
+    Optimiser = to.BayesianOptimiser(optimisation_params=batch_params, BaseDirectory=BaseDirectory,
+                                     SimulationName='development_test_batch',
+                                     OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_length_scales=.2, bayes_BatchSize=4,
+                                     PlotEveryNIterations=8, bayes_GPRefitInterval=8)
+    Optimiser.RunOptimisation()
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_batch' / 'logs' / 'OptimisationLogs.txt')
+    assert ResultsDict['Itteration'] == list(np.arange(30, dtype=float))
+    assert np.min(ResultsDict['ObjectiveFunction']) < ResultsDict['ObjectiveFunction'][0]
+    # one shell script per iteration in the batch:
+    assert os.path.isfile(BaseDirectory / 'development_test_batch' / 'TopasScripts' / 'RunIteration_itt_29.sh')
+    # slices through the final model can be predicted without plotting:
+    Slices, PairwiseSlices = Optimiser.PredictParameterSlices(Nsamples=50, Pairwise=True, PairwiseSamples=10)
+    assert Slices['x'][1].shape == (50,)
+    assert PairwiseSlices[('x', 'y')][2].shape == (10, 10)
+    # in between hyperparameter refits, points are added to the gaussian process incrementally:
+    assert Optimiser.optimizer._gp.n_full_fits_ < 10
+
+
+def test_BayesianAsynchronous():
+    """
+    with bayes_Asynchronous=True, bayes_BatchSize simulations are kept running and a new point is suggested as each
+    one finishes. Results can arrive in any order, but every iteration should be logged exactly once
+    """
+    async_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 30}
+    Optimiser = to.BayesianOptimiser(optimisation_params=async_params, BaseDirectory=BaseDirectory,
+                                     SimulationName='development_test_async',
+                                     OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_length_scales=.2, bayes_BatchSize=3,
+                                     bayes_Asynchronous=True)
+    Optimiser.RunOptimisation()
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_async' / 'logs' / 'OptimisationLogs.txt')
+    assert sorted(ResultsDict['Itteration']) == list(np.arange(30, dtype=float))
+    assert np.min(ResultsDict['ObjectiveFunction']) < ResultsDict['ObjectiveFunction'][0]
+
+
+def test_BayesianAsynchronousRestart():
+    """
+    an asynchronous optimisation which is interrupted while later iterations have already finished should rerun the
+    simulations which were still in flight on restart, so every iteration is still logged exactly once
+    """
+    async_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 20}
+    async_settings = {'BaseDirectory': BaseDirectory, 'SimulationName': 'development_test_async_restart',
+                      'OptimisationDirectory': OptimisationDirectory, 'TopasLocation': 'testing_mode',
+                      'ReadMeText': ReadMeText, 'Overwrite': True, 'KeepAllResults': False,
+                      'bayes_length_scales': .2, 'bayes_BatchSize': 3, 'bayes_Asynchronous': True}
+    Optimiser = to.BayesianOptimiser(optimisation_params=async_params,
+                                     Executor=FakeSchedulerExecutor(JobDuration=(0, 0.2), random_state=1),
+                                     **async_settings)
+    ObjectiveFunction = Optimiser.TopasObjectiveFunction
+
+    def InterruptedObjectiveFunction(ResultsLocation, iteration):
+        """
+        the original objective function, until an iteration has been logged while an earlier one was still running
+        """
+        Observed = [Observation[0] for Observation in Optimiser._Observations]
+        if Observed and min(list(Optimiser._InFlight) + [iteration]) < max(Observed):
+            raise Interrupt
+        return ObjectiveFunction(ResultsLocation, iteration)
+
+    Optimiser.TopasObjectiveFunction = InterruptedObjectiveFunction
+    try:
+        Optimiser.RunOptimisation()
+        assert False  # the optimisation should have been interrupted
+    except Interrupt:
+        pass
+    State = Optimiser._ReadCheckpoint()
+    Observed = [Observation[0] for Observation in State['Observations']]
+    # the checkpoint has a gap below the last iteration to finish:
+    assert min(State['InFlight']) < max(Observed)
+    assert State['Itteration'] == max(list(State['InFlight']) + Observed) + 1
+
+    Executor = FakeSchedulerExecutor(JobDuration=(0, 0.2), random_state=1)
+    Optimiser = to.BayesianOptimiser(optimisation_params=async_params, Executor=Executor, **async_settings)
+    Optimiser.RestartOptimisation()
+    Resubmitted = [Path(Script).name for Script in Executor.SubmittedScripts[:len(State['InFlight'])]]
+    assert Resubmitted == [f'RunIteration_itt_{Itteration}.sh' for Itteration in sorted(State['InFlight'])]
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_async_restart' / 'logs' / 'OptimisationLogs.txt')
+    assert sorted(ResultsDict['Itteration']) == list(np.arange(20, dtype=float))
+
+
+
+def test_BayesianSparse():
+    """
+    with bayes_SparseInducingPoints set, the gaussian process switches to a sparse approximation once there are more
+    results than inducing points, and the optimisation carries on as normal
+    """
+    sparse_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                     'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 30}
+    Optimiser = to.BayesianOptimiser(optimisation_params=sparse_params, BaseDirectory=BaseDirectory,
+                                     SimulationName='development_test_sparse',
+                                     OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_length_scales=.2, bayes_SparseInducingPoints=10)
+    Optimiser.RunOptimisation()
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_sparse' / 'logs' / 'OptimisationLogs.txt')
+    assert ResultsDict['Itteration'] == list(np.arange(30, dtype=float))
+    assert np.min(ResultsDict['ObjectiveFunction']) < ResultsDict['ObjectiveFunction'][0]
+    assert Optimiser.optimizer._gp.sparse_
+
+
+def test_BayesianAdaptivePrimaries():
+    """
+    with bayes_AdaptivePrimaries, the number of primaries is chosen within the given range for every iteration and
+    logged, along with the uncertainty returned by TopasObjectiveFunctionWithUncertainty, which the gaussian process
+    uses as the noise of each point
+    """
+    noise_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 12}
+    Optimiser = to.BayesianOptimiser(optimisation_params=noise_params, BaseDirectory=BaseDirectory,
+                                     SimulationName='development_test_adaptive_primaries',
+                                     OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_length_scales=.2,
+                                     bayes_AdaptivePrimaries=(1e3, 1e6))
+    Optimiser.TopasObjectiveFunction = TopasObjectiveFunctionWithUncertainty
+    Optimiser.RunOptimisation()
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_adaptive_primaries' / 'logs' /
+                                'OptimisationLogs.txt')
+    assert ResultsDict['n_primaries'][0] == 1e3
+    assert all(1e3 <= n_primaries <= 1e6 for n_primaries in ResultsDict['n_primaries'])
+    assert np.allclose(ResultsDict['ObjectiveFunctionUncertainty'], 0.1)
+    assert np.allclose(Optimiser.optimizer._gp.noise_variance, 0.01)
+    assert len(Optimiser.optimizer._gp.noise_variance) == len(Optimiser.optimizer.space.target)
+    # the uncertainty was 0.1 with 1e3 primaries, so 0.05 (half of the predicted std) needs 4e3 primaries:
+    Optimiser._plan_primaries(100, 0.1)
+    Optimiser._plan_primaries(101, 1e-5)
+    assert Optimiser._PlannedPrimaries[100] == 4000 and Optimiser._PlannedPrimaries[101] == 1e6
+
+
+def test_MultiFidelity():
+    """
+    each round of successive halving simulates mf_Eta ** 2 parameter sets at the lowest fidelity, then the best
+    third at the middle fidelity and the best one at the highest. The best result is taken from the highest fidelity
+    """
+    mf_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                 'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 26}
+    Optimiser = to.MultiFidelityOptimiser(optimisation_params=mf_params, BaseDirectory=BaseDirectory,
+                                          SimulationName='development_test_multifidelity',
+                                          OptimisationDirectory=OptimisationDirectory,
+                                          TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                          KeepAllResults=False, mf_Fidelities=[1e3, 1e4, 1e5],
+                                          mf_FidelityName='n_primaries', mf_RandomSeed=1)
+    Optimiser.RunOptimisation()
+    assert Optimiser.VariableDict['n_primaries'] == 1e5  # GenerateTopasScripts receives the fidelity
+    LogFile = BaseDirectory / 'development_test_multifidelity' / 'logs' / 'OptimisationLogs.txt'
+    ResultsDict = ReadInLogFile(LogFile)
+    assert ResultsDict['n_primaries'] == ([1e3] * 9 + [1e4] * 3 + [1e5]) * 2
+    assert ResultsDict['ObjectiveFunction'][0] == 1  # the start point is simulated first
+    # the second fidelity re-simulates the best of the first:
+    assert np.min(ResultsDict['ObjectiveFunction'][9:12]) == np.min(ResultsDict['ObjectiveFunction'][:9])
+    with open(LogFile) as f:
+        BestLine = f.readlines()[-1]
+    assert BestLine.split(',')[0] in ['Best parameter set: Itteration: 12.', 'Best parameter set: Itteration: 25.']
+
+def test_BayesianMeasuredNoiseRestart():
+    """
+    restarting without a checkpoint (as for optimisations from older versions) should read the measured noise of
+    each registered point back from the log file, skipping points which were simulated again but not registered
+    """
+    def ObjectiveFunctionWithIterationUncertainty(ResultsLocation, iteration):
+        """
+        a different uncertainty for each iteration, so that the noise of each point can be traced
+        """
+        return 0, 0.1 + 0.01 * iteration
+
+    noise_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 8}
+    for Nitterations in [8, 10]:
+        noise_params['Nitterations'] = Nitterations
+        Optimiser = to.BayesianOptimiser(optimisation_params=noise_params, BaseDirectory=BaseDirectory,
+                                         SimulationName='development_test_noise_restart',
+                                         OptimisationDirectory=OptimisationDirectory,
+                                         TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                         KeepAllResults=False, bayes_length_scales=.2, bayes_MeasuredNoise=True)
+        Optimiser.TopasObjectiveFunction = ObjectiveFunctionWithIterationUncertainty
+        if Nitterations == 8:
+            Optimiser.RunOptimisation()
+            # pretend the point of iteration 1 was requested again at iteration 3, which is logged but not
+            # registered, and that this optimisation is from a version without checkpoints:
+            LogFile = BaseDirectory / 'development_test_noise_restart' / 'logs' / 'OptimisationLogs.txt'
+            ResultsDict = ReadInLogFile(LogFile.with_suffix('.bin'))
+            Entries = [{key: values[row] for key, values in ResultsDict.items()} for row in range(8)]
+            Entries.insert(3, dict(Entries[1], ObjectiveFunctionUncertainty=5))
+            os.remove(LogFile.with_suffix('.bin'))
+            os.remove(str(LogFile.with_suffix('.bin')) + '.json')
+            for Entry in Entries:
+                AppendToBinaryLog(LogFile, Entry)
+            ExportLogToText(LogFile)
+            os.remove(Optimiser.CheckpointLocation)
+        else:
+            Optimiser.RestartOptimisation()
+    assert np.allclose(Optimiser._NoiseVariances[:8], (0.1 + 0.01 * np.arange(8)) ** 2)
+    assert len(Optimiser._NoiseVariances) == len(Optimiser.optimizer.space.target)
+
+
+def test_FakeSchedulerExecutor():
+    """
+    simulations are handed to the Executor rather than run directly. FakeSchedulerExecutor records each script and
+    finishes jobs after a random delay, so asynchronous results arrive out of order
+    """
+    exec_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                   'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 12}
+    Executor = FakeSchedulerExecutor(JobDuration=(0, 0.05), random_state=1)
+    Optimiser = to.BayesianOptimiser(optimisation_params=exec_params, BaseDirectory=BaseDirectory,
+                                     SimulationName='development_test_executor',
+                                     OptimisationDirectory=OptimisationDirectory,
+                                     TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                     KeepAllResults=False, bayes_length_scales=.2, bayes_BatchSize=3,
+                                     bayes_Asynchronous=True, Executor=Executor)
+    Optimiser.RunOptimisation()
+    assert len(Executor.SubmittedScripts) == 12
+    assert os.path.split(Executor.SubmittedScripts[-1])[1] == 'RunIteration_itt_11.sh'
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_executor' / 'logs' / 'OptimisationLogs.txt')
+    assert sorted(ResultsDict['Itteration']) == list(np.arange(12, dtype=float))
+
+
+def test_SlurmExecutorUnknownState():
+    """
+    jobs whose state can't be found, because the status command fails or doesn't exist, should fail after
+    UnknownStateTimeout rather than waiting forever, and the monitor should be restarted for later jobs
+    """
+    for StatusCommand in ['false', 'not_a_real_status_command {job_id}']:
+        Executor = SlurmExecutor(SubmitCommand='echo', StatusCommand=StatusCommand, PollInterval=0.01,
+                                 UnknownStateTimeout=0.1)
+        for _ in range(2):
+            future = Executor.Submit(BaseDirectory / 'RunIteration.sh', BaseDirectory)
+            assert future.result(timeout=10) == 1
+            Monitor = Executor._monitor
+            if Monitor is not None:
+                Monitor.join(timeout=10)
+            assert Executor._monitor is None
+
+
+def test_EarlyTermination():
+    """
+    the test TopasPartialObjectiveFunction says every simulation is much worse than the best so far, so every
+    simulation after the first should be stopped early and logged with its estimate
+    """
+    early_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 5}
+    Executor = FakeSchedulerExecutor(JobDuration=(5, 5))
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=early_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_early_termination',
+                                       OptimisationDirectory=OptimisationDirectory,
+                                       TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                       NM_StartingSimplex=.1, Executor=Executor, EarlyTerminationSigma=2,
+                                       EarlyTerminationInterval=0.05)
+    Optimiser.RunOptimisation()
+    assert len(Executor.CancelledScripts) == 4
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_early_termination' / 'logs' /
+                                'OptimisationLogs.txt')
+    assert ResultsDict['ObjectiveFunction'][0] < 100
+    assert all(OF == 100 for OF in ResultsDict['ObjectiveFunction'][1:])
+
+
+def test_SplitJobs():
+    """
+    With SplitJobs=2, SimpleCollimator (which nothing else reads here) should be split into two scripts with half
+    the histories each, run by their own shell scripts after RunIteration.sh. Its phase space can't be merged, so
+    it is changed to score a binned quantity instead
+    """
+    def GenerateCollimatorOnly(BaseDirectory, iteration, **variable_dict):
+        """
+        just the collimator from the test scripts, scoring the track count on the phase space surface
+        """
+        Scripts, ScriptNames = GenerateTopasScripts(BaseDirectory, iteration)
+        Collimator = [line.replace('"PhaseSpace"', '"SurfaceTrackCount"') for line in Scripts[0]]
+        return [Collimator], ScriptNames[:1]
+
+    split_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 3}
+    Executor = FakeSchedulerExecutor()
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=split_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_split_jobs',
+                                       OptimisationDirectory=OptimisationDirectory,
+                                       TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                       NM_StartingSimplex=.1, Executor=Executor, SplitJobs=2)
+    Optimiser.TopasScriptGenerator = GenerateCollimatorOnly
+    Optimiser.RunOptimisation()
+    assert [Path(Script).name for Script in Executor.SubmittedScripts] == \
+           ['RunIteration.sh', 'RunIteration_split_0.sh', 'RunIteration_split_1.sh'] * 3
+    ScriptsLocation = BaseDirectory / 'development_test_split_jobs' / 'TopasScripts'
+    with open(ScriptsLocation / 'RunIteration.sh') as f:
+        assert 'SimpleCollimator' not in f.read()
+    with open(ScriptsLocation / 'RunIteration_split_1.sh') as f:
+        assert 'SimpleCollimator_split_1_itt_2.tps' in f.read()
+    with open(ScriptsLocation / 'SimpleCollimator_split_1_itt_2.tps') as f:
+        SplitScript = f.read()
+    assert 'i:Ts/Seed = 2' in SplitScript
+    assert 'NumberOfHistoriesInRun = 250000' in SplitScript
+    assert 'coll_PhaseSpace_split_1_itt_2' in SplitScript
+    assert f'i:Ts/NumberOfThreads = {max(1, (os.cpu_count() or 1) // 2)}' in SplitScript
+
+    # the unmodified collimator writes a phase space, which can't be merged, so it shouldn't be split
+    def GeneratePhaseSpaceCollimator(BaseDirectory, iteration, **variable_dict):
+        """
+        just the collimator from the test scripts, unmodified
+        """
+        Scripts, ScriptNames = GenerateTopasScripts(BaseDirectory, iteration)
+        return Scripts[:1], ScriptNames[:1]
+
+    Executor = FakeSchedulerExecutor()
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=split_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_split_jobs',
+                                       OptimisationDirectory=OptimisationDirectory,
+                                       TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                       NM_StartingSimplex=.1, Executor=Executor, SplitJobs=2)
+    Optimiser.TopasScriptGenerator = GeneratePhaseSpaceCollimator
+    Optimiser.RunOptimisation()
+    assert [Path(Script).name for Script in Executor.SubmittedScripts] == ['RunIteration.sh'] * 3
+
+
+def test_EvaluateObjectiveFunctionBatch():
+    """
+    the test TopasObjectiveFunction.py has no batch function, so TopasObjectiveFunction is called for each iteration.
+    Uncertainties returned with the objective functions should be separated from them
+    """
+    OFs = to.EvaluateObjectiveFunctionBatch(OptimisationDirectory, BaseDirectory, range(3))
+    assert OFs.shape == (3,)
+    assert np.all(OFs == 0)
+    OFs, Uncertainties = to.EvaluateObjectiveFunctionBatch(OptimisationDirectory, BaseDirectory, range(3),
+                                                           ReturnUncertainty=True)
+    assert np.all(np.isnan(Uncertainties))
+
+    TopasObjectiveFunctionModule = sys.modules['TopasObjectiveFunction']
+    OriginalObjectiveFunction = TopasObjectiveFunctionModule.TopasObjectiveFunction
+    TopasObjectiveFunctionModule.TopasObjectiveFunction = TopasObjectiveFunctionWithUncertainty
+    try:
+        assert np.all(to.EvaluateObjectiveFunctionBatch(OptimisationDirectory, BaseDirectory, range(3)) == 0)
+        OFs, Uncertainties = to.EvaluateObjectiveFunctionBatch(OptimisationDirectory, BaseDirectory, range(3),
+                                                               ReturnUncertainty=True)
+    finally:
+        TopasObjectiveFunctionModule.TopasObjectiveFunction = OriginalObjectiveFunction
+    assert OFs.shape == (3,) and np.all(OFs == 0)
+    assert np.all(Uncertainties == 0.1)
+
+
+def test_SimulationCache():
+    """
+    the test GenerateTopasScripts ignores the parameters, so every model is identical: only the first should be
+    simulated, and a second study sharing the cache shouldn't need to simulate anything
+    """
+    cache_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 10}
+    if os.path.isdir(BaseDirectory / 'simulation_cache'):
+        shutil.rmtree(BaseDirectory / 'simulation_cache')  # left over from a previous test run
+    Cache = SimulationCache(BaseDirectory / 'simulation_cache')
+    for SimulationName, ExpectedSubmissions in [('development_test_cache1', 1), ('development_test_cache2', 0)]:
+        Executor = FakeSchedulerExecutor()
+        Optimiser = to.NelderMeadOptimiser(optimisation_params=cache_params, BaseDirectory=BaseDirectory,
+                                           SimulationName=SimulationName,
+                                           OptimisationDirectory=OptimisationDirectory,
+                                           TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                           NM_StartingSimplex=.1, Executor=Executor, SimulationCache=Cache)
+        Optimiser.RunOptimisation()
+        assert len(Executor.SubmittedScripts) == ExpectedSubmissions
+        assert Optimiser._CacheKeys == {}  # each key is forgotten once its iteration has been evaluated
+        ResultsDict = ReadInLogFile(BaseDirectory / SimulationName / 'logs' / 'OptimisationLogs.txt')
+        assert len(ResultsDict['ObjectiveFunction']) == 10
+
+
+def test_RunIterationExitCode():
+    """
+    RunIteration.sh should fail if any topas run fails, including one of several run at the same time
+    """
+    def GenerateScriptsWithParallelStage(BaseDirectory, iteration, **variable_dict):
+        """
+        the test scripts, plus a second water tank which runs alongside the first
+        """
+        (SimpleCollimator, WaterTank), ScriptNames = GenerateTopasScripts(BaseDirectory, iteration)
+        SecondWaterTank = [line.replace('WaterTank_itt', 'SecondWaterTank_itt') for line in WaterTank]
+        return [SimpleCollimator, WaterTank, SecondWaterTank], ScriptNames + ['SecondWaterTank']
+
+    exit_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                   'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 3}
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=exit_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_exit_code',
+                                       OptimisationDirectory=OptimisationDirectory,
+                                       TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                       NM_StartingSimplex=.1, ParallelScripts=True)
+    Optimiser.TopasScriptGenerator = GenerateScriptsWithParallelStage
+    Optimiser.RunOptimisation()
+    ScriptsLocation = BaseDirectory / 'development_test_exit_code' / 'TopasScripts'
+    with open(ScriptsLocation / 'RunIteration.sh') as f:
+        assert 'SecondWaterTank_itt_2.tps) &> ../logs/TopasLogs/SecondWaterTank_itt_2.tps &' in f.read()
+    assert subprocess.run(['bash', 'RunIteration.sh'], cwd=ScriptsLocation, capture_output=True).returncode == 0
+    with open(BaseDirectory / 'development_test_exit_code' / 'bin' / 'topas', 'w') as f:
+        f.write('case "$1" in *SecondWaterTank*) exit 3;; esac')
+    assert subprocess.run(['bash', 'RunIteration.sh'], cwd=ScriptsLocation, capture_output=True).returncode == 1
+
+
+def test_StageCache():
+    """
+    WaterTank reads the phase space written by SimpleCollimator. If only WaterTank changes between iterations,
+    SimpleCollimator should only be simulated once and its cached output used from then on
+    """
+    def GenerateScriptsWithDownstreamChange(BaseDirectory, iteration, **variable_dict):
+        """
+        the test scripts, but with the water tank depending on x
+        """
+        Scripts, ScriptNames = GenerateTopasScripts(BaseDirectory, iteration)
+        Scripts[1].append(f'd:Ge/Phantom/TransZ = {variable_dict["x"]} mm')
+        return Scripts, ScriptNames
+
+    stage_params = {'ParameterNames': ['x', 'y'], 'UpperBounds': np.array([1, 1]),
+                    'LowerBounds': np.array([-1, -1]), 'start_point': np.array([0, 0]), 'Nitterations': 6}
+    if os.path.isdir(BaseDirectory / 'stage_cache'):
+        shutil.rmtree(BaseDirectory / 'stage_cache')  # left over from a previous test run
+    Optimiser = to.NelderMeadOptimiser(optimisation_params=stage_params, BaseDirectory=BaseDirectory,
+                                       SimulationName='development_test_stage_cache',
+                                       OptimisationDirectory=OptimisationDirectory,
+                                       TopasLocation='testing_mode', ReadMeText=ReadMeText, Overwrite=True,
+                                       NM_StartingSimplex=.1, Executor=FakeSchedulerExecutor(RunScripts=True),
+                                       SimulationCache=SimulationCache(BaseDirectory / 'stage_cache'), TextLog=False)
+    Optimiser.TopasScriptGenerator = GenerateScriptsWithDownstreamChange
+    Optimiser.RunOptimisation()
+    with open(BaseDirectory / 'development_test_stage_cache' / 'TopasScripts' / 'RunIteration.sh') as f:
+        ShellScript = f.read()
+    assert 'Using cached results for: SimpleCollimator_itt_5.tps' in ShellScript
+    assert 'Beginning analysis of: WaterTank_itt_5.tps' in ShellScript
+    ResultsDict = ReadInLogFile(BaseDirectory / 'development_test_stage_cache' / 'logs' / 'OptimisationLogs.txt')
+    assert len(ResultsDict['ObjectiveFunction']) == 6
+    # with TextLog=False the text log is only exported at the end:
+    with open(BaseDirectory / 'development_test_stage_cache' / 'logs' / 'OptimisationLogs.txt') as f:
+        assert f.read().startswith('Itteration: 0, x: ')
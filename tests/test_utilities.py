@@ -11,8 +11,14 @@ from pathlib import Path
 this_dir = Path(__file__).parent
 sys.path.insert(0, str(this_dir.parent))
 
+import os
+import shutil
 import numpy as np
-from TopasOpt.utilities import WaterTankData, ReadInLogFile, PlotLogFile, compare_multiple_results
+from TopasOpt.utilities import WaterTankData, ReadInLogFile, PlotLogFile, compare_multiple_results, SimulationCache, \
+    AppendToBinaryLog, LogReader, ExportLogToText, BackgroundRenderer, PlotConvergence, \
+    GaussianProcessSlicer, IncrementalGaussianProcessRegressor, SparseGaussianProcessRegressor, \
+    PooledUpperConfidenceBound, heteroscedastic_alpha, MemoryMappedBinnedResult, SumBinnedResults, \
+    MergeBinnedResults, ReferenceDataCache, ExtractDataFromResults
 
 
 def test_WaterTankData():
@@ -23,9 +29,440 @@ def test_WaterTankData():
 
     ResultsLocation = str(this_directory.parent / 'docsrc' / '_resources')
     WT = WaterTankData(ResultsLocation, 'WaterTank.bin')
+    # several files are summed:
+    WT_double = WaterTankData(ResultsLocation, ['WaterTank.bin', 'WaterTank.bin'], ReadThreads=2)
+    assert np.allclose(WT_double.DoseCube, 2 * WT.DoseCube)
 
     # Extract some data
     Xpts_prof = WT.x  # profile over entire X range
     Ypts_prof = np.zeros(Xpts_prof.shape)
     Zpts_prof = WT.PhantomSizeZ * np.ones(Xpts_prof.shape)  # at the middle of the water tank
     WT.ProfileDose_X = WT.ExtractDataFromDoseCube(Xpts_prof, Ypts_prof, Zpts_prof)
+
+
+def test_ExtractDataFromDoseCube():
+    """
+    extracting points on and between the voxel centres, and outside the dose cube, should give the same results as
+    scipy's RegularGridInterpolator, whether or not the weights are cached
+    """
+    from scipy.interpolate import RegularGridInterpolator
+    this_directory = Path(__file__).parent
+    WT = WaterTankData(str(this_directory.parent / 'docsrc' / '_resources'), 'WaterTank.bin')
+    Interpolator = RegularGridInterpolator((WT.x, WT.y, WT.z), WT.DoseCube, bounds_error=False, fill_value=0)
+    rng = np.random.default_rng(1)
+    Xpts, Zpts = np.meshgrid(WT.x, WT.z)
+    Queries = [(WT.x, np.zeros(WT.x.shape), WT.PhantomSizeZ * np.ones(WT.x.shape)),  # profile
+               (np.zeros(WT.z.shape), np.zeros(WT.z.shape), WT.z),  # depth dose
+               (Xpts, WT.y[3] * np.ones(Xpts.shape), Zpts),  # plane through the voxel centres
+               tuple(rng.uniform(-1.2, 1.2, (3, 500)) * np.array([[WT.PhantomSizeX], [WT.PhantomSizeY],
+                                                                   [WT.PhantomSizeZ]]))]
+    for Query in Queries:
+        Expected = Interpolator(np.stack([np.ravel(Points) for Points in Query]).T).reshape(Query[0].shape)
+        assert np.allclose(WT.ExtractDataFromDoseCube(*Query), Expected)
+        assert np.allclose(WT.ExtractDataFromDoseCube(*Query), Expected)  # cached
+
+
+def test_ReferenceDataCache():
+    """
+    a reference should only be read once, and a new cache reading the same CacheFile should get the same data
+    without summing the file again. Extracting data shouldn't rewrite the dose cube. If the file changes, it should
+    be read again and the old version forgotten
+    """
+    this_directory = Path(__file__).parent
+    TestDirectory = Path('./temp_test').resolve() / 'reference_test'
+    os.makedirs(TestDirectory, exist_ok=True)
+    for file in ['WaterTank.bin', 'WaterTank.binheader']:
+        shutil.copy(this_directory.parent / 'docsrc' / '_resources' / file, TestDirectory / file)
+    CacheFile = TestDirectory / 'ReferenceData.npz'
+    for File in [CacheFile, TestDirectory / 'ReferenceData.extracted.npz']:
+        if os.path.isfile(File):
+            os.remove(File)
+
+    Cache = ReferenceDataCache(CacheFile)
+    Reference = Cache.GetWaterTankData(TestDirectory, 'WaterTank.bin')
+    assert Cache.GetWaterTankData(TestDirectory, 'WaterTank.bin') is Reference
+    Zpts = Reference.z
+    CubeModified = os.stat(CacheFile).st_mtime_ns
+    DepthDose = Cache.ExtractDataFromDoseCube(Reference, np.zeros(Zpts.shape), np.zeros(Zpts.shape), Zpts)
+    assert os.stat(CacheFile).st_mtime_ns == CubeModified
+    assert np.allclose(DepthDose, Reference.ExtractDataFromDoseCube(np.zeros(Zpts.shape), np.zeros(Zpts.shape), Zpts))
+
+    Restarted = ReferenceDataCache(CacheFile)
+    assert len(Restarted._Saved) == 2  # the dose cube and the depth dose
+    RestoredReference = Restarted.GetWaterTankData(TestDirectory, 'WaterTank.bin')
+    assert np.allclose(RestoredReference.DoseCube, Reference.DoseCube)
+    assert np.allclose(Restarted.ExtractDataFromDoseCube(RestoredReference, np.zeros(Zpts.shape),
+                                                         np.zeros(Zpts.shape), Zpts), DepthDose)
+
+    # a changed file is read again, and the out of date entries are removed:
+    os.utime(TestDirectory / 'WaterTank.bin', ns=(0, 0))
+    assert Restarted.GetWaterTankData(TestDirectory, 'WaterTank.bin') is not RestoredReference
+    assert len(Restarted._WaterTankData) == 1 and len(Restarted._Keys) == 1
+    assert len(ReferenceDataCache(CacheFile)._Saved) == 1
+
+
+def test_ExtractDataFromResults():
+    """
+    extracting from several files at once should give one row per file, matching extraction from each file
+    """
+    this_directory = Path(__file__).parent
+    ResultsLocation = this_directory.parent / 'docsrc' / '_resources'
+    WT = WaterTankData(str(ResultsLocation), 'WaterTank.bin')
+    Profile = (WT.x, np.zeros(WT.x.shape), WT.PhantomSizeZ * np.ones(WT.x.shape))
+    Xpts, Zpts = np.meshgrid(WT.x, WT.z)
+    Plane = (Xpts, np.zeros(Xpts.shape), Zpts)
+    Profiles, Planes = ExtractDataFromResults([ResultsLocation / 'WaterTank.bin'] * 3, [Profile, Plane], Threads=2)
+    assert Profiles.shape == (3,) + WT.x.shape
+    assert Planes.shape == (3,) + Xpts.shape
+    assert np.allclose(Profiles, WT.ExtractDataFromDoseCube(*Profile))
+    assert np.allclose(Planes, WT.ExtractDataFromDoseCube(*Plane))
+
+
+def test_MemoryMappedBinnedResult():
+    """
+    the memory mapped data should match topas2numpy for a file with several statistics, without being read into
+    memory until GetStatistic is called
+    """
+    import topas2numpy as tp
+
+    TestDirectory = Path('./temp_test').resolve() / 'memmap_test'
+    os.makedirs(TestDirectory, exist_ok=True)
+    Header = ['# Results for scorer Dose', '# X in 4 bins of 0.5 cm', '# Y in 3 bins of 0.5 cm',
+              '# Z in 5 bins of 1 cm', '# DoseToMedium ( Gy ) : Sum   Mean   Standard_Deviation']
+    with open(TestDirectory / 'Dose.binheader', 'w') as f:
+        f.write('\n'.join(Header) + '\n')
+    np.random.default_rng(1).uniform(0, 1, 3 * 4 * 3 * 5).tofile(TestDirectory / 'Dose.bin')
+
+    Expected = tp.BinnedResult(str(TestDirectory / 'Dose.bin'))
+    Result = MemoryMappedBinnedResult(TestDirectory / 'Dose.bin', Scale=1e6)
+    assert Result.statistics == ['Sum', 'Mean', 'Standard_Deviation'] and Result.unit == 'Gy'
+    for Statistic in Result.statistics:
+        assert isinstance(Result.data[Statistic], np.memmap)
+        assert np.array_equal(Result.data[Statistic], Expected.data[Statistic])
+    Mean = np.zeros([4, 3, 5])
+    Result.GetStatistic('Mean', out=Mean)
+    assert np.allclose(Mean, 1e6 * Expected.data['Mean'])
+    assert np.allclose(Result.GetStatistic('Sum'), 1e6 * Expected.data['Sum'])
+
+
+def test_SumBinnedResults():
+    """
+    streaming several files into one array, in small chunks and in parallel, should give the same sum as reading
+    them all in. A singleton dimension is broadcast over a larger output, as WaterTankData does
+    """
+    TestDirectory = Path('./temp_test').resolve() / 'sum_test'
+    os.makedirs(TestDirectory, exist_ok=True)
+    Header = ['# Results for scorer Dose', '# X in 1 bin  of 0.5 cm', '# Y in 3 bins of 0.5 cm',
+              '# Z in 50 bins of 1 cm', '# DoseToMedium ( Gy ) : Sum   Standard_Deviation']
+    rng = np.random.default_rng(1)
+    Results = []
+    for i in range(6):
+        with open(TestDirectory / f'Dose_{i}.binheader', 'w') as f:
+            f.write('\n'.join(Header) + '\n')
+        rng.uniform(0, 1, 2 * 3 * 50).tofile(TestDirectory / f'Dose_{i}.bin')
+        Results.append(MemoryMappedBinnedResult(TestDirectory / f'Dose_{i}.bin', Scale=1000))
+    Expected = 1000 * np.sum([Result.data['Sum'] for Result in Results], axis=0)
+
+    assert np.allclose(SumBinnedResults(Results), Expected)
+    Mirrored = SumBinnedResults(Results, out=np.zeros([2, 3, 50]), Threads=3, ChunkBytes=100)
+    assert np.allclose(Mirrored, np.concatenate([Expected, Expected]))
+
+
+def test_MergeBinnedResults():
+    """
+    merging the results of several parts of a job should give the statistics of all their histories together
+    """
+    TestDirectory = Path('./temp_test').resolve() / 'merge_test'
+    os.makedirs(TestDirectory, exist_ok=True)
+    Statistics = ['Sum', 'Mean', 'Count_in_Bin', 'Second_Moment', 'Variance', 'Standard_Deviation', 'Min', 'Max']
+    Header = ['# Results for scorer Dose_itt_1', '# X in 2 bins of 0.5 cm', '# Y in 1 bin  of 0.5 cm',
+              '# Z in 5 bins of 1 cm', '# DoseToMedium ( Gy ) : ' + '   '.join(Statistics)]
+    rng = np.random.default_rng(1)
+    Histories = [20, 30, 45]
+    Parts = [rng.exponential(1, (n, 2, 1, 5)) for n in Histories]
+    InputFiles = []
+    for i, Part in enumerate(Parts):
+        Data = [Part.sum(axis=0), Part.mean(axis=0), np.full((2, 1, 5), len(Part)),
+                np.sum((Part - Part.mean(axis=0)) ** 2, axis=0), Part.var(axis=0, ddof=1), Part.std(axis=0, ddof=1),
+                Part.min(axis=0), Part.max(axis=0)]
+        InputFiles.append(TestDirectory / f'Dose_split_{i}_itt_1.bin')
+        np.stack([Statistic.ravel(order='F') for Statistic in Data], axis=1).tofile(InputFiles[-1])
+        with open(TestDirectory / f'Dose_split_{i}_itt_1.binheader', 'w') as f:
+            f.write('\n'.join(Header).replace('Dose_itt_1', f'Dose_split_{i}_itt_1') + '\n')
+
+    # small chunks, so that the parts are combined a slice at a time:
+    MergeBinnedResults(InputFiles, TestDirectory / 'Dose_itt_1.bin', Histories, ChunkBytes=16)
+    Merged = MemoryMappedBinnedResult(TestDirectory / 'Dose_itt_1.bin')
+    AllHistories = np.concatenate(Parts)
+    assert Merged.statistics == Statistics
+    assert np.allclose(Merged.data['Sum'], AllHistories.sum(axis=0))
+    assert np.allclose(Merged.data['Mean'], AllHistories.mean(axis=0))
+    assert np.all(Merged.data['Count_in_Bin'] == sum(Histories))
+    assert np.allclose(Merged.data['Variance'], AllHistories.var(axis=0, ddof=1))
+    assert np.allclose(Merged.data['Standard_Deviation'], AllHistories.std(axis=0, ddof=1))
+    assert np.all(Merged.data['Min'] == AllHistories.min(axis=0))
+    assert np.all(Merged.data['Max'] == AllHistories.max(axis=0))
+    with open(TestDirectory / 'Dose_itt_1.binheader') as f:
+        assert f.read().startswith('# Results for scorer Dose_itt_1')
+
+
+def test_SimulationCache():
+    """
+    results stored for one iteration can be restored under another, and old entries are evicted once the cache is
+    too big
+    """
+    TestDirectory = Path('./temp_test').resolve() / 'cache_test'
+    if TestDirectory.is_dir():
+        shutil.rmtree(TestDirectory)
+    os.makedirs(TestDirectory / 'Results')
+    Cache = SimulationCache(TestDirectory / 'cache', MaxSizeGB=1.5e-6)  # room for one 1000 byte entry
+
+    Script3 = ['s:Sc/Dose/OutputFile = "../Results/Dose_itt_3"', 'd:Ge/Block/HLX = 1 mm']
+    Script7 = [line.replace('_itt_3', '_itt_7') for line in Script3]
+    Key3 = Cache.GetKey([Script3], 3, 'nowhere', '~/G4Data')
+    assert Key3 == Cache.GetKey([Script7], 7, 'nowhere', '~/G4Data')
+    assert not Key3 == Cache.GetKey([Script3], 3, 'nowhere', '~/OtherG4Data')
+    # relative include files are found in the directory topas runs from, whatever the working directory is:
+    os.makedirs(TestDirectory / 'TopasScripts')
+    with open(TestDirectory / 'TopasScripts' / 'Materials.txt', 'w') as f:
+        f.write('d:Ge/Block/HLY = 1 mm\n')
+    ScriptWithInclude = Script3 + ['includeFile = Materials.txt']
+    IncludeKey = Cache.GetKey([ScriptWithInclude], 3, 'nowhere', '~/G4Data',
+                              ScriptDirectory=TestDirectory / 'TopasScripts')
+    with open(TestDirectory / 'TopasScripts' / 'Materials.txt', 'w') as f:
+        f.write('d:Ge/Block/HLY = 10 mm\n')
+    assert not IncludeKey == Cache.GetKey([ScriptWithInclude], 3, 'nowhere', '~/G4Data',
+                                          ScriptDirectory=TestDirectory / 'TopasScripts')
+    assert not Cache.RestoreResults(Key3, TestDirectory / 'Results', 3)
+
+    Data = np.random.default_rng(1).bytes(1000)
+    with open(TestDirectory / 'Results' / 'Dose_itt_3.bin', 'wb') as f:
+        f.write(Data)
+    Cache.StoreResults(Key3, [TestDirectory / 'Results' / 'Dose_itt_3.bin'], 3, 1.5, 'objective')
+    assert Cache.RestoreResults(Key3, TestDirectory / 'Results', 7)
+    with open(TestDirectory / 'Results' / 'Dose_itt_7.bin', 'rb') as f:
+        assert f.read() == Data
+    assert Cache.GetObjectiveFunction(Key3, 'objective') == 1.5
+    assert Cache.GetObjectiveFunction(Key3, 'another objective') is None
+
+    # a second entry pushes the cache over its size limit, so the first is evicted:
+    Script3[1] = 'd:Ge/Block/HLX = 2 mm'
+    OtherKey = Cache.GetKey([Script3], 3, 'nowhere', '~/G4Data')
+    Cache.StoreResults(OtherKey, [TestDirectory / 'Results' / 'Dose_itt_3.bin'], 3)
+    assert Cache.RestoreResults(OtherKey, TestDirectory / 'Results', 3)
+    assert not Cache.RestoreResults(Key3, TestDirectory / 'Results', 3)
+
+
+def test_BinaryLog():
+    """
+    the binary log keeps full precision, can be read incrementally, and can be exported to the text format
+    """
+    TestDirectory = Path('./temp_test').resolve() / 'binary_log_test'
+    if TestDirectory.is_dir():
+        shutil.rmtree(TestDirectory)
+    os.makedirs(TestDirectory)
+    LogFileLoc = TestDirectory / 'OptimisationLogs.txt'
+
+    Reader = LogReader(LogFileLoc)
+    assert Reader.Read() == {}
+    for Itteration in range(100):
+        AppendToBinaryLog(LogFileLoc, {'Itteration': Itteration, 'x': Itteration / 3, 'ObjectiveFunction': 1 / 7})
+        if Itteration == 49:
+            assert len(Reader.Read()['x']) == 50
+    ResultsDict = Reader.Read()
+    assert list(ResultsDict.keys()) == ['Itteration', 'x', 'ObjectiveFunction']
+    assert np.array_equal(ResultsDict['Itteration'], np.arange(100))
+    assert ResultsDict['x'][10] == 10 / 3  # no loss of precision
+
+    ExportLogToText(LogFileLoc)
+    with open(LogFileLoc) as f:
+        assert f.readline() == 'Itteration: 0, x:  0.00, ObjectiveFunction:  0.14\n'
+    assert ReadInLogFile(LogFileLoc)['ObjectiveFunction'][99] == 0.14  # the text log is read when it's named
+    assert ReadInLogFile(LogFileLoc.with_suffix('.bin'))['ObjectiveFunction'][99] == 1 / 7
+
+    # values which weren't in the first entry get a new column, rather than being dropped:
+    AppendToBinaryLog(LogFileLoc, {'Itteration': 100, 'x': 0, 'ObjectiveFunction': 1, 'fidelity': 2})
+    ResultsDict = Reader.Read()
+    assert list(ResultsDict.keys()) == ['Itteration', 'x', 'ObjectiveFunction', 'fidelity']
+    assert np.array_equal(ResultsDict['Itteration'], np.arange(101))
+    assert np.all(np.isnan(ResultsDict['fidelity'][:100])) and ResultsDict['fidelity'][100] == 2
+
+
+def test_BackgroundRenderer():
+    """
+    plots requested from the renderer are drawn in another process; only the newest request for each plot is needed
+    """
+    TestDirectory = Path('./temp_test').resolve() / 'renderer_test'
+    if TestDirectory.is_dir():
+        shutil.rmtree(TestDirectory)
+    os.makedirs(TestDirectory)
+
+    for InBackground in [True, False]:
+        Renderer = BackgroundRenderer(InBackground=InBackground)
+        for Itteration in range(1, 20):
+            ResultsDict = {'Itteration': np.arange(Itteration), 'ObjectiveFunction': np.linspace(1, 0, Itteration)}
+            Renderer.Submit('ConvergencePlot', PlotConvergence, ResultsDict,
+                            TestDirectory / f'ConvergencePlot_{InBackground}.png')
+        Renderer.Close(wait=True)
+        assert os.path.isfile(TestDirectory / f'ConvergencePlot_{InBackground}.png')
+
+
+def test_GaussianProcessSlicer():
+    """
+    the cached distance calculation should give the same answer as predicting each slice with the gaussian process
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern, RationalQuadratic
+
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, [40, 3])
+    y = np.sin(X).sum(axis=1)
+    Centre = X[0]
+    Bounds = np.array([[-1, 1]] * 3)
+    for kernel in [Matern(length_scale=[.5, 1, 2], nu=2.5), RationalQuadratic()]:  # fast path and fallback
+        gp = GaussianProcessRegressor(kernel=kernel, alpha=0.01, normalize_y=True, optimizer=None).fit(X, y)
+        Slices, PairwiseSlices = GaussianProcessSlicer(gp).Predict(Centre, Bounds, Nsamples=20, Pairwise=True,
+                                                                   PairwiseSamples=5)
+        values, mean, std = Slices[1]
+        Points = np.tile(Centre, [20, 1])
+        Points[:, 1] = values
+        expected_mean, expected_std = gp.predict(Points, return_std=True)
+        assert np.allclose(mean, expected_mean) and np.allclose(std, expected_std)
+
+        values_0, values_2, mean, std = PairwiseSlices[(0, 2)]
+        Points = np.tile(Centre, [25, 1])
+        Points[:, 0], Points[:, 2] = [grid.ravel() for grid in np.meshgrid(values_0, values_2, indexing='ij')]
+        expected_mean, expected_std = gp.predict(Points, return_std=True)
+        assert np.allclose(mean, expected_mean.reshape(5, 5)) and np.allclose(std, expected_std.reshape(5, 5))
+
+
+def test_IncrementalGaussianProcessRegressor():
+    """
+    adding points with Cholesky updates should give the same model as a full fit with the same hyperparameters,
+    including when points are removed again as with the constant liar
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, [60, 2])
+    y = np.sin(3 * X).sum(axis=1)
+    gp = IncrementalGaussianProcessRegressor(kernel=Matern(length_scale=[1, 1], nu=1.5), alpha=0.01,
+                                             normalize_y=True, n_restarts_optimizer=2, random_state=1,
+                                             refit_every=20)
+    for n in range(10, 61):
+        gp.fit(X[:n], y[:n])
+    assert gp.n_full_fits_ == 3  # at 10, 30 and 50 points
+    TestPoints = rng.uniform(-1, 1, [20, 2])
+    for n in [60, 55]:
+        gp.fit(X[:n], y[:n])
+        expected = GaussianProcessRegressor(kernel=gp.kernel_, alpha=0.01, normalize_y=True,
+                                            optimizer=None).fit(X[:n], y[:n])
+        mean, std = gp.predict(TestPoints, return_std=True)
+        expected_mean, expected_std = expected.predict(TestPoints, return_std=True)
+        assert np.allclose(mean, expected_mean) and np.allclose(std, expected_std)
+        assert np.isclose(gp.log_marginal_likelihood_value_, expected.log_marginal_likelihood_value_)
+    assert gp.n_full_fits_ == 3
+
+
+def test_heteroscedastic_alpha():
+    """
+    measured noise is added to alpha per point, in normalised units when the targets are normalised. Points without
+    a measurement (e.g. constant liar dummies) get the mean. The incremental gaussian process should extend its
+    factor rather than recalculating it, keeping the normalisation of its last full fit, and match an exact fit
+    with the same normalisation and alpha
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+
+    y = np.array([0., 2, 4, 6])
+    assert heteroscedastic_alpha(0.01, None, y, True) == 0.01
+    assert np.allclose(heteroscedastic_alpha(0.01, [1, 2, 3], y, False), [1.01, 2.01, 3.01, 2.01])
+    assert np.allclose(heteroscedastic_alpha(0.01, [5, 5, 5, 5], y, True), 0.01 + 5 / np.var(y))
+
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, [40, 2])
+    y = np.sin(3 * X).sum(axis=1)
+    noise_variance = rng.uniform(0, 0.1, 40)
+    gp = IncrementalGaussianProcessRegressor(kernel=Matern(length_scale=[1, 1], nu=1.5), alpha=0.01,
+                                             normalize_y=True, refit_every=50, noise_variance=noise_variance[:30])
+    assert np.allclose(heteroscedastic_alpha(0.01, [5, 5, 5, 5], y[:4], True, y_std=2), 0.01 + 5 / 4)
+    TestPoints = rng.uniform(-1, 1, [20, 2])
+    Mean, Std = np.mean(y[:30]), np.std(y[:30])
+    for n in [30, 35]:
+        gp.fit(X[:n], y[:n])
+        if n == 30:
+            L = gp.L_.copy()
+        expected = GaussianProcessRegressor(kernel=gp.kernel_, optimizer=None,
+                                            alpha=heteroscedastic_alpha(0.01, noise_variance[:30], y[:n], True,
+                                                                        y_std=Std))
+        expected.fit(X[:n], (y[:n] - Mean) / Std)
+        assert np.allclose(gp.predict(TestPoints), expected.predict(TestPoints) * Std + Mean)
+    assert np.array_equal(gp.L_[:30, :30], L)
+    assert gp.n_full_fits_ == 1
+
+
+def test_SparseGaussianProcessRegressor():
+    """
+    with few points the sparse gaussian process should be exact; with many its mean should stay close to the exact
+    one
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, [400, 2])
+    y = np.sin(3 * X).sum(axis=1)
+    TestPoints = rng.uniform(-1, 1, [50, 2])
+    for n in [50, 400]:
+        gp = SparseGaussianProcessRegressor(kernel=Matern(length_scale=[.5, .5], nu=1.5), alpha=0.01,
+                                            normalize_y=True, optimizer=None, n_inducing=100).fit(X[:n], y[:n])
+        exact = GaussianProcessRegressor(kernel=gp.kernel_, alpha=0.01, normalize_y=True,
+                                         optimizer=None).fit(X[:n], y[:n])
+        mean, std = gp.predict(TestPoints, return_std=True)
+        expected_mean, expected_std = exact.predict(TestPoints, return_std=True)
+        _, cov = gp.predict(TestPoints[:5], return_cov=True)
+        assert np.allclose(np.sqrt(np.diag(cov)), std[:5])
+        if n <= 100:
+            assert not gp.sparse_ and np.allclose(mean, expected_mean) and np.allclose(std, expected_std)
+        else:
+            assert gp.sparse_ and gp.inducing_points_.shape == (100, 2)
+            assert np.max(np.abs(mean - expected_mean)) < 0.1
+            assert np.max(np.abs(std - expected_std)) < 0.3  # FITC tends to overestimate the uncertainty
+
+
+def test_PooledUpperConfidenceBound():
+    """
+    the pooled acquisition optimiser should find a maximum at least as good as bayes_opt's default, and refining in
+    parallel processes should give the same answer as refining in this one
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+    from bayes_opt import acquisition
+    from bayes_opt.target_space import TargetSpace
+
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, [50, 4])
+    Space = TargetSpace(None, {f'x{i}': (-1, 1) for i in range(4)})
+    for x in X:
+        Space.register(x, -np.sum((x - 0.3) ** 2))
+    gp = GaussianProcessRegressor(kernel=Matern(length_scale=np.ones(4), nu=2.5), alpha=1e-3, normalize_y=True,
+                                  optimizer=None).fit(Space.params, Space.target)
+    Default = acquisition.UpperConfidenceBound(kappa=1, random_state=1)
+    UCB = Default._get_acq(gp=gp)  # -1 * upper confidence bound
+    BestDefault = UCB(Default.suggest(gp, Space, fit_gp=False))
+    Suggestions = {}
+    for Workers in [1, 2]:
+        Pooled = PooledUpperConfidenceBound(kappa=1, random_state=1, pool_size=1024, n_workers=Workers)
+        Pooled.Start()
+        Processes = Pooled._workers
+        Suggestions[Workers] = []
+        for n in range(2):  # the second suggestion starts from the first's refined points
+            Suggestion = Pooled.suggest(gp, Space, fit_gp=False)
+            assert np.all(Suggestion >= -1) and np.all(Suggestion <= 1)
+            assert UCB(Suggestion) <= BestDefault + 1e-6
+            Suggestions[Workers].append(Suggestion)
+        assert Pooled._workers is Processes  # the same processes are used for every suggestion
+        Pooled.Close()
+        assert Pooled._workers is None
+    assert np.allclose(Suggestions[1], Suggestions[2])